@@ -8,12 +8,31 @@ A tribute to the videogame for NES named "The Guardian Legend"
 @author: Mauro Brenna
 """
 
+import argparse
+import array
 import logging
+import logging.handlers
 import math
 import random
 import os
+import pickle
+import queue
+import collections
+import gc
+import heapq
 import itertools
+import io
+import json
+import statistics
 import sys
+import threading
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError: # not on Windows
+    resource = None
 
 
 import pygame
@@ -40,7 +59,83 @@ PLAYER_IMMORTAL = False
 
 MAX_NUM_BULLET_AND_PLAYER = 3 + 1  # Max num player bullet on screen plus player
 
+#--- Difficulty ---
+INTERVAL_SPAWN_ENEMY = 1500 # ms
+KILL_RATE_SMOOTHING = 0.50 # alpha of exponential smoothing of ms per kill
+BOSS_MIN_SCORE = 50 # The boss can be spawn only when score is high
+BOSS_PROBABILITY = 0.05
+
+#--- Audio ---
+# Music, the files are read once and played from memory
+MUSIC_FILES = {'title': 'title.mid',
+               'corridor': 'corridor-0.mid',
+               'game_over': 'game-over.mid'}
+# Sound effects: name: (file, category)
+SOUND_FILES = {'fire': ('laser5.ogg', 'player_fire'),
+               'hit': ('27826_erdie_sword01_short.ogg', 'hit')}
+# category: (reserved channels, steal the oldest voice when all are busy)
+SOUND_CATEGORIES = {'player_fire': (2, True),
+                    'hit': (1, False)}
+
 DISPLAY_FLAGS = pygame.HWSURFACE|pygame.DOUBLEBUF|pygame.RESIZABLE
+LATENCY_SAMPLES = 600 # last frames of the input latency statistics
+
+# Folder containing bitmaps, fonts, maps and sounds
+DATA_DIR = os.path.dirname(os.path.abspath(__file__))
+
+#--- Collision categories ---
+# Each physical object is tagged with one of these ids
+CATEGORY_PLAYER = 0
+CATEGORY_PLAYER_IMMORTAL = 1
+CATEGORY_PLAYER_BULLET = 2
+CATEGORY_ENEMY = 3
+CATEGORY_ENEMY_BULLET = 4
+NUM_CATEGORIES = 5
+
+BULLET_CATEGORIES = (CATEGORY_PLAYER_BULLET, CATEGORY_ENEMY_BULLET)
+CATEGORY_NAMES = ('player', 'player immortal', 'player bullet', 'enemy',
+                  'enemy bullet')
+
+#--- Draw layers, from the bottom. The map is drawn below them ---
+LAYER_ENEMY_BULLETS = 0
+LAYER_ENEMIES = 1
+LAYER_BOSS = 2
+LAYER_PLAYER_BULLETS = 3
+LAYER_PLAYER = 4
+NUM_DRAW_LAYERS = 5
+
+#--- Input actions ---
+# The actions held by the player are a bit mask of these
+ACTION_NONE = 0
+ACTION_LEFT = 1
+ACTION_RIGHT = 2
+ACTION_UP = 4
+ACTION_DOWN = 8
+ACTION_FIRE = 16
+
+# Default bindings, they can be changed with InputMapper.bind_key()
+KEY_ACTIONS = {pygame.K_LEFT: ACTION_LEFT,
+               pygame.K_RIGHT: ACTION_RIGHT,
+               pygame.K_UP: ACTION_UP,
+               pygame.K_DOWN: ACTION_DOWN,
+               pygame.K_SPACE: ACTION_FIRE}
+# keyboard of the second player, who also gets the second joypad
+KEY_ACTIONS_PLAYER2 = {pygame.K_a: ACTION_LEFT,
+                       pygame.K_d: ACTION_RIGHT,
+                       pygame.K_w: ACTION_UP,
+                       pygame.K_s: ACTION_DOWN,
+                       pygame.K_LCTRL: ACTION_FIRE}
+# axis: (action of negative values, action of positive values)
+JOY_AXIS_ACTIONS = {0: (ACTION_LEFT, ACTION_RIGHT),
+                    1: (ACTION_UP, ACTION_DOWN)}
+JOY_AXIS_DEAD_ZONE = 0.5
+JOY_PAUSE_BUTTONS = (8, 9) # any button fires, these also pause
+
+# Collision responses, used as bit flags
+RESPONSE_IGNORE = 0
+RESPONSE_DAMAGE_ALLY = 1
+RESPONSE_DAMAGE_ENEMY = 2
+RESPONSE_DAMAGE_BOTH = RESPONSE_DAMAGE_ALLY | RESPONSE_DAMAGE_ENEMY
 
 #--- Logger ---
 
@@ -51,6 +146,346 @@ log_hdlr = logging.StreamHandler(sys.stdout)
 log_hdlr.setLevel(LOGGING_LEVEL)
 logger.addHandler(log_hdlr)
 
+# Telemetry records kept in memory before being written
+TELEMETRY_BUFFER_SIZE = 512
+
+
+class TelemetryQueueHandler(logging.handlers.QueueHandler):
+    """ Queue handler that leaves the record untouched: the event is
+    serialized by the writer thread, not by the game loop """
+
+    def prepare(self, record):
+        """ Record put in the queue """
+        return record
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """ One JSON object per line, from the dictionary of the record """
+
+    def format(self, record):
+        """ Serialize the event """
+        return json.dumps(record.msg, separators=(',', ':'))
+
+
+class Telemetry(object):
+    """ Structured game events (spawns, kills, damage, boss phases, frame
+    stats) written as JSON lines. Disabled by default: call sites check
+    telemetry.enabled before building an event, so it costs nothing.
+    When enabled, emit() only puts the event in a queue; a background
+    thread buffers the records and writes them to the file. """
+
+    def __init__(self):
+        """ Constructor """
+        self.enabled = False
+        self.logger = logging.getLogger(__name__ + '.telemetry')
+        self.logger.propagate = False
+        self.logger.setLevel(logging.INFO)
+        self.listener = None
+        self.buffer_handler = None
+
+    def start(self, file_name):
+        """ Enable the telemetry, written to file_name """
+        file_handler = logging.FileHandler(file_name, mode='w')
+        file_handler.setFormatter(JsonLinesFormatter())
+        self.buffer_handler = logging.handlers.MemoryHandler(
+            TELEMETRY_BUFFER_SIZE, flushLevel=logging.CRITICAL, target=file_handler)
+        events = queue.SimpleQueue()
+        self.listener = logging.handlers.QueueListener(events, self.buffer_handler)
+        self.listener.start()
+        self.logger.addHandler(TelemetryQueueHandler(events))
+        self.enabled = True
+
+    def emit(self, event, **fields):
+        """ Record an event with the current game time """
+        fields['event'] = event
+        fields['ticks'] = game_clock.get_ticks()
+        self.logger.info(fields)
+
+    def stop(self):
+        """ Write the pending events and close the file """
+        if not self.enabled:
+            return
+        self.enabled = False
+        for handler in list(self.logger.handlers):
+            self.logger.removeHandler(handler)
+        self.listener.stop()
+        file_handler = self.buffer_handler.target
+        self.buffer_handler.close() # flushes the buffer
+        file_handler.close()
+        self.listener = None
+        self.buffer_handler = None
+
+
+
+class GameClock(object):
+    """ Clock in milliseconds used by the game logic.
+    By default it follows pygame.time.get_ticks(). With a fixed step
+    it advances only when tick() is called, i.e. once per logic update,
+    so headless runs can go faster than real time. """
+
+    def __init__(self):
+        """ Constructor """
+        self.fixed_step = None
+        self.ticks = 0.0
+        self.offset = 0
+
+    def set_fixed_step(self, step_ms):
+        """ Advance of step_ms per tick. None to follow the real time """
+        self.fixed_step = step_ms
+        self.ticks = 0.0
+        self.offset = 0
+
+    def get_ticks(self):
+        """ Milliseconds elapsed """
+        if self.fixed_step is None:
+            return pygame.time.get_ticks() + self.offset
+        return int(self.ticks)
+
+    def get_state(self):
+        """ Current time, for snapshots """
+        if self.fixed_step is None:
+            return self.get_ticks()
+        return self.ticks
+
+    def set_state(self, ticks):
+        """ Go back (or forward) to the time of a snapshot """
+        if self.fixed_step is None:
+            self.offset = ticks - pygame.time.get_ticks()
+        else:
+            self.ticks = ticks
+
+    def tick(self):
+        """ Called once per logic update """
+        if self.fixed_step is not None:
+            self.ticks += self.fixed_step
+
+    def __repr__(self):
+        """ Representation of the object """
+        return "GameClock(fixed_step={0})".format(self.fixed_step)
+
+game_clock = GameClock()
+telemetry = Telemetry()
+
+
+class Timer(object):
+    """ Timer of the TimerScheduler. The callback is called with the
+    current ticks and returns the delay in ms before the next call, or None
+    to stop. The timer_owner_id of the owner, then kind, order the timers
+    due at the same time. """
+
+    def __init__(self, callback, owner=None, kind=0):
+        """ Constructor """
+        self.callback = callback
+        self.owner = owner
+        self.kind = kind
+        self.due = None
+        self.active = False
+
+
+class TimerScheduler(object):
+    """ Timers of the game objects, in a heap ordered by due time, so each
+    logic update processes only the timers that are due instead of polling
+    every object. Cancelled or moved timers leave stale entries in the heap,
+    skipped when they are popped. """
+
+    def __init__(self):
+        """ Constructor """
+        self.heap = []
+        self.num_pushed = 0
+        self.num_owners = 0
+
+    def new_owner_id(self):
+        """ Id of a new owner of timers. Ids grow with creation order """
+        self.num_owners += 1
+        return self.num_owners
+
+    def start(self, timer, due):
+        """ (Re)schedule the timer at the given ticks """
+        timer.due = due
+        timer.active = True
+        self.num_pushed += 1
+        owner_id = 0 if timer.owner is None else timer.owner.timer_owner_id
+        heapq.heappush(self.heap, (due, owner_id, timer.kind,
+                                   self.num_pushed, timer))
+
+    def cancel(self, timer):
+        """ Stop the timer """
+        timer.active = False
+
+    def cancel_all(self):
+        """ Forget all the scheduled timers """
+        self.heap = []
+
+    def clear(self):
+        """ Forget all the timers and owners, for a new game """
+        self.cancel_all()
+        self.num_pushed = 0
+        self.num_owners = 0
+
+    def run(self, ticks_now):
+        """ Call the callbacks of the timers due at ticks_now """
+        heap = self.heap
+        while heap and heap[0][0] <= ticks_now:
+            due, _, _, _, timer = heapq.heappop(heap)
+            if not timer.active or timer.due != due:
+                continue
+            delay = timer.callback(ticks_now)
+            if delay is None:
+                timer.active = False
+            elif timer.active and timer.due == due:
+                self.start(timer, ticks_now + max(delay, 1))
+
+    def __len__(self):
+        """ Number of entries in the heap, stale ones included """
+        return len(self.heap)
+
+timers = TimerScheduler()
+
+
+class QualitySettings(object):
+    """ Optional costs of the game, lowered by the QualityGovernor
+    under load """
+
+    def __init__(self):
+        """ Constructor """
+        self.hud_interval = 1 # frames between refreshes of the HUD text
+        self.smooth_scale = False # smooth scaling of the window
+        self.pixel_perfect = False # mask collisions after the rect ones
+
+    def __repr__(self):
+        """ Representation of the object """
+        msg = "QualitySettings(hud_interval={0}, smooth_scale={1}, pixel_perfect={2})"
+        return msg.format(self.hud_interval, self.smooth_scale,
+                          self.pixel_perfect)
+
+quality = QualitySettings()
+
+
+def mixer_available():
+    """ True if the mixer has been initialized and sounds can be played """
+    return bool(pygame.mixer) and pygame.mixer.get_init() is not None
+
+
+class AudioManager(object):
+    """ Music and sound effects. Files are read and decoded once.
+    Each sound category plays on its own reserved channels: when they are
+    all busy the new sound is dropped, or it replaces the oldest one of the
+    category. Nothing is done when disabled or without mixer, e.g. in
+    headless runs. """
+
+    def __init__(self):
+        """ Constructor """
+        self.enabled = True
+        self.music_data = {}
+        self.music_stream = None # the mixer reads the music from it
+        self.sounds = {}
+        self.channels = None # category: channels, the oldest voice first
+        self.stats = collections.Counter() # (category, 'played'/'dropped'/'stolen')
+
+    def available(self):
+        """ True if sounds can be played """
+        return self.enabled and mixer_available()
+
+    def preload(self):
+        """ Read the music and decode the sounds, so that no file is read
+        during the game """
+        if not self.available():
+            return
+        for name in MUSIC_FILES:
+            self._music_data(name)
+        for name in SOUND_FILES:
+            self._sound(name)
+        self._reserve_channels()
+
+    def _music_data(self, name):
+        """ Content of a music file """
+        data = self.music_data.get(name)
+        if data is None:
+            with open(os.path.join(DATA_DIR, 'sounds', MUSIC_FILES[name]),
+                      'rb') as music_file:
+                data = music_file.read()
+            self.music_data[name] = data
+        return data
+
+    def _sound(self, name):
+        """ Decoded sound effect """
+        sound = self.sounds.get(name)
+        if sound is None:
+            file_name = os.path.join(DATA_DIR, 'sounds', SOUND_FILES[name][0])
+            sound = pygame.mixer.Sound(file_name)
+            self.sounds[name] = sound
+        return sound
+
+    def _reserve_channels(self):
+        """ Reserve the first channels of the mixer to the categories """
+        if self.channels is not None:
+            return
+        num_reserved = sum(num for num, _ in SOUND_CATEGORIES.values())
+        if pygame.mixer.get_num_channels() <= num_reserved:
+            pygame.mixer.set_num_channels(num_reserved + 1)
+        pygame.mixer.set_reserved(num_reserved)
+
+        self.channels = {}
+        channel_id = 0
+        for category in sorted(SOUND_CATEGORIES):
+            num_channels, _ = SOUND_CATEGORIES[category]
+            self.channels[category] = collections.deque(
+                pygame.mixer.Channel(channel_id + idx) for idx in range(num_channels))
+            channel_id += num_channels
+
+    def play(self, name):
+        """ Play a sound effect on a channel of its category """
+        if not self.available():
+            return
+        sound = self._sound(name)
+        category = SOUND_FILES[name][1]
+        self._reserve_channels()
+        channels = self.channels[category]
+
+        for channel in channels:
+            if not channel.get_busy():
+                break
+        else:
+            # Category saturated
+            if not SOUND_CATEGORIES[category][1]:
+                self.stats[category, 'dropped'] += 1
+                return
+            channel = channels[0]
+            self.stats[category, 'stolen'] += 1
+
+        # The channel plays the most recent voice of the category
+        channels.remove(channel)
+        channels.append(channel)
+        channel.play(sound)
+        self.stats[category, 'played'] += 1
+
+    def play_music(self, name, loops=-1):
+        """ Play the music from memory """
+        if not self.available():
+            return
+        self.music_stream = io.BytesIO(self._music_data(name))
+        namehint = os.path.splitext(MUSIC_FILES[name])[1][1:]
+        pygame.mixer.music.load(self.music_stream, namehint)
+        pygame.mixer.music.play(loops)
+
+    def stop_music(self):
+        """ Stop the music """
+        if self.available():
+            pygame.mixer.music.stop()
+
+    def pause_music(self):
+        """ Pause the music """
+        if self.available():
+            pygame.mixer.music.set_volume(0.0)
+            pygame.mixer.music.pause() # midi does not stop
+
+    def unpause_music(self):
+        """ Resume the music """
+        if self.available():
+            pygame.mixer.music.set_volume(1.0)
+            pygame.mixer.music.unpause()
+
+audio = AudioManager()
 
 
 class SpriteSheet(object):
@@ -80,6 +515,134 @@ class SpriteSheet(object):
         # Return the image
         return image
 
+class AnimationClip(object):
+    """ Sequence of images looped, each shown for frame_ms milliseconds """
+
+    def __init__(self, frames, frame_ms):
+        """ Constructor """
+        self.frames = tuple(frames)
+        self.frame_ms = frame_ms
+
+    def frame(self, elapsed_ms):
+        """ Image shown elapsed_ms after the start of the clip """
+        return self.frames[int(elapsed_ms // self.frame_ms) % len(self.frames)]
+
+
+def image_bytes(image):
+    """ Bytes of the pixels of an image, as if it had its own surface """
+    return image.get_width() * image.get_height() * image.get_bytesize()
+
+
+def surface_pool_bytes(surfaces):
+    """ Number of pixel buffers allocated for the surfaces and their bytes.
+    A subsurface uses the buffer of its parent, counted once """
+    allocated = {}
+    for surface in surfaces:
+        if surface is not None:
+            parent = surface.get_abs_parent()
+            allocated[id(parent)] = parent.get_pitch() * parent.get_height()
+    return len(allocated), sum(allocated.values())
+
+
+class AssetRegistry(object):
+    """ Images loaded once and shared by all the objects, each with a
+    name. The name is used to refer to the image in game snapshots.
+    Animation clips are also registered by name. """
+
+    def __init__(self):
+        """ Constructor """
+        self.images = {}
+        self.names = {}
+        self.clips = {}
+
+    def add(self, name, image):
+        """ Register the image with the name and return it """
+        self.images[name] = image
+        self.names[image] = name
+        return image
+
+    def get(self, name):
+        """ Image with the given name """
+        return self.images[name]
+
+    def name_of(self, image):
+        """ Name of a registered image """
+        return self.names[image]
+
+    def add_clip(self, name, frames, frame_ms):
+        """ Register an animation clip of images and return it """
+        clip = AnimationClip(frames, frame_ms)
+        self.clips[name] = clip
+        return clip
+
+    def clip(self, name):
+        """ Animation clip with the given name """
+        return self.clips[name]
+
+    def memory_report(self):
+        """ Bytes of pixels of the registered images, and the surfaces and
+        bytes actually allocated for them: a subsurface is counted with the
+        buffer of its parent """
+        separate_bytes = sum(image_bytes(image) for image in self.images.values())
+        surfaces, allocated_bytes = surface_pool_bytes(self.images.values())
+        return {'images': len(self.images),
+                'separate_bytes': separate_bytes,
+                'surfaces': surfaces,
+                'allocated_bytes': allocated_bytes}
+
+assets = AssetRegistry()
+
+
+# Collision masks of the images, computed once
+_masks = {}
+
+def collide_pixel_perfect(sprite_a, sprite_b):
+    """ True if the opaque pixels of the sprites overlap """
+    masks = []
+    for sprite in (sprite_a, sprite_b):
+        mask = _masks.get(sprite.image)
+        if mask is None:
+            mask = _masks[sprite.image] = pygame.mask.from_surface(sprite.image)
+        masks.append(mask)
+    offset = (sprite_b.rect.x - sprite_a.rect.x, sprite_b.rect.y - sprite_a.rect.y)
+    return masks[0].overlap(masks[1], offset) is not None
+
+
+def _sweep_interval(a_min, a_max, b_min, b_max, move):
+    """ Open interval of times t in [0, 1] when the segment [b_min, b_max),
+    moved by move * (t - 1), overlaps [a_min, a_max). None if never """
+    if move == 0:
+        if b_min < a_max and b_max > a_min:
+            return 0.0, 1.0
+        return None
+    time_a = (a_min - b_max) / move + 1.0
+    time_b = (a_max - b_min) / move + 1.0
+    if time_a > time_b:
+        time_a, time_b = time_b, time_a
+    return max(time_a, 0.0), min(time_b, 1.0)
+
+
+def collide_swept(sprite_a, sprite_b):
+    """ True if the rects of the sprites overlapped at any time of their
+    last move (swept AABB): fast bullets cannot pass through ships """
+    move_x = sprite_b.last_move[0] - sprite_a.last_move[0]
+    move_y = sprite_b.last_move[1] - sprite_a.last_move[1]
+    rect_a = sprite_a.rect
+    rect_b = sprite_b.rect
+    if move_x == 0 and move_y == 0:
+        return rect_a.colliderect(rect_b)
+
+    interval_x = _sweep_interval(rect_a.left, rect_a.right,
+                                 rect_b.left, rect_b.right, move_x)
+    if interval_x is None:
+        return False
+    interval_y = _sweep_interval(rect_a.top, rect_a.bottom,
+                                 rect_b.top, rect_b.bottom, move_y)
+    if interval_y is None:
+        return False
+    return max(interval_x[0], interval_y[0]) < min(interval_x[1], interval_y[1])
+
+
 class PIController(object):
     """ Class repesenting a PI controller """
 
@@ -100,12 +663,79 @@ class PIController(object):
                            -self.anti_windup)
         return control_value
 
+    def get_state(self):
+        """ Integrator value, for snapshots """
+        return self.cum_sum
+
+    def set_state(self, cum_sum):
+        """ Restore the integrator value """
+        self.cum_sum = cum_sum
+
     def __repr__(self):
         """ Representation of the object """
         msg = "PIController(kp={0}, ki={1}, anti_windup={2})"
         return msg.format(self.kp_gain, self.ki_gain, self.anti_windup)
 
 
+class Movement(object):
+    """ Position of a sprite with sub-pixel precision. The float position
+    is written in place into the sprite rect, only when its integer value
+    changes. If the rect is moved from outside, the position follows it. """
+
+    def __init__(self, rect):
+        """ Constructor. Pass the rect of the sprite """
+        self.rect = rect
+        self.x_pos = float(rect.x)
+        self.y_pos = float(rect.y)
+        self.rect_x = rect.x
+        self.rect_y = rect.y
+
+    def follow_rect(self):
+        """ Take the rect position if it has been changed from outside """
+        if self.rect.x != self.rect_x:
+            self.rect_x = self.rect.x
+            self.x_pos = float(self.rect_x)
+        if self.rect.y != self.rect_y:
+            self.rect_y = self.rect.y
+            self.y_pos = float(self.rect_y)
+
+    def move(self, x_speed, y_speed, max_x, max_y, min_y=0):
+        """ Move by the given speed, in pixel per update, keeping the
+        position within [0, max_x] and [min_y, max_y] (min_y None for no
+        limit). Then write the integer position into the rect.
+        Call follow_rect() first if the rect may have been moved. """
+        x_pos = self.x_pos + x_speed
+        if x_pos < 0:
+            x_pos = 0.0
+        elif x_pos > max_x:
+            x_pos = float(max_x)
+        y_pos = self.y_pos + y_speed
+        if min_y is not None and y_pos < min_y:
+            y_pos = float(min_y)
+        elif y_pos > max_y:
+            y_pos = float(max_y)
+        self.x_pos = x_pos
+        self.y_pos = y_pos
+
+        x_int = int(x_pos)
+        if x_int != self.rect_x:
+            self.rect.x = self.rect_x = x_int
+        y_int = int(y_pos)
+        if y_int != self.rect_y:
+            self.rect.y = self.rect_y = y_int
+
+    def get_state(self):
+        """ Float position, for snapshots """
+        self.follow_rect()
+        return (self.x_pos, self.y_pos)
+
+    def set_state(self, state):
+        """ Restore the float position, the rect is already restored """
+        self.x_pos, self.y_pos = state
+        self.rect_x = self.rect.x
+        self.rect_y = self.rect.y
+
+
 def exponential_smoothing(alpha, val, old_filt_val):
     """ Exponential smoothing """
     return alpha * val + (1.0 - alpha) * old_filt_val
@@ -123,6 +753,233 @@ def create_physical_object_dict(score_value=0, hit_points=1,
     return phy_obj
 
 
+def create_collision_response_table():
+    """ Create the table [ally category][enemy category] -> response.
+    Bullets do not hit other bullets and the immortal player
+    is not hit by anything """
+    table = [[RESPONSE_IGNORE] * NUM_CATEGORIES for _ in range(NUM_CATEGORIES)]
+    for ally_category in (CATEGORY_PLAYER, CATEGORY_PLAYER_BULLET):
+        for enemy_category in (CATEGORY_ENEMY, CATEGORY_ENEMY_BULLET):
+            if (ally_category in BULLET_CATEGORIES and
+                    enemy_category in BULLET_CATEGORIES):
+                continue
+            table[ally_category][enemy_category] = RESPONSE_DAMAGE_BOTH
+    return tuple(tuple(row) for row in table)
+
+COLLISION_RESPONSE = create_collision_response_table()
+
+
+def get_sprite_state(sprite, field_names):
+    """ Snapshot of the common sprite attributes plus the listed ones.
+    The image is saved with its name in the asset registry. """
+    fields = tuple(getattr(sprite, name) for name in field_names)
+    return (tuple(sprite.rect), dict(sprite.physical_obj),
+            assets.name_of(sprite.image), fields)
+
+
+def set_sprite_state(sprite, field_names, state):
+    """ Restore a snapshot created by get_sprite_state """
+    rect, physical_obj, image_name, fields = state
+    sprite.image = assets.get(image_name)
+    # in place, the rect may be shared with a Movement
+    sprite.rect.update(rect)
+    # updated, not copied: the keys stay the interned strings, so the
+    # snapshots of restored and new sprites serialize to the same bytes
+    sprite.physical_obj = create_physical_object_dict()
+    sprite.physical_obj.update(physical_obj)
+    for name, value in zip(field_names, fields):
+        setattr(sprite, name, value)
+
+
+class LayeredSprite(pygame.sprite.Sprite):
+    """ Sprite registered in the EntityRegistry, in the list of its
+    draw_layer, instead of pygame groups. Its image is also kept in the
+    [image, rect] draw item blitted by the layer. It can own timers of
+    the TimerScheduler. """
+
+    registry = None # set by the Game
+    draw_layer = None
+    entity_index = None # position in the registry list, None when killed
+    draw_item = None
+    timers_owned = ()
+    timer_owner_id = 0
+    clip_id = None # animation clip playing
+    clip_start = 0 # game time when it started
+    last_move = (0, 0) # displacement of the last update
+    swept_rect = None # rect covered during the last update, None if still
+
+    def play_clip(self, clip_id, ticks_now):
+        """ Start the animation clip, unless it is already playing """
+        if clip_id != self.clip_id:
+            self.clip_id = clip_id
+            self.clip_start = ticks_now
+
+    def clip_frame(self, ticks_now):
+        """ Image of the playing clip at the given game time """
+        return assets.clips[self.clip_id].frame(ticks_now - self.clip_start)
+
+    def __init__(self):
+        """ Constructor, the sprite is added to the registry.
+        PatternBullet.spawn_many does the same for a batch of bullets """
+        super().__init__()
+        self.registry.add(self)
+
+    def new_timer(self, callback):
+        """ Timer of the sprite, cancelled when the sprite is killed """
+        if not self.timers_owned:
+            self.timers_owned = []
+            self.timer_owner_id = timers.new_owner_id()
+        timer = Timer(callback, self, len(self.timers_owned))
+        self.timers_owned.append(timer)
+        return timer
+
+    def kill(self):
+        """ Remove the sprite from the registry and stop its timers """
+        for timer in self.timers_owned:
+            timers.cancel(timer)
+        if self.entity_index is not None:
+            self.registry.remove(self)
+
+    def alive(self):
+        """ True until the sprite is killed """
+        return self.entity_index is not None
+
+    @property
+    def image(self):
+        """ Image of the sprite """
+        return self._image
+
+    @image.setter
+    def image(self, image):
+        """ Set the image, also in the draw item """
+        self._image = image
+        if self.draw_item is not None:
+            self.draw_item[0] = image
+
+
+class DrawLayer(object):
+    """ Sprites drawn together with one Surface.blits call.
+    The list of draw items is updated when sprites are added or removed,
+    not rebuilt at each frame. A sprite can be in only one layer. """
+
+    def __init__(self):
+        """ Constructor """
+        self.draw_items = []
+        self.item_owners = [] # sprite of each draw item
+        self.pending = {} # added sprites, their rect is not set yet
+
+    def add(self, sprite):
+        """ Called when a sprite is added """
+        self.pending[sprite] = None
+
+    def add_many(self, sprites):
+        """ Called when a batch of sprites is added """
+        self.pending.update(dict.fromkeys(sprites))
+
+    def remove(self, sprite):
+        """ Called when a sprite is removed. The last item takes its place """
+        if sprite.draw_item is None:
+            del self.pending[sprite]
+            return
+        last_item = self.draw_items.pop()
+        last_owner = self.item_owners.pop()
+        if last_owner is not sprite:
+            self.draw_items[sprite.draw_index] = last_item
+            self.item_owners[sprite.draw_index] = last_owner
+            last_owner.draw_index = sprite.draw_index
+        sprite.draw_item = None
+
+    def commands(self):
+        """ Copy of the draw items as (image, position) pairs, ready for
+        Surface.blits and not changed by the next updates """
+        for sprite in self.pending:
+            sprite.draw_index = len(self.draw_items)
+            sprite.draw_item = [sprite.image, sprite.rect]
+            self.draw_items.append(sprite.draw_item)
+            self.item_owners.append(sprite)
+        self.pending.clear()
+        return tuple([(image, rect.topleft) for image, rect in self.draw_items])
+
+
+class EntityView(object):
+    """ Iteration over the sprites of some draw layers of the registry,
+    e.g. all the enemies. The length is the sum of the list lengths """
+
+    def __init__(self, registry, draw_layers):
+        """ Constructor """
+        self.lists = [registry.entities[layer] for layer in draw_layers]
+
+    def __iter__(self):
+        """ Iterate over the sprites, do not kill sprites meanwhile """
+        return itertools.chain.from_iterable(self.lists)
+
+    def __len__(self):
+        """ Number of sprites """
+        return sum(len(entities) for entities in self.lists)
+
+    def sprites(self):
+        """ List of the sprites """
+        return list(self)
+
+
+class EntityRegistry(object):
+    """ All the sprites of the game, in one dense list for each draw layer:
+    enemy bullets, enemies, bosses, player bullets and player.
+    Adding and removing are O(1), a removed sprite is replaced by the last
+    one of its list, and the count of a kind is the length of its list. """
+
+    def __init__(self):
+        """ Constructor """
+        self.entities = [[] for _ in range(NUM_DRAW_LAYERS)]
+        self.draw_layers = [DrawLayer() for _ in range(NUM_DRAW_LAYERS)]
+
+    def add(self, sprite):
+        """ Add the sprite to the list of its draw layer """
+        entities = self.entities[sprite.draw_layer]
+        sprite.entity_index = len(entities)
+        entities.append(sprite)
+        self.draw_layers[sprite.draw_layer].add(sprite)
+
+    def add_many(self, draw_layer, sprites):
+        """ Add a batch of sprites of the same draw layer """
+        entities = self.entities[draw_layer]
+        for index, sprite in enumerate(sprites, len(entities)):
+            sprite.entity_index = index
+        entities.extend(sprites)
+        self.draw_layers[draw_layer].add_many(sprites)
+
+    def remove(self, sprite):
+        """ Remove the sprite, the last one of the list takes its place """
+        entities = self.entities[sprite.draw_layer]
+        last = entities.pop()
+        if last is not sprite:
+            entities[sprite.entity_index] = last
+            last.entity_index = sprite.entity_index
+        sprite.entity_index = None
+        self.draw_layers[sprite.draw_layer].remove(sprite)
+
+    def count(self, draw_layer):
+        """ Number of sprites of a draw layer """
+        return len(self.entities[draw_layer])
+
+    def view(self, *draw_layers):
+        """ Iteration view over the sprites of the draw layers """
+        return EntityView(self, draw_layers)
+
+
+def draw_circle_surface(radius, center, color, width):
+    """ Create a surface with a circle in the middle"""
+    bullet_surf = pygame.Surface([2 * radius, 2 * radius])
+    pygame.draw.circle(bullet_surf, color, center, radius, width)
+    bullet_surf.set_colorkey(BLACK)
+    return bullet_surf
+
+def draw_circle(color, radius, width):
+    """ Create a surface with a circle in the middle. Shortcut"""
+    center = (radius, radius)
+    return draw_circle_surface(radius, center, color, width)
+
+
 def circular_motion():
     """ Circular motion """
     #Using generators
@@ -135,28 +992,60 @@ def circular_motion():
     return ((radius * math.cos(angle), radius * math.sin(angle))
             for angle in angles)
 
-class Whale(pygame.sprite.Sprite):
+class Whale(LayeredSprite):
     """ This class represents the player. Spaceship """
 
     images = []
-
-    def __init__(self):
-        """ Constructor """
-        super().__init__(self.containers)
-        self.physical_obj = create_physical_object_dict(hit_points=50, damage=1,
-                                                        score_value=200//50)
-
+    bullet_image_big = None
+    bullet_image_small = None
+    circle_path = ()
+    category = CATEGORY_ENEMY
+    draw_layer = LAYER_BOSS
+    patterns = {} # name: BulletPattern
+    pattern_sequence = () # names of the patterns fired in turn
+    state_fields = ('x_speed', 'y_speed', 'player_x', 'player_y',
+                    'player_x_filt', 'player_y_filt',
+                    'last_time_change_behaviour', 'behaviour', 'last_time_fire',
+                    'clip_id', 'clip_start', 'circle_index', 'alpha_exp_smoothing',
+                    'timer_owner_id', 'fire_delay', 'pattern_index',
+                    'pattern_step', 'pattern_start')
+
+    @staticmethod
+    def load_assets():
+        """ Load the images and compile the bullet patterns, once. Called
+        when the game starts, so that a bad pattern file fails there and
+        no file is read during the game """
         if not Whale.images:
             #Load images
-            sprite_sheet = SpriteSheet(os.path.join('bitmaps', 'bosses.png'))
+            sprite_sheet = SpriteSheet(os.path.join(DATA_DIR, 'bitmaps', 'bosses.png'))
             Whale.images.append(sprite_sheet.get_image(82, 359, 46, 110)) #pin left, eye right
             Whale.images.append(sprite_sheet.get_image(138, 359, 46, 110)) #pin left, eye center
             Whale.images.append(pygame.transform.flip(Whale.images[-1], True, False)) #mirror
             Whale.images.append(sprite_sheet.get_image(195, 359, 46, 110)) #pin left, eye left
             Whale.images.append(sprite_sheet.get_image(318, 359, 62, 110)) #pin right, half open mouth
             Whale.images.append(sprite_sheet.get_image(398, 358, 62, 126)) #pin left, open mouth
+            for idx, image in enumerate(Whale.images):
+                assets.add('whale_{0}'.format(idx), image)
+            assets.add_clip('whale', Whale.images, 700)
+
+            Whale.bullet_image_big = assets.add('whale_bullet_big',
+                                                draw_circle(RED_EYE, 8, 4))
+            Whale.bullet_image_small = assets.add('whale_bullet_small',
+                                                  draw_circle(RED_EYE, 4, 0))
+            Whale.circle_path = tuple(circular_motion())
+        if not Whale.pattern_sequence:
+            Whale.patterns, Whale.pattern_sequence = load_bullet_patterns(
+                os.path.join(DATA_DIR, 'patterns', 'whale.json'))
+
+    def __init__(self):
+        """ Constructor """
+        super().__init__()
+        self.physical_obj = create_physical_object_dict(hit_points=50, damage=1,
+                                                        score_value=200//50)
+        Whale.load_assets()
 
         self.rect = Whale.images[0].get_rect()
+        self.movement = Movement(self.rect)
         self.max_speed = 5
         self.x_speed = 0
         self.y_speed = 0
@@ -166,22 +1055,35 @@ class Whale(pygame.sprite.Sprite):
         self.player_x_filt = 0
         self.player_y_filt = 0
 
-        self.last_time = pygame.time.get_ticks()
-        self.interval = 700 #ms
-        self.last_time_change_behaviour = self.last_time
+        ticks_now = game_clock.get_ticks()
+        self.last_time_change_behaviour = ticks_now
         self.interval_behaviour = 10000 #ms
         self.behaviour = 0
-        self.last_time_fire = self.last_time
-        self.interval_fire = 1000
-
-        self.image_iterator = itertools.cycle(Whale.images)
-        self._circle_iterator = itertools.cycle(circular_motion())
-        self.image = next(self.image_iterator)
+        self.last_time_fire = ticks_now
+        self.interval_fire = 1000 # pause between two patterns
+        self.fire_delay = self.interval_fire
+        self.pattern_index = 0 # in the pattern sequence
+        self.pattern_step = 0
+        self.pattern_start = ticks_now
+
+        self.circle_index = 0
+        self.play_clip('whale', ticks_now)
+        self.image = self.clip_frame(ticks_now)
         self.picontrol_x = PIController(kp=0.5, ki=0.05, anti_windup=100.0)
         self.picontrol_y = PIController(kp=0.5, ki=0.05, anti_windup=100.0)
         # alpha of exponential smoothing is 3/num_it for 95% constant sig
         self.alpha_exp_smoothing = 3.0/800
 
+        self.behaviour_timer = self.new_timer(self._change_behaviour)
+        self.fire_timer = self.new_timer(self._fire)
+        self._start_timers()
+
+    def _start_timers(self):
+        """ Schedule the timers from the time of their last call """
+        timers.start(self.behaviour_timer,
+                     self.last_time_change_behaviour + self.interval_behaviour)
+        timers.start(self.fire_timer, self.last_time_fire + self.fire_delay)
+
     def set_player_position(self, x_pos, y_pos):
         """ Setter for player position for smarter actions"""
         self.player_x = x_pos
@@ -197,78 +1099,77 @@ class Whale(pygame.sprite.Sprite):
         self.player_y_filt = y_pos*alpha + (1.0 - alpha)*self.player_y_filt
 
 
-    def _fire(self):
-        """ Create bullet based on time interval"""
-        bullets = []
-
-        # Shoot if time
-        ticks_now = pygame.time.get_ticks()
-        if ticks_now - self.last_time_fire >= self.interval_fire:
-            self.last_time_fire = ticks_now
-
-            def draw_circle_surface(radius, center, color, width):
-                """ Create a surface with a circle in the middle"""
-                bullet_surf = pygame.Surface([2 * radius, 2 * radius])
-                pygame.draw.circle(bullet_surf, color, center, radius, width)
-                bullet_surf.set_colorkey(BLACK)
-                return bullet_surf
-
-            def draw_circle(color, radius, width):
-                """ Create a surface with a circle in the middle. Shortcut"""
-                center = (radius, radius)
-                return draw_circle_surface(radius, center, color, width)
-
-            # Center
-            bullet = Bullet(enemy=True, image=draw_circle(RED_EYE, 8, 4))
-            bullet.rect.x = self.rect.x + self.rect.width//2 - bullet.rect.width//2
-            bullet.rect.y = self.rect.y + self.rect.height
-            bullets.append(bullet)
-            # Left
-            bullet = Bullet(enemy=True, x_speed=-3, image=draw_circle(RED_EYE, 4, 0))
-            bullet.rect.x = self.rect.x + self.rect.width//2 - bullet.rect.width//2
-            bullet.rect.y = self.rect.y + self.rect.height
-            bullets.append(bullet)
-            # Left
-            bullet = Bullet(enemy=True, x_speed=-1, image=draw_circle(RED_EYE, 4, 0))
-            bullet.rect.x = self.rect.x + self.rect.width//2 - bullet.rect.width//2
-            bullet.rect.y = self.rect.y + self.rect.height
-            bullets.append(bullet)
-            # Right
-            bullet = Bullet(enemy=True, x_speed=+3, image=draw_circle(RED_EYE, 4, 0))
-            bullet.rect.x = self.rect.x + self.rect.width//2 - bullet.rect.width//2
-            bullet.rect.y = self.rect.y + self.rect.height
-            bullets.append(bullet)
-            # Right
-            bullet = Bullet(enemy=True, x_speed=+1, image=draw_circle(RED_EYE, 4, 0))
-            bullet.rect.x = self.rect.x + self.rect.width//2 - bullet.rect.width//2
-            bullet.rect.y = self.rect.y + self.rect.height
-            bullets.append(bullet)
-
-
-        return bullets
-
-
-
-    def update_animation(self):
-        """ Update animation """
-        # Shoot if time
-        ticks_now = pygame.time.get_ticks()
-        if ticks_now - self.last_time >= self.interval:
-            self.last_time = ticks_now
-            self.image = next(self.image_iterator)
-        if ticks_now - self.last_time_change_behaviour >= self.interval_behaviour:
-            self.last_time_change_behaviour = ticks_now
-            self.behaviour = (self.behaviour + 1) % 2
+    def _fire(self, ticks_now):
+        """ Fire timer: spawn the bullets of the next step of the current
+        pattern, from the mouth. After the last step the next pattern of
+        the sequence starts interval_fire ms later """
+        self.last_time_fire = ticks_now
+        pattern = Whale.patterns[Whale.pattern_sequence[self.pattern_index]]
+        if self.pattern_step == 0:
+            self.pattern_start = ticks_now
+
+        _, rows, aimed_rows = pattern.steps[self.pattern_step]
+        center_x = self.rect.x + self.rect.width//2
+        top = self.rect.y + self.rect.height
+        if rows:
+            PatternBullet.spawn_many(rows, center_x, top)
+        if aimed_rows:
+            angle = math.atan2(self.player_y - top, self.player_x - center_x)
+            direction = round(angle * AIM_DIRECTIONS / (2.0 * math.pi))
+            PatternBullet.spawn_many(aimed_rows[direction % AIM_DIRECTIONS],
+                                     center_x, top)
+
+        self.pattern_step += 1
+        if self.pattern_step < len(pattern.steps):
+            time_next = self.pattern_start + pattern.steps[self.pattern_step][0]
+            self.fire_delay = max(time_next - ticks_now, 1)
+        else:
+            self.pattern_step = 0
+            self.pattern_index = (self.pattern_index + 1) % len(Whale.pattern_sequence)
+            self.fire_delay = self.interval_fire
+        return self.fire_delay
+
+
+
+    def get_state(self):
+        """ Snapshot of the whale """
+        return (get_sprite_state(self, Whale.state_fields),
+                self.picontrol_x.get_state(), self.picontrol_y.get_state(),
+                self.movement.get_state())
+
+    def set_state(self, state):
+        """ Restore a snapshot of the whale """
+        sprite_state, picontrol_x, picontrol_y, movement = state
+        set_sprite_state(self, Whale.state_fields, sprite_state)
+        self.picontrol_x.set_state(picontrol_x)
+        self.picontrol_y.set_state(picontrol_y)
+        self.movement.set_state(movement)
+        self._start_timers()
+
+    def _change_behaviour(self, ticks_now):
+        """ Behaviour timer: follow the player or circle around """
+        self.last_time_change_behaviour = ticks_now
+        self.behaviour = (self.behaviour + 1) % 2
+        if telemetry.enabled:
+            telemetry.emit('boss_phase', behaviour=self.behaviour,
+                           hit_points=self.physical_obj['hit_points'])
+        return self.interval_behaviour
 
     def update(self):
         """ Update whale """
 
-        self.update_animation()
+        image = self.clip_frame(game_clock.get_ticks())
+        if image is not self.image:
+            self.image = image
+            self.rect.size = image.get_size()
 
-        enemy_center_x = self.rect.x + self.rect.width//2
-        enemy_center_y = self.rect.y + self.rect.height//2
+        movement = self.movement
+        movement.follow_rect()
+        enemy_center_x = movement.x_pos + self.rect.width/2.0
+        enemy_center_y = movement.y_pos + self.rect.height/2.0
 
-        x_circle, y_circle = next(self._circle_iterator)
+        x_circle, y_circle = Whale.circle_path[self.circle_index]
+        self.circle_index = (self.circle_index + 1) % len(Whale.circle_path)
 
         if self.behaviour == 1:
 
@@ -298,43 +1199,31 @@ class Whale(pygame.sprite.Sprite):
             self.y_speed = self.picontrol_y.control(error_y)
             self.y_speed = min(max(self.y_speed, -self.max_speed), self.max_speed)
 
-        x_pos = self.rect.x + self.x_speed
-        y_pos = self.rect.y + self.y_speed
-
-        self.rect = self.image.get_rect()
-
-        self.rect.x = x_pos
-        self.rect.y = y_pos
-
+        #Move within the boundaries
+        movement.move(self.x_speed, self.y_speed,
+                      SCREEN_WIDTH - self.rect.width,
+                      SCREEN_HEIGHT - self.rect.height, min_y=None)
 
-        #Check boundaries of the spaceship
-        if self.rect.y > SCREEN_HEIGHT - self.rect.height:
-            self.rect.y = SCREEN_HEIGHT - self.rect.height
-
-        if self.rect.x < 0:
-            self.rect.x = 0
-        elif self.rect.x > SCREEN_WIDTH - self.rect.width:
-            self.rect.x = SCREEN_WIDTH - self.rect.width
-
-        #Fire if it is time
-        self._fire()
-
-class EnemySmallSpaceship(pygame.sprite.Sprite):
+class EnemySmallSpaceship(LayeredSprite):
     """ This class represents a specific enemy. Spaceship """
 
+    category = CATEGORY_ENEMY
+    draw_layer = LAYER_ENEMIES
+    state_fields = ('x_speed', 'y_speed', 'player_x', 'player_y', 'last_time',
+                    'times_update_func_called', 'timer_owner_id')
     image_center = None
     image_left = None
     image_right = None
 
     def __init__(self):
         """ Constructor """
-        super().__init__(self.containers)
+        super().__init__()
         self.physical_obj = create_physical_object_dict(hit_points=1,
                                                         damage=1,
                                                         score_value=2)
 
         if EnemySmallSpaceship.image_center is None:
-            sprite_sheet = SpriteSheet(os.path.join('bitmaps', 'enemies.png'),
+            sprite_sheet = SpriteSheet(os.path.join(DATA_DIR, 'bitmaps', 'enemies.png'),
                                        color_key=(3, 0, 38))
             EnemySmallSpaceship.image_center = sprite_sheet.get_image(35, 95,
                                                                       16, 14)
@@ -343,6 +1232,9 @@ class EnemySmallSpaceship(pygame.sprite.Sprite):
             EnemySmallSpaceship.image_left = pygame.transform.flip(
                                              EnemySmallSpaceship.image_right,
                                              True, False)
+            assets.add('enemy_center', EnemySmallSpaceship.image_center)
+            assets.add('enemy_right', EnemySmallSpaceship.image_right)
+            assets.add('enemy_left', EnemySmallSpaceship.image_left)
 
         self.image = EnemySmallSpaceship.image_center
         self.rect = self.image.get_rect()
@@ -352,41 +1244,55 @@ class EnemySmallSpaceship(pygame.sprite.Sprite):
 
         self.player_x = 0
         self.player_y = 0
-        self.last_time = pygame.time.get_ticks()
+        self.last_time = game_clock.get_ticks()
         self.interval = 700 #ms
 
         self.rect.y = self.rect.height + 1
+        self.movement = Movement(self.rect)
 
         self.picontrol_x = PIController(kp=0.01, ki=0.01, anti_windup=100.0)
         self.picontrol_y = PIController(kp=0.01, ki=0.01, anti_windup=100.0)
         self.times_update_func_called = 0
 
+        self.fire_timer = self.new_timer(self._fire)
+        timers.start(self.fire_timer, self.last_time + self.interval)
+
     def set_player_position(self, x_pos, y_pos):
         """ Setter for player position for smarter actions"""
         self.player_x = x_pos
         self.player_y = y_pos
 
 
-    def _fire(self):
-        """ Create bullet based on time interval"""
-        bullets = []
-
-        # Shoot if time
-        ticks_now = pygame.time.get_ticks()
-        if ticks_now - self.last_time >= self.interval:
-            self.last_time = ticks_now
-            bullet = Bullet(enemy=True)
-            bullet.rect.x = self.rect.x + self.rect.width//2 - bullet.rect.width//2
-            bullet.rect.y = self.rect.y + self.rect.height
-            bullets.append(bullet)
-
-        return bullets
+    def _fire(self, ticks_now):
+        """ Fire timer: create a bullet """
+        self.last_time = ticks_now
+        bullet = Bullet(enemy=True)
+        bullet.rect.x = self.rect.x + self.rect.width//2 - bullet.rect.width//2
+        bullet.rect.y = self.rect.y + self.rect.height
+        return self.interval
+
+    def get_state(self):
+        """ Snapshot of the enemy """
+        return (get_sprite_state(self, EnemySmallSpaceship.state_fields),
+                self.picontrol_x.get_state(), self.picontrol_y.get_state(),
+                self.movement.get_state())
+
+    def set_state(self, state):
+        """ Restore a snapshot of the enemy """
+        sprite_state, picontrol_x, picontrol_y, movement = state
+        set_sprite_state(self, EnemySmallSpaceship.state_fields, sprite_state)
+        self.picontrol_x.set_state(picontrol_x)
+        self.picontrol_y.set_state(picontrol_y)
+        self.movement.set_state(movement)
+        timers.start(self.fire_timer, self.last_time + self.interval)
 
     def update(self):
         """ Update enemy ship"""
         # Move enemy spaceship
-        enemy_center_x = self.rect.x + self.rect.width//2
-        enemy_center_y = self.rect.y + self.rect.height//2
+        movement = self.movement
+        movement.follow_rect()
+        enemy_center_x = movement.x_pos + self.rect.width/2.0
+        enemy_center_y = movement.y_pos + self.rect.height/2.0
         error_x = (self.player_x - enemy_center_x)
 
         self.x_speed = self.picontrol_x.control(error_x)
@@ -404,74 +1310,58 @@ class EnemySmallSpaceship(pygame.sprite.Sprite):
 
         self.times_update_func_called = self.times_update_func_called + 1.0
 
-        x_new = self.rect.x + self.x_speed
-        y_new = self.rect.y + self.y_speed
-
         x_speed_int = int(self.x_speed)
 
         if x_speed_int > 1:
-            self.image = EnemySmallSpaceship.image_right
+            image = EnemySmallSpaceship.image_right
         elif x_speed_int < -1:
-            self.image = EnemySmallSpaceship.image_left
+            image = EnemySmallSpaceship.image_left
         else:
-            self.image = EnemySmallSpaceship.image_center
+            image = EnemySmallSpaceship.image_center
 
-        self.rect = self.image.get_rect()
-        self.rect.x = x_new
-        self.rect.y = y_new
-
-        #Check boundaries of the spaceship
-        if self.rect.y < 0:
-            self.rect.y = 0
-        elif self.rect.y > SCREEN_HEIGHT - self.rect.height:
-            self.rect.y = SCREEN_HEIGHT - self.rect.height
-
-        if self.rect.x < 0:
-            self.rect.x = 0
-        elif self.rect.x > SCREEN_WIDTH - self.rect.width:
-            self.rect.x = SCREEN_WIDTH - self.rect.width
-
-        self._fire()
-
-
-def on_keyboard_event_user1(event):
-    """ Convert keys to game event """
-
-    event_result = {'type': 'None', 'value': 'None'}
-
-    if event.type == pygame.KEYDOWN:
-        event_result['type'] = 'pressed'
-    elif event.type == pygame.KEYUP:
-        event_result['type'] = 'released'
+        if image is not self.image:
+            self.image = image
+            self.rect.size = image.get_size()
 
-    if event_result['type'] != 'None':
-        if event.key == pygame.K_LEFT:
-            event_result['value'] = 'left'
-        elif event.key == pygame.K_RIGHT:
-            event_result['value'] = 'right'
-        elif event.key == pygame.K_UP:
-            event_result['value'] = 'up'
-        elif event.key == pygame.K_DOWN:
-            event_result['value'] = 'down'
-        elif event.key == pygame.K_SPACE:
-            event_result['value'] = 'fire'
+        #Move within the boundaries
+        movement.move(self.x_speed, self.y_speed,
+                      SCREEN_WIDTH - self.rect.width,
+                      SCREEN_HEIGHT - self.rect.height)
 
-    return event_result
 
 def send_event_pause():
     """ Send event pause/start """
 
-    ev_dict = {'type': 'pause'}
+    # pygame 2 does not accept a 'type' key in the event dict
+    ev_dict = {'name': 'pause'}
     user_event = pygame.event.Event(pygame.USEREVENT, ev_dict)
     pygame.event.post(user_event)
 
     logger.debug('Pause event')
 
 
-class JoypadControl(object):
-    """ This class that handles the joypad inputs """
-
-    def __init__(self):
+class InputMapper(object):
+    """ Convert keyboard and joypad events to actions through prebuilt
+    tables. The held actions are kept as a bit mask, as well as the actions
+    pressed since the last poll(), so a press shorter than a frame is not
+    lost. One (held, pressed) pair per tick is all it takes to record the
+    input. """
+
+    def __init__(self, key_actions=None, joystick_index=0):
+        """ Constructor. By default the arrow keys and the first joypad """
+        if key_actions is None:
+            key_actions = KEY_ACTIONS
+        self.key_actions = dict(key_actions)
+        self.axis_actions = {}
+        self.button_actions = []
+        self.pause_buttons = frozenset(JOY_PAUSE_BUTTONS)
+        self.held = ACTION_NONE
+        self.pressed = ACTION_NONE
+        self.handlers = {pygame.KEYDOWN: self._on_key_down,
+                         pygame.KEYUP: self._on_key_up,
+                         pygame.JOYBUTTONDOWN: self._on_button_down,
+                         pygame.JOYBUTTONUP: self._on_button_up,
+                         pygame.JOYAXISMOTION: self._on_axis_motion}
 
         # Initialize the joysticks
         pygame.joystick.init()
@@ -482,200 +1372,248 @@ class JoypadControl(object):
         logger.debug('Number joypads connected: %d', joystick_count)
 
         self.joystick = None
+        self.joystick_id = None
 
-        if joystick_count:
-            self.joystick = pygame.joystick.Joystick(0) #first one
+        if joystick_count > joystick_index:
+            self.joystick = pygame.joystick.Joystick(joystick_index)
             self.joystick.init()
-            self.numaxes = self.joystick.get_numaxes()
-            self.numbuttons = self.joystick.get_numbuttons()
-            self.axis_lr_pressed_old = 'left'
-            self.axis_ud_pressed_old = 'up'
-
-    def on_joypad_event(self, event):
-        """ Convert joypad to game event """
-        event_result = {'type': 'None', 'value': 'None'}
-
-        if not self.joystick or self.numaxes < 2 or self.numbuttons < 10:
-            return event_result
-
-        # Possible joystick actions: JOYAXISMOTION JOYBALLMOTION JOYBUTTONDOWN
-        # JOYBUTTONUP JOYHATMOTION
-        if event.type == pygame.JOYBUTTONDOWN:
-            event_result['type'] = 'pressed'
-            event_result['value'] = 'fire'
-#            for i in range(buttons):
-#                button = joystick.get_button(i)
-#                if button:
-#                    event_result['value'] = 'fire'
-#                    break
-            if self.joystick.get_button(8) or self.joystick.get_button(9):
+            self.joystick_id = self.joystick.get_instance_id()
+            numbuttons = self.joystick.get_numbuttons()
+            # Only joypads with the expected layout are used
+            if self.joystick.get_numaxes() >= 2 and numbuttons >= 10:
+                self.axis_actions = dict(JOY_AXIS_ACTIONS)
+                self.button_actions = [ACTION_FIRE] * numbuttons
+
+    def bind_key(self, key, action):
+        """ Remap a key to an action, ACTION_NONE to unbind it """
+        self.key_actions[key] = action
+
+    def bind_button(self, button, action):
+        """ Remap a joypad button to an action """
+        if button < len(self.button_actions):
+            self.button_actions[button] = action
+
+    def process_event(self, event):
+        """ Update the actions with a pygame event """
+        handler = self.handlers.get(event.type)
+        if handler is not None:
+            handler(event)
+
+    def poll(self):
+        """ Return the held actions and the ones pressed since the last
+        call """
+        pressed = self.pressed
+        self.pressed = ACTION_NONE
+        return self.held, pressed
+
+    def _press(self, action):
+        """ Action pressed """
+        self.held |= action
+        self.pressed |= action
+
+    def _on_key_down(self, event):
+        """ Key pressed """
+        self._press(self.key_actions.get(event.key, ACTION_NONE))
+
+    def _on_key_up(self, event):
+        """ Key released """
+        self.held &= ~self.key_actions.get(event.key, ACTION_NONE)
+
+    def _on_button_down(self, event):
+        """ Joypad button pressed """
+        if event.instance_id != self.joystick_id:
+            return
+        if event.button < len(self.button_actions):
+            self._press(self.button_actions[event.button])
+            if event.button in self.pause_buttons:
                 send_event_pause()
 
-        elif event.type == pygame.JOYBUTTONUP:
-            event_result['type'] = 'released'
-            event_result['value'] = 'fire'
+    def _on_button_up(self, event):
+        """ Joypad button released """
+        if event.instance_id != self.joystick_id:
+            return
+        if event.button < len(self.button_actions):
+            self.held &= ~self.button_actions[event.button]
 
-        elif event.type == pygame.JOYAXISMOTION:
-            if event.dict['axis'] == 0:
-                if abs(event.dict['value']) < 0.5:
-                    event_result['type'] = 'released'
-                    event_result['value'] = self.axis_lr_pressed_old
-                else:
-                    event_result['type'] = 'pressed'
-                    if event.dict['value'] < 0.0:
-                        event_result['value'] = 'left'
-                    else:
-                        event_result['value'] = 'right'
-                    self.axis_lr_pressed_old = event_result['value']
-
-            if event.dict['axis'] == 1:
-                if abs(event.dict['value']) < 0.5:
-                    event_result['type'] = 'released'
-                    event_result['value'] = self.axis_ud_pressed_old
-                else:
-                    event_result['type'] = 'pressed'
-                    if event.dict['value'] < 0.0:
-                        event_result['value'] = 'up'
-                    else:
-                        event_result['value'] = 'down'
-                    self.axis_ud_pressed_old = event_result['value']
-
-        return event_result
+    def _on_axis_motion(self, event):
+        """ Joypad axis moved: press the action of its direction, release
+        both when back in the dead zone """
+        if event.instance_id != self.joystick_id:
+            return
+        actions = self.axis_actions.get(event.axis)
+        if actions is None:
+            return
+        negative, positive = actions
+        self.held &= ~(negative | positive)
+        if event.value <= -JOY_AXIS_DEAD_ZONE:
+            self._press(negative)
+        elif event.value >= JOY_AXIS_DEAD_ZONE:
+            self._press(positive)
 
 
-class Player(pygame.sprite.Sprite):
+class Player(LayeredSprite):
 
 
     """ This class represents the player. Spaceship """
-    def __init__(self):
-        super().__init__(self.containers)
+
+    spaceship_normal = None
+    spaceship_left = None
+    spaceship_right = None
+    images_center = []
+    images_reverse = []
+    bullet_image = None
+    draw_layer = LAYER_PLAYER
+    state_fields = ('x_speed_left', 'x_speed_right', 'y_speed_up',
+                    'y_speed_down', 'score', 'last_hit_points',
+                    'last_time_immortal', 'category', 'clip_id', 'clip_start',
+                    'actions')
+
+    def __init__(self, player_index=0, num_players=1):
+        """ Constructor. The players are spread on the bottom of the
+        screen """
+        super().__init__()
+        self.player_index = player_index
         self.physical_obj = create_physical_object_dict(hit_points=PLAYER_HP,
                                                         immortal=PLAYER_IMMORTAL,
                                                         damage=1)
-        sprite_sheet = SpriteSheet(os.path.join('bitmaps',
-                                                'theGuardian.png'))
-
-        self.spaceship_normal = sprite_sheet.get_image(7, 87, 23, 30)
-        self.spaceship_power1 = sprite_sheet.get_image(65, 87, 23, 30)
-        self.spaceship_power2 = sprite_sheet.get_image(95, 87, 23, 30)
-        self.spaceship_left = sprite_sheet.get_image(155, 87, 23, 30)
-        self.spaceship_right = pygame.transform.flip(self.spaceship_left,
-                                                     True, False)
-        self.iterator_spaceship_center = itertools.cycle([self.spaceship_normal,
-                                                          self.spaceship_power1,
-                                                          self.spaceship_power2])
+        if Player.spaceship_normal is None:
+            Player.load_images()
 
-        reverse_spaceship = sprite_sheet.get_image(391, 46, 25, 28) #49
-        reverse_spaceship_tilt1 = sprite_sheet.get_image(366, 46, 18, 28)
-        reverse_spaceship_tilt2 = sprite_sheet.get_image(345, 47, 14, 27)
-        reverse_spaceship_tilt1_flip = pygame.transform.flip(reverse_spaceship_tilt1,
-                                                             True, False)
-        reverse_spaceship_tilt2_flip = pygame.transform.flip(reverse_spaceship_tilt2,
-                                                             True, False)
-
-        self.iterator_spaceship_reverse = itertools.cycle([reverse_spaceship_tilt2,
-                                                           reverse_spaceship_tilt1,
-                                                           reverse_spaceship,
-                                                           reverse_spaceship_tilt2_flip,
-                                                           reverse_spaceship_tilt1_flip,
-                                                           self.spaceship_normal])
-
-        bullet_sprite_sheet = SpriteSheet(os.path.join('bitmaps',
-                                                       'bullet.png'))
-        self.bullet_image = bullet_sprite_sheet.get_image(8, 4, 7, 21)
         self.image = self.spaceship_normal
         self.rect = self.image.get_rect()
-        self.rect.x = SCREEN_WIDTH//2 - self.rect.width//2
+        center_x = SCREEN_WIDTH * (2 * player_index + 1) // (2 * num_players)
+        self.rect.x = center_x - self.rect.width//2
         self.rect.y = SCREEN_HEIGHT - self.rect.height//2
         self.x_speed_left = 0
         self.x_speed_right = 0
         self.y_speed_up = 0
         self.y_speed_down = 0
 
-        #http://programarcadegames.com/index.php?
-        #chapter=bitmapped_graphics_and_sound
-        if pygame.mixer:
-            self.fire_sound = pygame.mixer.Sound(os.path.join('sounds',
-                                                              'laser5.ogg'))
-            self.collision_sound = pygame.mixer.Sound(os.path.join('sounds',
-                                                              '27826_erdie_sword01_short.ogg'))
         self.score = 0
         self.last_hit_points = self.physical_obj['hit_points']
-        self.last_time_immortal = pygame.time.get_ticks()
+        self.last_time_immortal = game_clock.get_ticks()
         self.immortality_interval = 800
         self.immortality_always = PLAYER_IMMORTAL
-        self.iteration = 0
+        self.category = CATEGORY_PLAYER
+        if self.immortality_always:
+            self.category = CATEGORY_PLAYER_IMMORTAL
+        self.play_clip('player_center', game_clock.get_ticks())
+        self.immortality_timer = self.new_timer(self._end_immortality)
+        self.actions = ACTION_NONE # held at the last apply_actions()
+
+    @staticmethod
+    def load_images():
+        """ Load the images shared by all the players """
+        sprite_sheet = SpriteSheet(os.path.join(DATA_DIR, 'bitmaps',
+                                                'theGuardian.png'))
 
-        self.reloading = False
+        Player.spaceship_normal = sprite_sheet.get_image(7, 87, 23, 30)
+        spaceship_power1 = sprite_sheet.get_image(65, 87, 23, 30)
+        spaceship_power2 = sprite_sheet.get_image(95, 87, 23, 30)
+        Player.spaceship_left = sprite_sheet.get_image(155, 87, 23, 30)
+        Player.spaceship_right = pygame.transform.flip(Player.spaceship_left,
+                                                       True, False)
+        Player.images_center = [Player.spaceship_normal,
+                                spaceship_power1,
+                                spaceship_power2]
 
-        self.joypad = JoypadControl()
+        reverse_spaceship = sprite_sheet.get_image(391, 46, 25, 28) #49
+        reverse_spaceship_tilt1 = sprite_sheet.get_image(366, 46, 18, 28)
+        reverse_spaceship_tilt2 = sprite_sheet.get_image(345, 47, 14, 27)
+        reverse_spaceship_tilt1_flip = pygame.transform.flip(reverse_spaceship_tilt1,
+                                                             True, False)
+        reverse_spaceship_tilt2_flip = pygame.transform.flip(reverse_spaceship_tilt2,
+                                                             True, False)
+
+        Player.images_reverse = [reverse_spaceship_tilt2,
+                                 reverse_spaceship_tilt1,
+                                 reverse_spaceship,
+                                 reverse_spaceship_tilt2_flip,
+                                 reverse_spaceship_tilt1_flip,
+                                 Player.spaceship_normal]
+
+        bullet_sprite_sheet = SpriteSheet(os.path.join(DATA_DIR, 'bitmaps',
+                                                       'bullet.png'))
+        Player.bullet_image = bullet_sprite_sheet.get_image(8, 4, 7, 21)
+
+        assets.add('player_left', Player.spaceship_left)
+        assets.add('player_right', Player.spaceship_right)
+        for idx, image in enumerate(Player.images_center):
+            assets.add('player_center_{0}'.format(idx), image)
+        # the last one is spaceship_normal, already registered
+        for idx, image in enumerate(Player.images_reverse[:-1]):
+            assets.add('player_reverse_{0}'.format(idx), image)
+
+        # Frame durations of 3 and 5 logic updates
+        assets.add_clip('player_center', Player.images_center, 3000.0 / FPS)
+        assets.add_clip('player_reverse', Player.images_reverse, 5000.0 / FPS)
+        assets.add_clip('player_left', [Player.spaceship_left], 1000)
+        assets.add_clip('player_right', [Player.spaceship_right], 1000)
+        assets.add('player_bullet', Player.bullet_image)
 
     def _fire(self):
         """ Generate a bullet. """
         bullet = BulletPlayer(image=self.bullet_image)
+        bullet.player_index = self.player_index
 
         bullet.rect.x = self.rect.x + self.rect.width//2 - bullet.rect.width//2
         bullet.rect.y = self.rect.y
-        if pygame.mixer:
-            self.fire_sound.play()
+        #http://programarcadegames.com/index.php?
+        #chapter=bitmapped_graphics_and_sound
+        audio.play('fire')
 
         return bullet
 
-    def process_event(self, event):
-        """ Update the player location. """
-
-        #Select player action to apply in next update step
-
-        game_event = on_keyboard_event_user1(event)
-
-        if game_event['type'] == 'None' or game_event['value'] == 'None':
-            game_event = self.joypad.on_joypad_event(event)
-            if game_event['type'] == 'None' or game_event['value'] == 'None':
-                return None
-
-        firing = False
-
-        if game_event['type'] == 'pressed':
-            # Figure out if it was an arrow key. If so
-            # adjust speed.
-            if game_event['value'] == 'left':
-                self.x_speed_left = -3
-            elif game_event['value'] == 'right':
-                self.x_speed_right = 3
-            elif game_event['value'] == 'up':
-                self.y_speed_up = -3
-            elif game_event['value'] == 'down':
-                self.y_speed_down = 3
-            elif game_event['value'] == 'fire':
-                num_bullet_and_player = min(len(group) for group in
-                                            BulletPlayer.containers)
-                if  num_bullet_and_player < MAX_NUM_BULLET_AND_PLAYER:
-                    self._fire()
-
-        # User let up on a key
-        elif game_event['type'] == 'released':
-                # If it is an arrow key, reset vector back to zero
-            if game_event['value'] == 'left':
-                self.x_speed_left = 0
-            elif game_event['value'] == 'right':
-                self.x_speed_right = 0
-            elif game_event['value'] == 'up':
-                self.y_speed_up = 0
-            elif game_event['value'] == 'down':
-                self.y_speed_down = 0
-        #pos = pygame.mouse.get_pos()
-
-        self.reloading = firing
-
-        #logging.debug('new pos ', self.rect.x, ' ', self.rect.y)
-        return None
+    def apply_actions(self, held, pressed=None):
+        """ Select the player actions of the next update step from the bit
+        mask of held actions. A bullet is fired when fire gets pressed,
+        by default when it was not held at the previous call. """
+        if pressed is None:
+            pressed = held & ~self.actions
+
+        self.x_speed_left = -3 if held & ACTION_LEFT else 0
+        self.x_speed_right = 3 if held & ACTION_RIGHT else 0
+        self.y_speed_up = -3 if held & ACTION_UP else 0
+        self.y_speed_down = 3 if held & ACTION_DOWN else 0
+
+        if pressed & ACTION_FIRE:
+            num_players = self.registry.count(LAYER_PLAYER)
+            num_bullet_and_player = (self.registry.count(LAYER_PLAYER_BULLETS) +
+                                     num_players)
+            if  num_bullet_and_player < MAX_NUM_BULLET_AND_PLAYER * num_players:
+                self._fire()
+
+        self.actions = held
+
+    def get_state(self):
+        """ Snapshot of the player """
+        return get_sprite_state(self, Player.state_fields)
+
+    def set_state(self, state):
+        """ Restore a snapshot of the player """
+        set_sprite_state(self, Player.state_fields, state)
+        if self.physical_obj['immortal'] and not self.immortality_always:
+            timers.start(self.immortality_timer,
+                         self.last_time_immortal + self.immortality_interval)
+        else:
+            timers.cancel(self.immortality_timer)
 
     def _set_temporary_immortality(self):
         """ Make immortal after one damage is received """
 
         self.physical_obj['immortal'] = True
         self.physical_obj['damage'] = 0.0
-        self.last_time_immortal = pygame.time.get_ticks()
+        self.category = CATEGORY_PLAYER_IMMORTAL
+        self.last_time_immortal = game_clock.get_ticks()
+        timers.start(self.immortality_timer,
+                     self.last_time_immortal + self.immortality_interval)
+
+    def _end_immortality(self, ticks_now):
+        """ Immortality timer: remove immortality when time expired """
+        del ticks_now
+        if not self.immortality_always:
+            self.physical_obj['immortal'] = False
+            self.category = CATEGORY_PLAYER
 
 
     def update(self):
@@ -698,12 +1636,6 @@ class Player(pygame.sprite.Sprite):
         elif self.rect.x > SCREEN_WIDTH - self.rect.width:
             self.rect.x = SCREEN_WIDTH - self.rect.width
 
-        # remove immortality if time expired
-        if self.physical_obj['immortal'] and not self.immortality_always:
-            ticks_now = pygame.time.get_ticks()
-            if ticks_now - self.last_time_immortal >= self.immortality_interval:
-                self.physical_obj['immortal'] = False
-
         #check if damage received, if so make it immortal for a period of time
         if self.last_hit_points > self.physical_obj['hit_points']:
             self._set_temporary_immortality()
@@ -711,29 +1643,38 @@ class Player(pygame.sprite.Sprite):
         self.last_hit_points = self.physical_obj['hit_points']
 
 
-        #change the image accordingly
+        #change the animation accordingly
+        ticks_now = game_clock.get_ticks()
         if self.physical_obj['immortal'] and not self.immortality_always:
-            if self.iteration % 5 == 0:
-                self.image = next(self.iterator_spaceship_reverse)
+            self.play_clip('player_reverse', ticks_now)
+        elif x_speed < 0:
+            self.play_clip('player_left', ticks_now)
+        elif x_speed > 0:
+            self.play_clip('player_right', ticks_now)
         else:
-            if x_speed < 0 and self.image != self.spaceship_left:
-                self.image = self.spaceship_left
-            elif x_speed > 0 and self.image != self.spaceship_right:
-                self.image = self.spaceship_right
-            elif x_speed == 0 and self.iteration % 3 == 0:
-                self.image = next(self.iterator_spaceship_center)
+            self.play_clip('player_center', ticks_now)
 
-        self.iteration += 1
+        image = self.clip_frame(ticks_now)
+        if image is not self.image:
+            self.image = image
 
-class Bullet(pygame.sprite.Sprite):
+class Bullet(LayeredSprite):
     """ This class represents the bullet . """
 
     image_default = None
+    category = CATEGORY_ENEMY_BULLET
+    draw_layer = LAYER_ENEMY_BULLETS
+    state_fields = ('x_speed', 'y_speed', 'enemy')
 
     def __init__(self, x_speed=0, y_speed=3, enemy=False, image=None):
         # Call the parent class (Sprite) constructor
-        super().__init__(self.containers)
+        super().__init__()
+        self._init_fields(x_speed, y_speed, enemy, image)
 
+    def _init_fields(self, x_speed, y_speed, enemy, image):
+        """ Set the attributes of a new bullet. Called by the constructor
+        and by PatternBullet.spawn_many, which skips the constructors:
+        the attributes of the bullets go here """
         self.physical_obj = create_physical_object_dict(damage=1)
         self.x_speed = x_speed
         self.y_speed = y_speed
@@ -741,6 +1682,7 @@ class Bullet(pygame.sprite.Sprite):
         if not Bullet.image_default:
             Bullet.image_default = pygame.Surface([4, 10])
             Bullet.image_default.fill(WHITE)
+            assets.add('bullet_default', Bullet.image_default)
 
         if image:
             self.image = image
@@ -751,13 +1693,24 @@ class Bullet(pygame.sprite.Sprite):
 
         self.damage = 1
 
+    def get_state(self):
+        """ Snapshot of the bullet """
+        return get_sprite_state(self, self.state_fields)
+
+    def set_state(self, state):
+        """ Restore a snapshot of the bullet """
+        set_sprite_state(self, self.state_fields, state)
+
     def update(self):
         """ Move the bullet. """
+        swept_rect = self.rect.copy()
         if self.enemy is True:
+            self.last_move = (self.x_speed, self.y_speed)
             self.rect.y += self.y_speed
             if self.rect.y >= SCREEN_HEIGHT:
                 self.physical_obj['hit_points'] = 0 #dead
         else:
+            self.last_move = (self.x_speed, -self.y_speed)
             self.rect.y -= self.y_speed
             if self.rect.y <= self.rect.height:
                 self.physical_obj['hit_points'] = 0 #dead
@@ -766,11 +1719,255 @@ class Bullet(pygame.sprite.Sprite):
         if self.rect.x <= self.rect.width or self.rect.x >= SCREEN_WIDTH:
             self.physical_obj['hit_points'] = 0 #dead
 
+        swept_rect.union_ip(self.rect)
+        self.swept_rect = swept_rect
+
 class BulletPlayer(Bullet):
     """ Placeholder to write less code thanks to container """
 
+    category = CATEGORY_PLAYER_BULLET
+    draw_layer = LAYER_PLAYER_BULLETS
+    state_fields = Bullet.state_fields + ('player_index',)
+
     def __init__(self, x_speed=0, y_speed=3, enemy=False, image=None):
         super().__init__(x_speed, y_speed, enemy, image)
+        self.player_index = 0 # the score of the hits goes to this player
+
+
+class PatternBullet(Bullet):
+    """ Enemy bullet of the bullet patterns. The position is kept with
+    sub-pixel precision, so it can go in any direction at any speed.
+    Patterns spawn them in batches with spawn_many(). """
+
+    state_fields = Bullet.state_fields + ('x_pos', 'y_pos')
+
+    def __init__(self, x_speed=0, y_speed=3, enemy=True, image=None):
+        super().__init__(x_speed, y_speed, enemy, image)
+
+    def _init_fields(self, x_speed, y_speed, enemy, image):
+        """ Set the attributes of a new bullet """
+        super()._init_fields(x_speed, y_speed, enemy, image)
+        self.x_pos = float(self.rect.x)
+        self.y_pos = float(self.rect.y)
+
+    def move_to(self, x_pos, y_pos):
+        """ Place the bullet """
+        self.rect.topleft = (x_pos, y_pos)
+        self.x_pos = float(x_pos)
+        self.y_pos = float(y_pos)
+
+    @classmethod
+    def spawn_many(cls, rows, center_x, top):
+        """ Create the bullets of rows (image, x speed, y speed) of a
+        compiled pattern, centered on center_x with the top at top. As in
+        LayeredSprite.__init__ but for the whole batch, the bullets are
+        added to the registry in one call """
+        init_sprite = pygame.sprite.Sprite.__init__
+        new_bullet = cls.__new__
+        bullets = []
+        for image, x_speed, y_speed in rows:
+            bullet = new_bullet(cls)
+            init_sprite(bullet)
+            bullet._init_fields(x_speed, y_speed, True, image)
+            bullet.move_to(center_x - bullet.rect.width//2, top)
+            bullets.append(bullet)
+        cls.registry.add_many(cls.draw_layer, bullets)
+
+    def update(self):
+        """ Move the bullet, it dies out of the screen """
+        swept_rect = self.rect.copy()
+        self.x_pos += self.x_speed
+        self.y_pos += self.y_speed
+        self.rect.x = int(self.x_pos)
+        self.rect.y = int(self.y_pos)
+        self.last_move = (self.rect.x - swept_rect.x, self.rect.y - swept_rect.y)
+
+        if (self.rect.y >= SCREEN_HEIGHT or self.rect.bottom <= 0 or
+                self.rect.x <= self.rect.width or self.rect.x >= SCREEN_WIDTH):
+            self.physical_obj['hit_points'] = 0 #dead
+
+        swept_rect.union_ip(self.rect)
+        self.swept_rect = swept_rect
+
+
+#--- Bullet patterns ---
+# A pattern is a list of elements, e.g.
+#   {"shape": "spread", "count": 5, "width": 60, "speed": 2.5, "repeat": 3}
+# shape: "bullets" (list of "velocities" [x, y]), "ring", "spread" around
+# "angle", "aimed" (spread around the direction of the player) or
+# "spiral" ("count" bullets on "arms" arms turning by "turn" degrees).
+# Optional: "image" (asset name), "speed" (pixels per tick), "delay",
+# "repeat", "interval" (ticks), "rotate" (degrees per repeat) and
+# "speed_step" (speed added per repeat).
+# Angles are in degrees, 0 is right and 90 down.
+PATTERN_SHAPES = ('bullets', 'ring', 'spread', 'aimed', 'spiral')
+AIM_DIRECTIONS = 64 # aimed elements are compiled for these directions
+PATTERN_COUNT_KEYS = ('count', 'arms', 'repeat') # positive integers
+PATTERN_TICK_KEYS = ('delay', 'interval') # integers >= 0
+PATTERN_NUMBER_KEYS = ('speed', 'speed_step', 'width', 'angle', 'rotate', 'turn')
+
+# steps: (time in ms from the start, rows (image, x speed, y speed),
+# rows of each aim direction or None) for each tick with bullets
+BulletPattern = collections.namedtuple('BulletPattern', ('steps', 'duration_ms'))
+
+
+def _pattern_angles(shape, element, count):
+    """ Directions in degrees of the bullets of one repeat of an element """
+    if shape == 'ring':
+        start = element.get('angle', 90.0)
+        return [start + 360.0 * index / count for index in range(count)]
+    # spread, around the direction of the player if aimed
+    center = 0.0 if shape == 'aimed' else element.get('angle', 90.0)
+    width = element.get('width', 0.0)
+    if count == 1:
+        return [center]
+    return [center - width / 2.0 + width * index / (count - 1)
+            for index in range(count)]
+
+
+def _velocity_rows(image, speed, angles):
+    """ Spawn table rows of bullets going in the given directions """
+    return [(image, speed * math.cos(math.radians(angle)),
+             speed * math.sin(math.radians(angle))) for angle in angles]
+
+
+def compile_bullet_pattern(elements, fps=FPS):
+    """ Compile the elements of a pattern into a BulletPattern: the rows of
+    the bullets spawned at each tick, with their velocities computed
+    ahead of time. Aimed elements get a set of rows for each direction """
+    fixed = collections.defaultdict(list)
+    aimed = {}
+    for element in elements:
+        shape = element['shape']
+        image = assets.get(element.get('image', 'whale_bullet_small'))
+        speed = element.get('speed', 3.0)
+        speed_step = element.get('speed_step', 0.0)
+        count = element.get('count', 1)
+        repeat = element.get('repeat', 1)
+        rotate = element.get('rotate', 0.0)
+        if shape == 'spiral':
+            # a ring of one bullet per arm, turning at each repeat
+            arms = element.get('arms', 1)
+            shape, count = 'ring', arms
+            repeat = -(-element.get('count', arms) // arms)
+            rotate = element.get('turn', 10.0)
+
+        for index in range(repeat):
+            tick = element.get('delay', 0) + index * element.get('interval', 1)
+            if shape == 'bullets':
+                fixed[tick].extend((image, x_speed, y_speed)
+                                   for x_speed, y_speed in element['velocities'])
+                continue
+            angles = [angle + index * rotate
+                      for angle in _pattern_angles(shape, element, count)]
+            repeat_speed = speed + index * speed_step
+            if shape != 'aimed':
+                fixed[tick].extend(_velocity_rows(image, repeat_speed, angles))
+                continue
+            directions = aimed.setdefault(tick, [[] for _ in range(AIM_DIRECTIONS)])
+            for direction, rows in enumerate(directions):
+                aim = 360.0 * direction / AIM_DIRECTIONS
+                rows.extend(_velocity_rows(image, repeat_speed,
+                                           [aim + angle for angle in angles]))
+
+    steps = []
+    for tick in sorted(set(fixed) | set(aimed)):
+        aimed_rows = None
+        if tick in aimed:
+            aimed_rows = tuple(tuple(rows) for rows in aimed[tick])
+        # rounded down, so the fire timer is never a tick late
+        steps.append((int(tick * 1000.0 / fps), tuple(fixed.get(tick, ())),
+                      aimed_rows))
+    return BulletPattern(tuple(steps), steps[-1][0] if steps else 0)
+
+
+def _is_number(value):
+    """ True for a finite int or float, not a bool """
+    return (isinstance(value, (int, float)) and not isinstance(value, bool) and
+            math.isfinite(value))
+
+
+def check_bullet_pattern(elements):
+    """ Raise ValueError if the elements of a pattern are not valid """
+    if not isinstance(elements, list):
+        raise ValueError('a pattern is a list of elements')
+    for element in elements:
+        if not isinstance(element, dict):
+            raise ValueError('a pattern element is an object')
+        shape = element.get('shape')
+        if shape not in PATTERN_SHAPES:
+            raise ValueError('unknown shape {0!r}'.format(shape))
+        image = element.get('image', 'whale_bullet_small')
+        if image not in assets.images:
+            raise ValueError('unknown image {0!r}'.format(image))
+        for key in PATTERN_COUNT_KEYS:
+            value = element.get(key, 1)
+            if not (_is_number(value) and isinstance(value, int) and value > 0):
+                raise ValueError('"{0}" must be a positive integer'.format(key))
+        for key in PATTERN_TICK_KEYS:
+            value = element.get(key, 0)
+            if not (_is_number(value) and isinstance(value, int) and value >= 0):
+                raise ValueError('"{0}" must be a number of ticks >= 0'.format(key))
+        for key in PATTERN_NUMBER_KEYS:
+            if key in element and not _is_number(element[key]):
+                raise ValueError('"{0}" must be a number'.format(key))
+        if shape == 'bullets':
+            velocities = element.get('velocities')
+            if (not isinstance(velocities, list) or
+                    not all(isinstance(velocity, list) and len(velocity) == 2 and
+                            all(_is_number(speed) for speed in velocity)
+                            for velocity in velocities)):
+                raise ValueError('"bullets" needs "velocities", a list of [x, y]')
+
+
+def load_bullet_patterns(file_name):
+    """ Read and compile the patterns of a JSON file
+    {"sequence": [names], "patterns": {name: [elements]}}.
+    Return the patterns by name and the sequence. Raise ValueError if
+    a pattern is not valid or fires no bullets """
+    with open(file_name) as json_file:
+        data = json.load(json_file)
+    patterns = {}
+    for name, elements in data['patterns'].items():
+        try:
+            check_bullet_pattern(elements)
+        except ValueError as error:
+            raise ValueError('bullet pattern {0!r} in {1}: {2}'.format(
+                name, file_name, error))
+        patterns[name] = compile_bullet_pattern(elements)
+        if not patterns[name].steps:
+            raise ValueError('bullet pattern {0!r} in {1} fires no bullets'.format(
+                name, file_name))
+    sequence = tuple(data['sequence'])
+    if not sequence:
+        raise ValueError('empty bullet pattern sequence in ' + file_name)
+    for name in sequence:
+        if name not in patterns:
+            raise ValueError('unknown bullet pattern {0!r} in {1}'.format(
+                name, file_name))
+    return patterns, sequence
+
+
+# Classes of the objects saved in game snapshots
+ENTITY_CLASSES = {cls.__name__: cls for cls in (Whale, EnemySmallSpaceship,
+                                                Bullet, BulletPlayer,
+                                                PatternBullet)}
+
+
+def dump_state(state):
+    """ Serialize a game snapshot to bytes. Without the memo, equal
+    states give the same bytes whether or not they share objects, e.g.
+    after a restore (snapshots have no reference cycles) """
+    data = io.BytesIO()
+    pickler = pickle.Pickler(data, pickle.HIGHEST_PROTOCOL)
+    pickler.fast = True
+    pickler.dump(state)
+    return data.getvalue()
+
+
+def load_state(data):
+    """ Deserialize a game snapshot """
+    return pickle.loads(data)
 
 
 def print_text_on_surface(font, str_list, surface, center, offset_line):
@@ -789,22 +1986,20 @@ class StartScreen(object):
     image_eye = None
 
     def __init__(self):
-        sprite_sheet = SpriteSheet(os.path.join('bitmaps', 'originalStartup.png'),
+        sprite_sheet = SpriteSheet(os.path.join(DATA_DIR, 'bitmaps', 'originalStartup.png'),
                                    color_key=BLACK)
         StartScreen.image_eye = sprite_sheet.get_image(80, 0, 96, 88)
 
-        self.font_title = pygame.font.Font(os.path.join('fonts', 'PressStart2P.ttf'),
+        self.font_title = pygame.font.Font(os.path.join(DATA_DIR, 'fonts', 'PressStart2P.ttf'),
                                            12)
 
-        self.font = pygame.font.Font(os.path.join('fonts', 'PressStart2P.ttf'),
+        self.font = pygame.font.Font(os.path.join(DATA_DIR, 'fonts', 'PressStart2P.ttf'),
                                      8)
 
     def play_music(self):
         """ Start start screen theme """
-        if pygame.mixer:
         # http://www.khinsider.com/midi/nes/guardian-legend
-            pygame.mixer.music.load(os.path.join('sounds', 'title.mid'))
-            pygame.mixer.music.play(-1)
+        audio.play_music('title')
 
 
     def draw(self, surface):
@@ -835,6 +2030,13 @@ def add_whale():
     return enemy
 
 
+# What is drawn for a tick: flags of the screen to show, map center,
+# (image, position) pairs of each draw layer and HUD values
+RenderFrame = collections.namedtuple('RenderFrame', (
+    'start_screen', 'game_over', 'pause', 'center_map', 'layers', 'score',
+    'max_score', 'fps', 'hit_points', 'kills_per_s', 'time_input'))
+
+
 class Game(object):
     """ This class represents an instance of the game. If we need to
         reset the game we'd just need to create a new instance of this
@@ -847,10 +2049,22 @@ class Game(object):
     # variables for resize
     size_fixed = [SCREEN_WIDTH, SCREEN_HEIGHT]
     center_image_resize = (0, 0)
+    memory_overlay = () # lines of text set by the MemoryMonitor
+    show_memory_overlay = True
+
+    # attributes saved in snapshots
+    state_fields = ('start_screen', 'game_over', 'pause',
+                    'game_over_music_enabled', 'last_time_enemy_killed',
+                    'milliseconds_per_kill', 'interval_spawn_enemy',
+                    'kill_rate_smoothing', 'boss_probability', 'enemies_killed',
+                    'bosses_spawned', 'last_time_spawn_enemy', 'max_score')
 
     # --- Class methods
     # Set up the game
-    def __init__(self):
+    def __init__(self, num_players=1):
+        # Timers of the previous game are forgotten
+        timers.clear()
+        self.num_players = num_players
         self.score = 0
         self.start_screen = True
         self.start_screen_obj = StartScreen()
@@ -858,42 +2072,72 @@ class Game(object):
         self.pause = False
         self.game_over_music_enabled = False
         self.fps = 0.0
-        self.font = pygame.font.Font(os.path.join('fonts', 'PressStart2P.ttf'),
+        self.font = pygame.font.Font(os.path.join(DATA_DIR, 'fonts', 'PressStart2P.ttf'),
                                      8)
-
-        self.all_sprites_list = pygame.sprite.Group()
-        self.player_object_list = pygame.sprite.Group()
+        # HUD text surfaces, rendered again only when the text changes
+        self.hud_cache = {}
+        self.frames_drawn = 0
+
+        # The second player has its own keys and the second joypad
+        self.input_mappers = [InputMapper()]
+        if num_players > 1:
+            self.input_mappers.append(InputMapper(KEY_ACTIONS_PLAYER2, 1))
+
+        self.entity_registry = EntityRegistry()
+        LayeredSprite.registry = self.entity_registry
+
+        # Views over the registry
+        self.all_sprites_list = self.entity_registry.view(
+            LAYER_PLAYER, LAYER_PLAYER_BULLETS, LAYER_ENEMIES, LAYER_BOSS,
+            LAYER_ENEMY_BULLETS)
+        self.player_object_list = self.entity_registry.view(LAYER_PLAYER,
+                                                            LAYER_PLAYER_BULLETS)
         #it contains all enemy sprites including bullets
-        self.enemy_object_list = pygame.sprite.Group()
+        self.enemy_object_list = self.entity_registry.view(LAYER_ENEMIES, LAYER_BOSS,
+                                                           LAYER_ENEMY_BULLETS)
         #it contains only ships and monsters
-        self.enemy_list = pygame.sprite.Group()
-
-        Player.containers = self.all_sprites_list, self.player_object_list
-        EnemySmallSpaceship.containers = self.all_sprites_list, self.enemy_object_list, self.enemy_list
-        Whale.containers = self.all_sprites_list, self.enemy_object_list, self.enemy_list
-        Bullet.containers = self.all_sprites_list, self.enemy_object_list
-        BulletPlayer.containers = self.all_sprites_list, self.player_object_list
+        self.enemy_list = self.entity_registry.view(LAYER_ENEMIES, LAYER_BOSS)
+
+        # Sprites to test against for each ally category, None when
+        # nothing can be hit. Bullets are checked only against ships.
+        self.collision_candidates = {}
+        for category, row in enumerate(COLLISION_RESPONSE):
+            if not any(row):
+                self.collision_candidates[category] = None
+            elif row[CATEGORY_ENEMY_BULLET] == RESPONSE_IGNORE:
+                self.collision_candidates[category] = self.enemy_list
+            else:
+                self.collision_candidates[category] = self.enemy_object_list
 
-        self.last_time_enemy_killed = pygame.time.get_ticks()
+        self.last_time_enemy_killed = game_clock.get_ticks()
         self.milliseconds_per_kill = 1500
 
 
 
-        # Create the player
-        self.player = Player()
+        # Create the players, the first one is also self.player
+        self.players = [Player(index, num_players) for index in range(num_players)]
+        self.player = self.players[0]
 
-        self.interval_spawn_enemy = 1500
-        self.last_time_spawn_enemy = pygame.time.get_ticks()
+        self.interval_spawn_enemy = INTERVAL_SPAWN_ENEMY
+        self.kill_rate_smoothing = KILL_RATE_SMOOTHING
+        self.boss_probability = BOSS_PROBABILITY
+        self.enemies_killed = 0
+        self.bosses_spawned = 0
+        self.last_time_spawn_enemy = game_clock.get_ticks()
+        self.spawn_timer = Timer(self.spawn_enemy)
+        self.schedule_spawn()
 
         self.max_score = 0
 
         # Test boss
         #add_whale()
+        # its bullet patterns are compiled now, not when it first appears
+        Whale.load_assets()
 
         self.start_screen_obj.play_music()
 
         # Load TMX data
-        tmx_data = load_pygame(os.path.join('maps', 'mapcorridor.tmx'))
+        tmx_data = load_pygame(os.path.join(DATA_DIR, 'maps', 'mapcorridor.tmx'))
 
         # Make data source for the map
         map_data = pyscroll.TiledMapData(tmx_data)
@@ -905,35 +2149,132 @@ class Game(object):
         self.center_map = [self.map_layer.map_rect.width//2,
                            self.map_layer.map_rect.height - SCREEN_HEIGHT//2]
 
-    def spawn_enemy(self):
-        """ Spawn new enemy based on time interval. """
-        ticks_now = pygame.time.get_ticks()
+    def spawn_interval(self):
+        """ Milliseconds between spawns, shorter when enemies are killed
+        faster """
         max_interval = max(self.milliseconds_per_kill * 0.80,
                            self.interval_spawn_enemy / 2.0)
-        max_interval = min(max_interval, self.interval_spawn_enemy * 1.5)
-
-        if ticks_now - self.last_time_spawn_enemy >= max_interval:
-            self.last_time_spawn_enemy = ticks_now
-            # The boss can be spawn only when score is high
-            if self.player.score < 50:
-                add_enemy()
-            elif random.random() < 0.95:
-                add_enemy()
-            else:
-                add_whale()
-                # Slow down spawn of monster for some time
-                slow_down_time = 60*1000 # 1 min
-                self.last_time_spawn_enemy = ticks_now + slow_down_time
+        return min(max_interval, self.interval_spawn_enemy * 1.5)
+
+    def schedule_spawn(self):
+        """ Schedule the spawn timer again, to be called when the kill rate
+        or the difficulty parameters change """
+        timers.start(self.spawn_timer,
+                     self.last_time_spawn_enemy + self.spawn_interval())
+
+    def spawn_enemy(self, ticks_now):
+        """ Spawn timer: spawn new enemy. """
+        self.last_time_spawn_enemy = ticks_now
+        # The boss can be spawn only when score is high
+        if self.total_score() < BOSS_MIN_SCORE:
+            enemy = add_enemy()
+        elif random.random() < 1.0 - self.boss_probability:
+            enemy = add_enemy()
+        else:
+            enemy = add_whale()
+            self.bosses_spawned += 1
+            # Slow down spawn of monster for some time
+            slow_down_time = 60*1000 # 1 min
+            self.last_time_spawn_enemy = ticks_now + slow_down_time
+        if telemetry.enabled:
+            telemetry.emit('spawn', entity=type(enemy).__name__, x=enemy.rect.x)
+        return self.last_time_spawn_enemy - ticks_now + self.spawn_interval()
 
     def set_fps(self, fps):
         """ Setter fps """
         self.fps = fps
 
-    def process_events(self, screen):
-        """ Process all of the events. Return a "True" if we need
-            to close the window. """
-
-        for event in pygame.event.get():
+    def total_score(self):
+        """ Score of all the players together """
+        return sum(player.score for player in self.players)
+
+    def apply_actions(self, actions):
+        """ Apply the (held, pressed) actions of each player, see
+        Player.apply_actions(). Dead players are left alone. """
+        for player, (held, pressed) in zip(self.players, actions):
+            if player.alive():
+                player.apply_actions(held, pressed)
+
+    def get_state(self):
+        """ Snapshot of the simulation: player, enemies, bullets, timers
+        and random generator. It contains no surfaces, images are referred
+        by name in the asset registry, so it can be serialized with
+        dump_state(). """
+        fields = tuple(getattr(self, name) for name in Game.state_fields)
+        entities = [(type(sprite).__name__, sprite.get_state())
+                    for sprite in self.all_sprites_list
+                    if sprite.draw_layer != LAYER_PLAYER]
+        players = tuple((player.alive(), player.get_state())
+                        for player in self.players)
+        return (game_clock.get_state(), random.getstate(), fields,
+                tuple(self.center_map), players, entities,
+                timers.num_owners)
+
+    def set_state(self, state):
+        """ Restore a snapshot created by get_state() """
+        (ticks, random_state, fields, center_map, players, entities,
+         num_timer_owners) = state
+        game_clock.set_state(ticks)
+        random.setstate(random_state)
+        for name, value in zip(Game.state_fields, fields):
+            setattr(self, name, value)
+        self.center_map = list(center_map)
+
+        # The sprites are added in the order of the snapshot, keeping
+        # the order of the registry lists. Timers keep their owner ids.
+        for sprite in self.all_sprites_list.sprites():
+            sprite.kill()
+        timers.cancel_all()
+        for player, (alive, player_state) in zip(self.players, players):
+            self.entity_registry.add(player)
+            player.set_state(player_state)
+            if not alive:
+                player.kill()
+        for class_name, entity_state in entities:
+            ENTITY_CLASSES[class_name]().set_state(entity_state)
+        timers.num_owners = num_timer_owners
+        self.schedule_spawn()
+
+    def resize_screen(self, size_screen):
+        """ Set the window size, the game is scaled keeping the aspect
+        ratio and centered. Return the new screen """
+        screen = pygame.display.set_mode(size_screen, DISPLAY_FLAGS)
+
+
+        size = [SCREEN_WIDTH, SCREEN_HEIGHT]
+        min_div = min(float(size_screen[0]) / size[0],
+                      float(size_screen[1]) / size[1])
+
+        #min_div = min(min_div, 1.0) #size original or smaller
+
+        Game.size_fixed = [int(dim * min_div) for dim in size]
+        #print('val', min_div, 'size_fixed', self.size_fixed)
+
+
+        center_fixed = [i // 2 for i in self.size_fixed]
+        center_resize = [i // 2 for i in size_screen]
+
+        Game.center_image_resize = (center_resize[0] - center_fixed[0],
+                                    center_resize[1] - center_fixed[1])
+        screen.fill(BLACK)
+        screen = pygame.display.set_mode(size_screen, DISPLAY_FLAGS)
+        return screen
+
+    def process_events(self, screen, events=None):
+        """ Process all of the events, by default the ones in the queue.
+            Return a "True" if we need to close the window. """
+
+        if events is None:
+            events = pygame.event.get()
+
+        #Player events
+        for event in events:
+            for input_mapper in self.input_mappers:
+                input_mapper.process_event(event)
+        self.apply_actions([input_mapper.poll()
+                            for input_mapper in self.input_mappers])
+
+        for event in events:
 
             # Generic game events
             if self.start_screen:
@@ -941,43 +2282,20 @@ class Game(object):
                 event.type == pygame.JOYBUTTONDOWN):
                     self.start_screen = False
 
-                    if pygame.mixer:
-                        # http://www.khinsider.com/midi/nes/guardian-legend
-                        pygame.mixer.music.load(os.path.join('sounds', 'corridor-0.mid'))
-                        pygame.mixer.music.play(-1)
+                    # http://www.khinsider.com/midi/nes/guardian-legend
+                    audio.play_music('corridor')
 
 
             if event.type == pygame.QUIT:
                 return True, screen
             elif event.type == pygame.VIDEORESIZE:
-                size_screen = event.dict['size']
-                screen = pygame.display.set_mode(size_screen, DISPLAY_FLAGS)
-
-
-                size = [SCREEN_WIDTH, SCREEN_HEIGHT]
-                min_div = min(float(size_screen[0]) / size[0],
-                              float(size_screen[1]) / size[1])
-
-                #min_div = min(min_div, 1.0) #size original or smaller
-
-                Game.size_fixed = [int(dim * min_div) for dim in size]
-                #print('val', min_div, 'size_fixed', self.size_fixed)
-
-
-                center_fixed = [i // 2 for i in self.size_fixed]
-                center_resize = [i // 2 for i in size_screen]
-
-                Game.center_image_resize = (center_resize[0] - center_fixed[0],
-                                            center_resize[1] - center_fixed[1])
-                screen.fill(BLACK)
-                screen = pygame.display.set_mode(size_screen, DISPLAY_FLAGS)
-
+                screen = self.resize_screen(event.dict['size'])
                 return False, screen
             if (self.game_over and
                 (event.type == pygame.MOUSEBUTTONDOWN or
                 (event.type == pygame.KEYDOWN and event.key == pygame.K_RETURN) or
-                (event.type == pygame.USEREVENT and event.dict['type'] == 'pause'))):
-                self.__init__()
+                (event.type == pygame.USEREVENT and event.dict.get('name') == 'pause'))):
+                self.__init__(self.num_players)
                 return False, screen
             elif event.type == pygame.KEYDOWN and event.key == pygame.K_1:
                 ev_dict = {'size': [SCREEN_WIDTH, SCREEN_HEIGHT]}
@@ -991,19 +2309,15 @@ class Game(object):
                 return False, screen
             elif event.type == pygame.KEYDOWN and event.key == pygame.K_p:
                 send_event_pause()
+            elif event.type == pygame.KEYDOWN and event.key == pygame.K_m:
+                self.show_memory_overlay = not self.show_memory_overlay
 
-            if event.type == pygame.USEREVENT and event.dict['type'] == 'pause':
+            if event.type == pygame.USEREVENT and event.dict.get('name') == 'pause':
                 self.pause = not self.pause
                 if self.pause:
-                    pygame.mixer.music.set_volume(0.0)
-                    pygame.mixer.music.pause() # midi does not stop
+                    audio.pause_music()
                 else:
-                    pygame.mixer.music.set_volume(1.0)
-                    pygame.mixer.music.unpause()
-
-            #Player events
-
-            self.player.process_event(event)
+                    audio.unpause_music()
 
         return False, screen
 
@@ -1012,20 +2326,23 @@ class Game(object):
         This method is run each time through the frame. It
         updates positions and checks for collisions.
         """
-        self.game_over = self.player.physical_obj['hit_points'] <= 0
+        game_clock.tick()
+        self.game_over = all(player.physical_obj['hit_points'] <= 0
+                             for player in self.players)
 
 
         if self.start_screen:
             pass
         elif self.game_over:
-            if not self.game_over_music_enabled and pygame.mixer:
-                pygame.mixer.music.stop()
-                pygame.mixer.music.load(os.path.join('sounds', 'game-over.mid'))
-                pygame.mixer.music.play(1)
+            if not self.game_over_music_enabled:
+                audio.stop_music()
+                audio.play_music('game_over', 1)
                 self.game_over_music_enabled = True
+                if telemetry.enabled:
+                    telemetry.emit('game_over', score=self.total_score(),
+                                   enemies_killed=self.enemies_killed)
 
-                if self.player.score > self.max_score:
-                    self.max_score = self.player.score
+                self.max_score = max(self.max_score, self.total_score())
 
         elif self.pause:
             pass # Do nothing for now
@@ -1043,133 +2360,817 @@ class Game(object):
                 self.center_map[1] = (self.map_layer.map_rect.height -
                                       half_height - scroll_speed)
 
-            self.map_layer.center(self.center_map)
-
-            # Spawn new enemy if time
-
-            self.spawn_enemy()
-
-            # Move all the sprites
-            player_x = self.player.rect.x + self.player.rect.width // 2
-            player_y = self.player.rect.y + self.player.rect.height // 2
+            # Move all the sprites, the enemies chase the first player alive
+            target = self.player
+            for player in self.players:
+                if player.physical_obj['hit_points'] > 0:
+                    target = player
+                    break
+            player_x = target.rect.x + target.rect.width // 2
+            player_y = target.rect.y + target.rect.height // 2
 
             for enemy in self.enemy_list:
                 enemy.set_player_position(player_x, player_y)
 
-            self.all_sprites_list.update()
+            for sprite in self.all_sprites_list:
+                sprite.update()
+
+            # Spawn enemies, fire bullets and animate when it is time
+            timers.run(game_clock.get_ticks())
 
 
             # Check collisions
-            player_hp_old = self.player.physical_obj['hit_points']
+            players_hp_old = [player.physical_obj['hit_points']
+                              for player in self.players]
 
-            for ally_obj in  self.player_object_list:
-                enemy_hit_list = pygame.sprite.spritecollide(ally_obj,
-                                                             self.enemy_object_list,
-                                                             False)
+            # Rects covered by the candidates during their move, collected
+            # once per tick and tested in a batch by each ally
+            swept_candidates = {}
 
-                # When player is immortal to not check collision with him
-                if ally_obj == self.player and self.player.physical_obj['immortal']:
+            for ally_obj in self.player_object_list:
+                # e.g. immortal player or bullets against bullets
+                candidates = self.collision_candidates[ally_obj.category]
+                if candidates is None:
                     continue
 
+                swept = swept_candidates.get(id(candidates))
+                if swept is None:
+                    sprites = candidates.sprites()
+                    swept = swept_candidates[id(candidates)] = (sprites, [
+                        sprite.rect if sprite.swept_rect is None
+                        else sprite.swept_rect for sprite in sprites])
+                sprites, swept_rects = swept
+
+                ally_rect = (ally_obj.rect if ally_obj.swept_rect is None
+                             else ally_obj.swept_rect)
+                enemy_hit_list = [sprites[index] for index
+                                  in ally_rect.collidelistall(swept_rects)]
+                if enemy_hit_list:
+                    enemy_hit_list = [enemy_obj for enemy_obj in enemy_hit_list
+                                      if collide_swept(ally_obj, enemy_obj)]
+                if quality.pixel_perfect and enemy_hit_list:
+                    # Only the overlaps at the end of the move have pixels
+                    colliderect = ally_obj.rect.colliderect
+                    enemy_hit_list = [enemy_obj for enemy_obj in enemy_hit_list
+                                      if not colliderect(enemy_obj.rect) or
+                                      collide_pixel_perfect(ally_obj, enemy_obj)]
+                responses = COLLISION_RESPONSE[ally_obj.category]
+
                 for enemy_obj in enemy_hit_list:
-                    if not isinstance(ally_obj, Bullet) or not isinstance(enemy_obj, Bullet):
-                        if ally_obj.physical_obj['immortal'] is False:
-                            ally_obj.physical_obj['hit_points'] -= enemy_obj.physical_obj['damage']
-                        if not enemy_obj.physical_obj['immortal']:
-                            enemy_obj.physical_obj['hit_points'] -= ally_obj.physical_obj['damage']
-                            self.player.score += enemy_obj.physical_obj['score_value']
-
-            # Make sound if player gets damage
-            if (pygame.mixer and
-                    player_hp_old - self.player.physical_obj['hit_points'] > 0):
-                self.player.collision_sound.play()
+                    response = responses[enemy_obj.category]
+                    if response & RESPONSE_DAMAGE_ALLY:
+                        ally_obj.physical_obj['hit_points'] -= enemy_obj.physical_obj['damage']
+                    if response & RESPONSE_DAMAGE_ENEMY:
+                        enemy_obj.physical_obj['hit_points'] -= ally_obj.physical_obj['damage']
+                        scorer = self.players[ally_obj.player_index]
+                        scorer.score += enemy_obj.physical_obj['score_value']
+
+            # Make sound if a player gets damage
+            for player, hp_old in zip(self.players, players_hp_old):
+                if hp_old - player.physical_obj['hit_points'] > 0:
+                    audio.play('hit')
+                    if telemetry.enabled:
+                        telemetry.emit('damage', player=player.player_index,
+                                       hit_points=player.physical_obj['hit_points'])
 
             # Check for dead objects to be removed
             num_killed_enemy_now = 0
 
-            for sprite in self.all_sprites_list:
-                if sprite.physical_obj['hit_points'] <= 0:
-                    logger.debug(str(sprite) + '  will be removed')
+            # Backwards, as a killed sprite is replaced by the last one
+            for entities in self.entity_registry.entities:
+                for index in range(len(entities) - 1, -1, -1):
+                    sprite = entities[index]
+                    if sprite.physical_obj['hit_points'] > 0:
+                        continue
+                    logger.debug('%s will be removed', sprite)
                     sprite.kill()
-                    if not isinstance(sprite, Bullet):
+                    if sprite.category not in BULLET_CATEGORIES:
                         num_killed_enemy_now += 1
+                        if telemetry.enabled:
+                            telemetry.emit('kill', entity=type(sprite).__name__,
+                                           x=sprite.rect.x, y=sprite.rect.y,
+                                           score=self.total_score())
+                    if sprite.category == CATEGORY_ENEMY:
+                        self.enemies_killed += 1
 
             if num_killed_enemy_now > 0:
-                ticks_now = pygame.time.get_ticks()
+                ticks_now = game_clock.get_ticks()
                 interval_kills = (ticks_now - self.last_time_enemy_killed) / num_killed_enemy_now
                 self.last_time_enemy_killed = ticks_now
-                alpha = 0.50
+                alpha = self.kill_rate_smoothing
                 self.milliseconds_per_kill = exponential_smoothing(alpha,
                                                                    interval_kills,
                                                                    self.milliseconds_per_kill)
                 #self.milliseconds_per_kill = alpha * self.milliseconds_per_kill + (1.0 - alpha) * interval_kills
-                logger.debug('%10.2f ms/kills %10.2f kills/s',
-                             self.milliseconds_per_kill,
-                             1000.0/(self.milliseconds_per_kill))
-
-    def display_frame(self, surface_fixed_size, true_screen):
-        """ Display everything to the screen for the game. """
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug('%10.2f ms/kills %10.2f kills/s',
+                                 self.milliseconds_per_kill,
+                                 1000.0/(self.milliseconds_per_kill))
+                self.schedule_spawn()
+
+    def render_commands(self, time_input=None):
+        """ RenderFrame of the current state: what present() needs, copied
+        so that the logic can go on while it is drawn. time_input is when
+        the input of the tick was read """
+        if self.start_screen or self.game_over:
+            layers = ()
+        else:
+            layers = tuple([layer.commands()
+                            for layer in self.entity_registry.draw_layers])
+        hit_points = ' '.join(str(player.physical_obj['hit_points'])
+                              for player in self.players)
+        return RenderFrame(self.start_screen, self.game_over, self.pause,
+                           tuple(self.center_map), layers, self.total_score(),
+                           self.max_score, round(self.fps, 1), hit_points,
+                           1000.0/(self.milliseconds_per_kill), time_input)
+
+    def present(self, frame, surface_fixed_size, true_screen):
+        """ Draw a RenderFrame on the screen. Only the map view, the HUD
+        cache and the frame counter of the game are used, so it can run
+        while the logic computes the next tick. """
         surface_fixed_size.fill(BLACK)
 
-        if self.start_screen:
+        if frame.start_screen:
             self.start_screen_obj.draw(surface_fixed_size)
 
-        elif self.game_over:
+        elif frame.game_over:
             offset_y = 14
             str_list = ['Game Over, click the mouse', 'or press enter to restart',
                         '', '', '',
-                        'Score {0} - Max {1}'.format(self.player.score, self.max_score)]
+                        'Score {0} - Max {1}'.format(frame.score, frame.max_score)]
             print_text_on_surface(self.font, str_list, surface_fixed_size,
                                   (SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2), offset_y)
 
         else:
 
+            self.map_layer.center(frame.center_map)
             self.map_layer.draw(surface_fixed_size, surface_fixed_size.get_rect())
 
-            self.all_sprites_list.draw(surface_fixed_size)
+            for layer in frame.layers:
+                surface_fixed_size.blits(layer, doreturn=False)
+
+            # The HUD text is refreshed every quality.hud_interval frames
+            refresh_hud = self.frames_drawn % quality.hud_interval == 0
 
             # Score
-            text_score = self.font.render("Score {0}".format(self.player.score)
-                                          , True, WHITE)
-            surface_fixed_size.blit(text_score, [5, 20])
+            text_score = self.render_hud('score', "Score {0}", frame.score,
+                                         refresh_hud)
 
             #Display fps in bottom left side
-            text_fps = self.font.render("FPS {0}".format(round(self.fps, 1)),
-                                        True, WHITE)
-            surface_fixed_size.blit(text_fps, [SCREEN_WIDTH -95, SCREEN_HEIGHT -20])
+            text_fps = self.render_hud('fps', "FPS {0}", frame.fps, refresh_hud)
 
-            # Hit points
-            text_hp = self.font.render("HP {0}".format(
-                self.player.physical_obj['hit_points']), True, WHITE)
-            surface_fixed_size.blit(text_hp, [SCREEN_WIDTH -60, 20])
+            # Hit points, of each player
+            text_hp = self.render_hud('hp', "HP {0}", frame.hit_points, refresh_hud)
 
             # Kill / s
-            text_kill_s = self.font.render("Kill/s {0:.2f}".format(
-                1000.0/(self.milliseconds_per_kill)), True, WHITE)
-            surface_fixed_size.blit(text_kill_s, [0, SCREEN_HEIGHT -20])
+            text_kill_s = self.render_hud('kill_s', "Kill/s {0:.2f}",
+                                          frame.kills_per_s, refresh_hud)
+
+            surface_fixed_size.blits(((text_score, (5, 20)),
+                                      (text_fps, (SCREEN_WIDTH -95, SCREEN_HEIGHT -20)),
+                                      (text_hp, (SCREEN_WIDTH -60, 20)),
+                                      (text_kill_s, (0, SCREEN_HEIGHT -20))),
+                                     doreturn=False)
 
             #test Map coordinate
             #text_map = self.font.render("Map 1 {0}".format(
             #    self.center_map[1]), True, WHITE)
             #surface_fixed_size.blit(text_map, [SCREEN_WIDTH//2, SCREEN_HEIGHT -80])
 
-            if self.pause:
+            if frame.pause:
                 #Display fps in bottom left side
                 text_pause = self.font.render("PAUSED", True, WHITE)
                 center_x = (SCREEN_WIDTH // 2) - (text_pause.get_width() // 2)
                 center_y = (SCREEN_HEIGHT // 2) - (text_pause.get_height() // 2)
                 surface_fixed_size.blit(text_pause, [center_x, center_y])
 
+        if self.memory_overlay and self.show_memory_overlay:
+            surface_fixed_size.blits(
+                [(self.render_hud(('memory', index), "{0}", line, True),
+                  (5, 34 + 10 * index))
+                 for index, line in enumerate(self.memory_overlay)],
+                doreturn=False)
 
-        true_screen.blit(pygame.transform.scale(surface_fixed_size,
-                                                Game.size_fixed),
-                         Game.center_image_resize)
+        if quality.smooth_scale:
+            scaled = pygame.transform.smoothscale(surface_fixed_size,
+                                                  Game.size_fixed)
+        else:
+            scaled = pygame.transform.scale(surface_fixed_size, Game.size_fixed)
+        true_screen.blit(scaled, Game.center_image_resize)
 
         pygame.display.flip()
+        self.frames_drawn += 1
+
+    def display_frame(self, surface_fixed_size, true_screen):
+        """ Display everything to the screen for the game. """
+        self.present(self.render_commands(), surface_fixed_size, true_screen)
+
+    def render_hud(self, slot, text_format, value, refresh):
+        """ Surface with the text of a HUD slot. It is rendered again
+        only if the value changed and refresh is True """
+        cached = self.hud_cache.get(slot)
+        if cached is not None and (cached[0] == value or not refresh):
+            return cached[1]
+        text = self.font.render(text_format.format(value), True, WHITE)
+        self.hud_cache[slot] = (value, text)
+        return text
+
+
+class RewindBuffer(object):
+    """ Ring buffer with the snapshots of the last seconds of a game,
+    one for each logic update """
+
+    def __init__(self, seconds=5.0):
+        """ Constructor. Pass the seconds of game to keep """
+        # plus the current state, the last snapshot recorded
+        self.states = collections.deque(maxlen=max(int(seconds * FPS), 1) + 1)
+
+    def __len__(self):
+        """ Number of snapshots """
+        return len(self.states)
+
+    def record(self, game):
+        """ Save the current state of the game """
+        self.states.append(game.get_state())
+
+    def rewind(self, game, seconds):
+        """ Bring the game back by the given seconds, at most up to the
+        oldest snapshot. The last snapshot is the current state, it and
+        the newer ones are dropped. Return the number of ticks rewound,
+        0 if there is nothing to rewind """
+        num_ticks = min(max(int(seconds * FPS), 1), len(self.states) - 1)
+        if num_ticks <= 0:
+            return 0
+        for _ in range(num_ticks):
+            self.states.pop()
+        game.set_state(self.states[-1])
+        return num_ticks
+
+    def clear(self):
+        """ Remove all the snapshots """
+        self.states.clear()
+
+
+class QualityGovernor(object):
+    """ Watch the cost of the frames and keep the logic at FPS updates
+    per second under load: frames late on schedule are not drawn, and the
+    optional costs in quality are lowered, then restored when there is
+    headroom again. """
+
+    # hud_interval, smooth_scale allowed, pixel_perfect allowed
+    LEVELS = ((1, True, True),
+              (4, False, True),
+              (15, False, False))
+
+    def __init__(self, max_frame_skip=5):
+        """ Constructor. At most max_frame_skip frames in a row are
+        not drawn """
+        self.budget_ms = 1000.0 / FPS
+        self.max_frame_skip = max_frame_skip
+        self.level = 0
+        # what the user selected, restored at level 0
+        self.smooth_scale = quality.smooth_scale
+        self.pixel_perfect = quality.pixel_perfect
+
+        self.cost_ms = 0.0 # smoothed logic + drawing time of a frame
+        self.frames_since_change = 0
+        self.num_skipped_row = 0
+        self.num_logic_ticks = 0
+        self.num_frames_drawn = 0
+        self.num_frames_skipped = 0
+        self.num_level_changes = 0
+        # time from reading the input of a tick to the flip of its frame
+        self.latencies_ms = collections.deque(maxlen=LATENCY_SAMPLES)
+        self.time_start = time.perf_counter()
+
+    def skip_drawing(self, late_s):
+        """ Decide if the frame is not drawn, given how late in seconds
+        the next logic update is """
+        self.num_logic_ticks += 1
+        if late_s > 0.0 and self.num_skipped_row < self.max_frame_skip:
+            self.num_skipped_row += 1
+            self.num_frames_skipped += 1
+            return True
+        self.num_skipped_row = 0
+        self.num_frames_drawn += 1
+        return False
+
+    def frame_done(self, cost_ms, latency_ms=None):
+        """ Called at each frame with the time spent in logic and drawing,
+        and the input latency of the frame drawn if any. Change the quality
+        level if needed """
+        self.cost_ms = exponential_smoothing(0.1, cost_ms, self.cost_ms)
+        if latency_ms is not None:
+            self.latencies_ms.append(latency_ms)
+        self.frames_since_change += 1
+
+        if (self.cost_ms > 0.9 * self.budget_ms and self.frames_since_change > 30
+                and self.level < len(self.LEVELS) - 1):
+            self.set_level(self.level + 1)
+        elif (self.cost_ms < 0.5 * self.budget_ms and self.frames_since_change > 120
+              and self.level > 0):
+            self.set_level(self.level - 1)
+
+    def set_level(self, level):
+        """ Apply a quality level, 0 is the best """
+        self.level = level
+        self.frames_since_change = 0
+        self.num_level_changes += 1
+        hud_interval, smooth_allowed, pixel_perfect_allowed = self.LEVELS[level]
+        quality.hud_interval = hud_interval
+        quality.smooth_scale = self.smooth_scale and smooth_allowed
+        quality.pixel_perfect = self.pixel_perfect and pixel_perfect_allowed
+        logger.debug('Quality level %d, frame cost %.2f ms, %s',
+                     level, self.cost_ms, quality)
+
+    def metrics(self):
+        """ Dictionary with the decisions taken so far """
+        elapsed = max(time.perf_counter() - self.time_start, 1e-6)
+        latencies_ms = sorted(self.latencies_ms)
+        return {'level': self.level,
+                'frame_cost_ms': self.cost_ms,
+                'logic_ticks_per_s': self.num_logic_ticks / elapsed,
+                'frames_drawn_per_s': self.num_frames_drawn / elapsed,
+                'frames_skipped': self.num_frames_skipped,
+                'level_changes': self.num_level_changes,
+                'input_latency_ms': (statistics.mean(latencies_ms)
+                                     if latencies_ms else None),
+                'input_latency_p95_ms': (latencies_ms[int(0.95 * (len(latencies_ms) - 1))]
+                                         if latencies_ms else None)}
+
+
+class AllocationMonitor(object):
+    """ Opt-in instrumentation of the main loop. It reports the memory
+    allocated in each frame, the call sites allocating the most
+    (tracemalloc) and the garbage collector pauses with the frame they
+    landed on (gc.callbacks). """
+
+    def __init__(self, snapshot_interval=60, top=10):
+        """ Constructor. Call sites are compared every snapshot_interval
+        frames, top is the number of entries in the report """
+        self.snapshot_interval = snapshot_interval
+        self.top = top
+        self.frame = 0
+        # peak bytes allocated during each frame, an array does not keep
+        # an int object per frame that would show up in the report
+        self.frame_allocated = array.array('q')
+        self.gc_pauses = [] # frame, generation, ms, objects collected
+        self.site_blocks = collections.Counter()
+        self.site_bytes = collections.Counter()
+        self.num_sampled_frames = 0
+        self._gc_start = None
+
+        tracemalloc.start()
+        self._snapshot = self._take_snapshot()
+        self._frame_start_memory = tracemalloc.get_traced_memory()[0]
+        gc.callbacks.append(self._on_gc)
+
+    @staticmethod
+    def _take_snapshot():
+        """ Snapshot of the allocations, excluding tracemalloc itself """
+        snapshot = tracemalloc.take_snapshot()
+        return snapshot.filter_traces(
+            (tracemalloc.Filter(False, tracemalloc.__file__),))
+
+    def _on_gc(self, phase, info):
+        """ Callback of the garbage collector """
+        if phase == 'start':
+            self._gc_start = time.perf_counter()
+        elif self._gc_start is not None:
+            pause_ms = (time.perf_counter() - self._gc_start) * 1000.0
+            self.gc_pauses.append((self.frame, info['generation'], pause_ms,
+                                   info['collected']))
+            self._gc_start = None
+
+    def end_frame(self):
+        """ Called once at the end of each frame """
+        peak = tracemalloc.get_traced_memory()[1]
+        self.frame_allocated.append(peak - self._frame_start_memory)
+
+        self.frame += 1
+        if self.frame % self.snapshot_interval == 0:
+            snapshot = self._take_snapshot()
+            for stat in snapshot.compare_to(self._snapshot, 'lineno'):
+                if stat.count_diff > 0:
+                    site = str(stat.traceback[0])
+                    self.site_blocks[site] += stat.count_diff
+                    self.site_bytes[site] += stat.size_diff
+            self._snapshot = snapshot
+            self.num_sampled_frames += self.snapshot_interval
+
+        # The work of the monitor is not counted in the next frame
+        tracemalloc.reset_peak()
+        self._frame_start_memory = tracemalloc.get_traced_memory()[0]
+
+    def report(self):
+        """ Lines of text with the results """
+        lines = ['Frames: {0}'.format(self.frame)]
+        if self.frame_allocated:
+            worst = sorted(enumerate(self.frame_allocated),
+                           key=lambda item: item[1], reverse=True)[:self.top]
+            lines.append('Allocated per frame: mean {0:.0f} B'.format(
+                sum(self.frame_allocated) / len(self.frame_allocated)))
+            lines.append('Frames allocating the most: ' + ', '.join(
+                '{0} ({1} B)'.format(frame, size) for frame, size in worst))
+
+        num_frames = max(self.num_sampled_frames, 1)
+        lines.append('Call sites, new blocks kept per frame:')
+        for site, blocks in self.site_blocks.most_common(self.top):
+            lines.append('  {0:8.2f} blocks {1:10.1f} B  {2}'.format(
+                blocks / num_frames, self.site_bytes[site] / num_frames, site))
+
+        total_ms = sum(pause[2] for pause in self.gc_pauses)
+        lines.append('GC pauses: {0}, total {1:.2f} ms'.format(
+            len(self.gc_pauses), total_ms))
+        longest = sorted(self.gc_pauses, key=lambda pause: pause[2],
+                         reverse=True)[:self.top]
+        for frame, generation, pause_ms, collected in longest:
+            lines.append('  frame {0} gen {1}: {2:.3f} ms, {3} collected'.format(
+                frame, generation, pause_ms, collected))
+        return lines
+
+    def stop(self):
+        """ Stop tracing """
+        gc.callbacks.remove(self._on_gc)
+        tracemalloc.stop()
+
+
+def resident_memory():
+    """ Resident memory of the process in bytes, None if unknown (it is
+    read from /proc, only on Linux) """
+    if resource is None:
+        return None
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def peak_resident_memory():
+    """ Highest resident memory of the process so far in bytes, as
+    recorded by the kernel. None if unknown """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes elsewhere
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def sprite_bytes(sprite, seen):
+    """ Approximate bytes of the Python objects of a sprite: the object,
+    its attribute dict and the objects the attributes refer to (rects,
+    dicts, lists, timers), not their content. Images are accounted in
+    the surface pools. Objects whose id is in seen are not counted again """
+    total = 0
+    for obj in itertools.chain((sprite, sprite.__dict__), sprite.__dict__.values()):
+        if id(obj) in seen or isinstance(obj, (pygame.Surface, pygame.sprite.Sprite)):
+            continue
+        seen.add(id(obj))
+        total += sys.getsizeof(obj)
+    return total
+
+
+def format_bytes(num_bytes):
+    """ Size in B, KB or MB for the reports """
+    if num_bytes is None:
+        return '?'
+    if num_bytes < 1024:
+        return '{0} B'.format(num_bytes)
+    if num_bytes < 1024 * 1024:
+        return '{0:.1f} KB'.format(num_bytes / 1024.0)
+    return '{0:.1f} MB'.format(num_bytes / (1024.0 * 1024.0))
+
+
+class MemoryMonitor(object):
+    """ Opt-in accounting of where the memory goes. Bytes of each
+    registered image and of the surface pools (sprite images, map tiles,
+    map buffer, window, HUD text, collision masks, sounds), and of the
+    live sprites of each category. It also tracks the resident memory of
+    the process and its peak over the run. The pools are sampled every
+    sample_interval frames, between two logic updates. The sprites are
+    counted sprites_per_frame at a time over the next frames, so that a
+    sample does not make a frame late. """
+
+    def __init__(self, sample_interval=60, sprites_per_frame=50):
+        """ Constructor """
+        self.sample_interval = sample_interval
+        self.sprites_per_frame = sprites_per_frame
+        self.frame = 0
+        self.pools = {} # name: (surfaces or objects, bytes) of the last sample
+        self.entities = {} # category name: (sprites, bytes) of the last count
+        self.resident = None
+        self.peaks = collections.Counter() # name: highest bytes sampled
+        self.peak_frames = {} # name: frame of the peak
+        # sprites of the count in progress still to visit, and the totals
+        self._sprites_left = []
+        self._counted = None
+        self._seen = None
+
+    def surface_pools(self, game, surfaces_window):
+        """ Pixel buffers by pool: name, (surfaces, bytes) """
+        map_layer = game.map_layer
+        map_buffers = (getattr(map_layer, '_buffer', None),
+                       getattr(map_layer, '_zoom_buffer', None))
+        # the window is scaled into a new surface at each drawing
+        scaled_bytes = (Game.size_fixed[0] * Game.size_fixed[1] *
+                        surfaces_window[0].get_bytesize())
+        window = surface_pool_bytes(surfaces_window)
+        masks_bytes = sum((mask.get_size()[0] + 63) // 64 * 8 * mask.get_size()[1]
+                          for mask in _masks.values())
+
+        sounds_bytes = sum(len(data) for data in audio.music_data.values())
+        if mixer_available():
+            frequency, size, channels = pygame.mixer.get_init()
+            sounds_bytes += sum(int(sound.get_length() * frequency) * channels *
+                                abs(size) // 8 for sound in audio.sounds.values())
+
+        return (('sprite images', surface_pool_bytes(assets.images.values())),
+                ('map tiles', surface_pool_bytes(map_layer.data.tmx.images)),
+                ('map buffer', surface_pool_bytes(map_buffers)),
+                ('window', (window[0] + 1, window[1] + scaled_bytes)),
+                ('HUD text', surface_pool_bytes(
+                    text for _, text in game.hud_cache.values())),
+                ('collision masks', (len(_masks), masks_bytes)),
+                ('sounds', (len(audio.music_data) + len(audio.sounds),
+                            sounds_bytes)))
+
+    def start_count(self, game):
+        """ Start counting the bytes of the live sprites """
+        self._sprites_left = [sprite for layer in game.entity_registry.entities
+                              for sprite in layer]
+        self._counted = collections.OrderedDict(
+            (name, [0, 0]) for name in CATEGORY_NAMES)
+        self._seen = set()
+
+    def count_sprites(self, max_sprites=None):
+        """ Count up to max_sprites of the sprites left, all by default.
+        When all are counted, the totals and peaks are updated and True
+        is returned. Sprites killed since the start are still counted """
+        if self._counted is None:
+            return False
+        sprites_left = self._sprites_left
+        if max_sprites is None:
+            max_sprites = len(sprites_left)
+        for _ in range(min(max_sprites, len(sprites_left))):
+            sprite = sprites_left.pop()
+            entry = self._counted[CATEGORY_NAMES[sprite.category]]
+            entry[0] += 1
+            entry[1] += sprite_bytes(sprite, self._seen)
+        if sprites_left:
+            return False
+
+        self.entities = collections.OrderedDict(
+            (name, tuple(entry)) for name, entry in self._counted.items())
+        self._counted = self._seen = None
+        self.update_peaks(('entities ' + name, num_bytes)
+                          for name, (_, num_bytes) in self.entities.items())
+        return True
+
+    def sample(self, game, surfaces_window):
+        """ Account the surface pools and the resident memory now, and
+        start counting the sprites if the last count is over """
+        self.pools = collections.OrderedDict(
+            self.surface_pools(game, surfaces_window))
+        self.resident = resident_memory()
+        self.update_peaks([(name, num_bytes)
+                           for name, (_, num_bytes) in self.pools.items()] +
+                          [('resident', self.resident or 0)])
+        if self._counted is None:
+            self.start_count(game)
+
+    def update_peaks(self, totals):
+        """ Keep the highest bytes of each name, with their frame """
+        for name, num_bytes in totals:
+            if num_bytes > self.peaks[name]:
+                self.peaks[name] = num_bytes
+                self.peak_frames[name] = self.frame
+
+    def end_frame(self, game, surfaces_window):
+        """ Called once at the end of each frame, while the logic is not
+        running. Set the lines of the overlay of the game when the totals
+        change """
+        if self.frame % self.sample_interval == 0:
+            self.sample(game, surfaces_window)
+            game.memory_overlay = self.overlay_lines()
+        if self.count_sprites(self.sprites_per_frame):
+            game.memory_overlay = self.overlay_lines()
+        self.frame += 1
+
+    def peak_resident(self):
+        """ Peak resident memory, from the kernel and the samples """
+        peak = peak_resident_memory()
+        if peak is None:
+            return self.peaks['resident'] or None
+        return max(peak, self.peaks['resident'])
+
+    def overlay_lines(self):
+        """ Short lines of text with the totals of the last sample """
+        surfaces_bytes = sum(num_bytes for _, num_bytes in self.pools.values())
+        num_sprites = sum(count for count, _ in self.entities.values())
+        entities_bytes = sum(num_bytes for _, num_bytes in self.entities.values())
+        return ('RSS {0}'.format(format_bytes(self.resident)),
+                'Peak {0}'.format(format_bytes(self.peak_resident())),
+                'Pools {0}'.format(format_bytes(surfaces_bytes)),
+                'Sprites {0} {1}'.format(num_sprites, format_bytes(entities_bytes)))
+
+    def report(self, game, surfaces_window):
+        """ Lines of text with the results, after counting everything now """
+        self._counted = None
+        self.sample(game, surfaces_window)
+        self.count_sprites()
+        accounted = (sum(num_bytes for _, num_bytes in self.pools.values()) +
+                     sum(num_bytes for _, num_bytes in self.entities.values()))
+        lines = ['Resident memory: {0}, peak {1}, accounted below {2}'.format(
+            format_bytes(self.resident), format_bytes(self.peak_resident()),
+            format_bytes(accounted))]
+
+        lines.append('Surface pools, now and peak:')
+        for name, (count, num_bytes) in self.pools.items():
+            lines.append('  {0:16} {1:5} {2:>10} {3:>10}'.format(
+                name, count, format_bytes(num_bytes),
+                format_bytes(self.peaks[name])))
+
+        lines.append('Images and their bytes:')
+        images = sorted(assets.images.items(), key=lambda item: image_bytes(item[1]),
+                        reverse=True)
+        for name, image in images:
+            lines.append('  {0:>10} {1}x{2} {3}'.format(
+                format_bytes(image_bytes(image)), image.get_width(),
+                image.get_height(), name))
+
+        lines.append('Sprites by category, now and peak (frame):')
+        for name, (count, num_bytes) in self.entities.items():
+            peak_name = 'entities ' + name
+            lines.append('  {0:16} {1:5} {2:>10} {3:>10} ({4})'.format(
+                name, count, format_bytes(num_bytes),
+                format_bytes(self.peaks[peak_name]),
+                self.peak_frames.get(peak_name, '-')))
+        return lines
+
+
+# auto: Python default, manual: disabled during gameplay and run at
+# safe points (start screen, pause, game over), off: never run
+GC_MODES = ('auto', 'manual', 'off')
+
+class GarbageCollectorControl(object):
+    """ Decide when the garbage collector runs """
+
+    def __init__(self, mode='auto'):
+        """ Constructor. Pass one of GC_MODES """
+        self.mode = mode
+        self.in_safe_point = True
+        if mode != 'auto':
+            gc.disable()
+
+    def update(self, safe_point):
+        """ Called once per frame. safe_point is True when a hitch is
+        not visible, e.g. pause or game over """
+        if self.mode == 'manual' and safe_point and not self.in_safe_point:
+            gc.collect()
+        self.in_safe_point = safe_point
+
+
+class IdleMode(object):
+    """ Screens without animation (start screen, pause, game over) are
+    drawn once, then the main loop blocks on pygame.event.wait() and runs
+    again only when an event arrives, e.g. input or window exposed.
+    Wake ups, timeouts, time and CPU time spent waiting are counted. """
+
+    def __init__(self, enabled=True, timeout_ms=1000):
+        """ Constructor. The wait returns after timeout_ms without events """
+        self.enabled = enabled
+        self.timeout_ms = timeout_ms
+        self.frame_drawn = False # the idle screen is on the window
+        self.num_wakeups = 0
+        self.num_timeouts = 0
+        self.idle_s = 0.0
+        self.idle_cpu_s = 0.0
+
+    @staticmethod
+    def is_idle(game):
+        """ True on the screens without animation, of a Game or of a
+        RenderFrame """
+        return game.start_screen or game.pause or game.game_over
+
+    def should_wait(self, game):
+        """ True if the loop can wait for events """
+        return self.enabled and self.frame_drawn and self.is_idle(game)
+
+    def frame_done(self, frame, drawn):
+        """ Called after each loop with the RenderFrame, drawn is True if
+        it was drawn """
+        if drawn:
+            self.frame_drawn = self.is_idle(frame)
+
+    def wait(self):
+        """ Block until an event arrives or the timeout expires.
+        Return the events, empty on timeout """
+        time_start = time.perf_counter()
+        cpu_start = time.process_time()
+        event = pygame.event.wait(self.timeout_ms)
+        idle_s = time.perf_counter() - time_start
+        self.idle_s += idle_s
+        self.idle_cpu_s += time.process_time() - cpu_start
+
+        woken = event.type != pygame.NOEVENT
+        if telemetry.enabled:
+            telemetry.emit('idle_wait', wait_ms=idle_s * 1000.0, woken=woken)
+        if not woken:
+            self.num_timeouts += 1
+            return []
+        self.num_wakeups += 1
+        # the events may change the screen: draw it before waiting again,
+        # also when the next frame is skipped or comes from the pipeline
+        self.frame_drawn = False
+        return [event] + pygame.event.get()
+
+    def metrics(self):
+        """ Dictionary with the idle statistics """
+        return {'wakeups': self.num_wakeups,
+                'timeouts': self.num_timeouts,
+                'idle_s': self.idle_s,
+                'idle_cpu_s': self.idle_cpu_s,
+                'idle_cpu_percent': 100.0 * self.idle_cpu_s / max(self.idle_s, 1e-6)}
+
+
+class LogicWorker(object):
+    """ Thread running Game.run_logic, so the main thread can draw the
+    RenderFrame of the previous tick at the same time (pipelined loop).
+    start() and finish() alternate, the game must not be used between
+    them. The input of a tick is then shown one frame later. The two
+    threads share the GIL: it is faster only when drawing blocks without
+    holding it, e.g. a display flip waiting for vsync. """
+
+    def __init__(self, game):
+        """ Constructor, the thread waits for the first tick """
+        self.game = game
+        self.requests = queue.Queue(maxsize=1)
+        self.frames = queue.Queue(maxsize=1)
+        self.thread = threading.Thread(target=self._run, name='logic',
+                                       daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        """ Loop of the thread, stopped by a None request """
+        while True:
+            time_input = self.requests.get()
+            if time_input is None:
+                break
+            try:
+                self.game.run_logic()
+                result = self.game.render_commands(time_input)
+            except Exception as error: # raised again by finish()
+                result = error
+            self.frames.put(result)
+
+    def start(self, time_input):
+        """ Run the logic of a tick, whose input was read at time_input """
+        self.requests.put(time_input)
+
+    def finish(self):
+        """ Wait for the end of the tick, return its RenderFrame """
+        result = self.frames.get()
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def stop(self):
+        """ Stop the thread """
+        self.requests.put(None)
+        self.thread.join()
+
+
+def parse_arguments():
+    """ Command line options """
+    parser = argparse.ArgumentParser(description='Guardian')
+    parser.add_argument('--profile-alloc', action='store_true',
+                        help='report allocations per frame and GC pauses')
+    parser.add_argument('--memory-report', action='store_true',
+                        help='show memory by pool and sprite category, report at exit')
+    parser.add_argument('--gc', choices=GC_MODES, default='auto',
+                        help='garbage collector mode')
+    parser.add_argument('--smooth-scale', action='store_true',
+                        help='smooth scaling of the window')
+    parser.add_argument('--pixel-perfect', action='store_true',
+                        help='pixel perfect collisions')
+    parser.add_argument('--no-frame-skip', action='store_true',
+                        help='draw every frame, even when late')
+    parser.add_argument('--no-idle', action='store_true',
+                        help='keep redrawing start, pause and game over screens')
+    parser.add_argument('--telemetry', metavar='FILE', default=None,
+                        help='write game events and frame stats as JSON lines')
+    parser.add_argument('--players', type=int, choices=(1, 2), default=1,
+                        help='players on the same computer')
+    parser.add_argument('--pipeline', action='store_true',
+                        help='run the logic of a tick while drawing the previous one')
+    return parser.parse_args()
 
 
 def main():
     """ Main program function. """
+    args = parse_arguments()
+
     # Initialize logger
     #logging.getLogger().setLevel(logging.INFO)
     # Initialize Pygame and set up the window
@@ -1183,9 +3184,17 @@ def main():
 
     pygame.display.set_caption("Guardian")
     pygame.mouse.set_visible(False)
+    # The mouse is not used, do not wake up the idle screens
+    pygame.event.set_blocked(pygame.MOUSEMOTION)
+
+    # Read the music and sounds now and not during the game
+    audio.preload()
+
+    if args.telemetry:
+        telemetry.start(args.telemetry)
 
     # Set Icon of the window
-    sprite_sheet = SpriteSheet(os.path.join('bitmaps', 'bosses.png'))
+    sprite_sheet = SpriteSheet(os.path.join(DATA_DIR, 'bitmaps', 'bosses.png'))
     icon = sprite_sheet.get_image(99, 312, 32, 32)
     pygame.display.set_icon(icon)
 
@@ -1194,25 +3203,109 @@ def main():
     clock = pygame.time.Clock()
 
     # Create an instance of the Game class
-    game = Game()
+    game = Game(args.players)
+
+    monitor = None
+    if args.profile_alloc:
+        monitor = AllocationMonitor()
+    memory_monitor = MemoryMonitor() if args.memory_report else None
+    gc_control = GarbageCollectorControl(args.gc)
+
+    quality.smooth_scale = args.smooth_scale
+    quality.pixel_perfect = args.pixel_perfect
+    governor = QualityGovernor(max_frame_skip=0 if args.no_frame_skip else 5)
+    idle = IdleMode(enabled=not args.no_idle)
+    logic_step = 1.0 / FPS
+    next_logic_time = time.perf_counter()
+
+    # Pipelined: the frame drawn is the one of the previous tick
+    worker = LogicWorker(game) if args.pipeline else None
+    frame = None
 
     # Main game loop
     while not done:
 
-        # Process events (keystrokes, mouse clicks, etc)
-        done, screen = game.process_events(screen)
-
-        # Update object positions, check for collisions
-        game.run_logic()
+        # Nothing changes on idle screens until an event arrives
+        events = None
+        if idle.should_wait(game):
+            events = idle.wait()
+            if not events:
+                gc_control.update(True)
+                continue
+            # the idle screen it shows is already on the window
+            if worker:
+                frame = None
 
+        # Process events (keystrokes, mouse clicks, etc)
+        time_input = time.perf_counter()
+        done, screen = game.process_events(screen, events)
         #set fps to be printed
         game.set_fps(clock.get_fps())
 
-        # Draw the current frame
-        game.display_frame(surface_fixed_size, screen)
+        time_start = time.perf_counter()
 
-        # Pause for the next frame
-        clock.tick(FPS)
+        # Update object positions, check for collisions
+        if worker:
+            worker.start(time_input)
+        else:
+            game.run_logic()
+
+        # Too late, e.g. the window was moved: do not try to catch up
+        next_logic_time += logic_step
+        time_now = time.perf_counter()
+        if time_now - next_logic_time > governor.max_frame_skip * logic_step:
+            next_logic_time = time_now
+
+        # Behind schedule: skip drawing to keep the logic at FPS
+        skip_drawing = governor.skip_drawing(time_now - next_logic_time)
+        if not worker and not skip_drawing:
+            frame = game.render_commands(time_input)
+        presented = frame
+        drawn = presented is not None and not skip_drawing
+        latency_ms = None
+        if drawn:
+            # Draw the current frame, or the previous one when pipelined
+            game.present(presented, surface_fixed_size, screen)
+            latency_ms = (time.perf_counter() - presented.time_input) * 1000.0
+        if worker:
+            frame = worker.finish()
+        cost_ms = (time.perf_counter() - time_start) * 1000.0
+        governor.frame_done(cost_ms, latency_ms)
+        # the frame drawn tells which screen is on the window
+        idle.frame_done(presented, drawn)
+        if telemetry.enabled:
+            telemetry.emit('frame', cost_ms=cost_ms, drawn=drawn,
+                           latency_ms=latency_ms,
+                           sprites=len(game.all_sprites_list),
+                           quality=governor.level)
+
+        gc_control.update(game.start_screen or game.pause or game.game_over)
+        if monitor:
+            monitor.end_frame()
+        if memory_monitor:
+            memory_monitor.end_frame(game, (screen, surface_fixed_size))
+
+        # Sleep until the next logic update, unless catching up. A fixed
+        # clock.tick(FPS) would wait a whole frame after the work of this
+        # one and fall behind the schedule
+        if not skip_drawing:
+            delay = next_logic_time - time.perf_counter()
+            if delay > 0.0:
+                time.sleep(delay)
+            clock.tick()
+
+    if worker:
+        worker.stop()
+    if monitor:
+        monitor.stop()
+        for line in monitor.report():
+            logger.info(line)
+    if memory_monitor:
+        for line in memory_monitor.report(game, (screen, surface_fixed_size)):
+            logger.info(line)
+    logger.debug('Quality governor: %s', governor.metrics())
+    logger.debug('Idle mode: %s', idle.metrics())
+    telemetry.stop()
 
     # Close window and exit
     pygame.quit()
@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Batch simulator used to tune spawn and difficulty parameters.
+
+Many seeded headless games are played by bots on all the cores, for each
+combination of a parameter grid. Aggregated metrics (survival time, score,
+kills per second, frame cost) are written to CSV.
+
+Example:
+    python guardian_batch.py --interval-spawn 1000,1500 --boss-probability 0.05,0.2
+"""
+
+import argparse
+import csv
+import itertools
+import math
+import multiprocessing
+import os
+import random
+import time
+
+import guardian
+import guardian_env
+
+
+# Columns of the aggregated CSV, after the parameters
+PARAMETERS = ('interval_spawn_enemy', 'kill_rate_smoothing', 'boss_probability')
+METRICS = ('survival_s', 'score', 'kills_per_s', 'bosses', 'frame_cost_ms')
+
+
+def random_bot(rng, step, observation):
+    """ Press random buttons """
+    del step, observation
+    return rng.randrange(guardian_env.NUM_ACTIONS)
+
+
+def scripted_bot(rng, step, observation):
+    """ Stay under the closest enemy and keep firing """
+    del rng
+    player_x, player_y = observation['player']
+    action = guardian_env.ACTION_NONE
+
+    if observation['enemies']:
+        target_x, _ = min(observation['enemies'],
+                          key=lambda pos: abs(pos[0] - player_x))
+        if target_x < player_x - 2:
+            action |= guardian_env.ACTION_LEFT
+        elif target_x > player_x + 2:
+            action |= guardian_env.ACTION_RIGHT
+
+    # Step aside from bullets coming close
+    for bullet_x, bullet_y in observation['bullets']:
+        if abs(bullet_x - player_x) < 12 and 0 < player_y - bullet_y < 40:
+            action &= ~(guardian_env.ACTION_LEFT | guardian_env.ACTION_RIGHT)
+            if bullet_x < player_x:
+                action |= guardian_env.ACTION_RIGHT
+            else:
+                action |= guardian_env.ACTION_LEFT
+            break
+
+    # Fire is triggered when pressed, so release it every other step
+    if step % 2 == 0:
+        action |= guardian_env.ACTION_FIRE
+    return action
+
+BOTS = {'random': random_bot, 'scripted': scripted_bot}
+
+
+# Environment of each worker process
+_worker_env = None
+
+def _init_worker():
+    """ Create the environment of the worker process """
+    global _worker_env
+    _worker_env = guardian_env.GameEnv()
+
+
+def run_game(job):
+    """ Play one game. job is (parameters, seed, bot name, max steps).
+    Return the parameters and the metrics of the game """
+    parameters, seed, bot_name, max_steps = job
+    env = _worker_env
+    bot = BOTS[bot_name]
+    rng = random.Random(seed)
+
+    observation = env.reset(seed)
+    for name, value in zip(PARAMETERS, parameters):
+        setattr(env.game, name, value)
+    env.game.schedule_spawn()
+
+    steps = 0
+    done = False
+    time_start = time.perf_counter()
+    while not done and steps < max_steps:
+        observation, _, done, _ = env.step(bot(rng, steps, observation))
+        steps += 1
+    elapsed = time.perf_counter() - time_start
+
+    survival_s = steps / float(guardian.FPS)
+    metrics = {'survival_s': survival_s,
+               'score': env.game.player.score,
+               'kills_per_s': env.game.enemies_killed / survival_s,
+               'bosses': env.game.bosses_spawned,
+               'frame_cost_ms': 1000.0 * elapsed / steps}
+    return parameters, seed, metrics
+
+
+def aggregate(results):
+    """ Mean and standard deviation of the metrics for each parameter set """
+    by_parameters = {}
+    for parameters, _, metrics in results:
+        by_parameters.setdefault(parameters, []).append(metrics)
+
+    rows = []
+    for parameters in sorted(by_parameters):
+        runs = by_parameters[parameters]
+        row = dict(zip(PARAMETERS, parameters))
+        row['runs'] = len(runs)
+        for metric in METRICS:
+            values = [run[metric] for run in runs]
+            mean = sum(values) / len(values)
+            variance = sum((val - mean) ** 2 for val in values) / len(values)
+            row[metric + '_mean'] = mean
+            row[metric + '_std'] = math.sqrt(variance)
+        rows.append(row)
+    return rows
+
+
+def write_csv(file_name, rows, fieldnames):
+    """ Write dictionaries as CSV """
+    with open(file_name, 'w', newline='') as csv_file:
+        writer = csv.DictWriter(csv_file, fieldnames=fieldnames)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def parse_list(value, cast=float):
+    """ Parse comma separated values """
+    return [cast(val) for val in value.split(',')]
+
+
+def main():
+    """ Run the parameter sweep """
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--interval-spawn', type=parse_list,
+                        default=[guardian.INTERVAL_SPAWN_ENEMY],
+                        help='comma separated spawn intervals in ms')
+    parser.add_argument('--alpha', type=parse_list,
+                        default=[guardian.KILL_RATE_SMOOTHING],
+                        help='comma separated smoothing alphas of ms per kill')
+    parser.add_argument('--boss-probability', type=parse_list,
+                        default=[guardian.BOSS_PROBABILITY],
+                        help='comma separated boss probabilities')
+    parser.add_argument('--seeds', type=int, default=8,
+                        help='games for each parameter set')
+    parser.add_argument('--bot', choices=sorted(BOTS), default='scripted')
+    parser.add_argument('--max-seconds', type=float, default=300.0,
+                        help='max game time of a game')
+    parser.add_argument('--processes', type=int, default=os.cpu_count())
+    parser.add_argument('--output', default='batch_results.csv')
+    parser.add_argument('--runs-output', default=None,
+                        help='optional CSV with the metrics of each game')
+    args = parser.parse_args()
+
+    max_steps = int(args.max_seconds * guardian.FPS)
+    if max_steps < 1:
+        parser.error('--max-seconds must be at least one tick, {0:.4f} s'.format(
+            1.0 / guardian.FPS))
+    grid = list(itertools.product(args.interval_spawn, args.alpha,
+                                  args.boss_probability))
+    jobs = [(parameters, seed, args.bot, max_steps)
+            for parameters in grid for seed in range(args.seeds)]
+
+    time_start = time.perf_counter()
+    with multiprocessing.Pool(args.processes, initializer=_init_worker) as pool:
+        results = list(pool.imap_unordered(run_game, jobs))
+    elapsed = time.perf_counter() - time_start
+
+    fieldnames = list(PARAMETERS) + ['runs']
+    for metric in METRICS:
+        fieldnames += [metric + '_mean', metric + '_std']
+    write_csv(args.output, aggregate(results), fieldnames)
+
+    if args.runs_output:
+        rows = []
+        for parameters, seed, metrics in sorted(results, key=lambda res: res[:2]):
+            row = dict(zip(PARAMETERS, parameters))
+            row['seed'] = seed
+            row.update(metrics)
+            rows.append(row)
+        write_csv(args.runs_output, rows,
+                  list(PARAMETERS) + ['seed'] + list(METRICS))
+
+    print('{0} games of {1} parameter sets in {2:.1f} s, written {3}'.format(
+        len(jobs), len(grid), elapsed, args.output))
+
+
+if __name__ == "__main__":
+    main()
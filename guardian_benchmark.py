@@ -0,0 +1,340 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Performance benchmark of the game, based on scenarios.
+
+Each scenario builds a Game state programmatically (start screen, many
+enemies, whale fight, bullets everywhere, zoomed window) and times
+Game.run_logic and Game.display_frame separately over many ticks, with
+the SDL dummy video driver. Results are saved as JSON and can be compared
+with a stored baseline: the exit code is 1 if a scenario regressed.
+
+Example:
+    python guardian_benchmark.py --save-baseline benchmark_baseline.json
+    python guardian_benchmark.py --baseline benchmark_baseline.json
+"""
+
+import argparse
+import json
+import platform
+import random
+import statistics
+import sys
+import time
+
+import pygame
+
+import guardian
+import guardian_env
+
+
+PHASES = ('run_logic', 'display_frame')
+
+
+def make_player_immortal(game):
+    """ The player survives the whole scenario """
+    player = game.player
+    player.immortality_always = True
+    player.physical_obj['immortal'] = True
+    player.category = guardian.CATEGORY_PLAYER_IMMORTAL
+
+
+def setup_enemies(num_enemies):
+    """ Scenario setup with the given number of small spaceships """
+    def setup(game):
+        """ Add the enemies """
+        make_player_immortal(game)
+        for _ in range(num_enemies):
+            guardian.add_enemy()
+    return setup
+
+
+def setup_whale(game):
+    """ Whale fight: the whale shoots its patterns 100 ms apart and the
+    player fires back without killing it """
+    make_player_immortal(game)
+    whale = guardian.add_whale()
+    whale.interval_fire = whale.fire_delay = 100
+    guardian.timers.start(whale.fire_timer,
+                          whale.last_time_fire + whale.fire_delay)
+    whale.physical_obj['hit_points'] = 10**9
+
+
+def refill_whale(game, tick):
+    """ Keep the player firing """
+    game.player.apply_actions(guardian.ACTION_FIRE if tick % 2 == 0
+                              else guardian.ACTION_NONE)
+
+
+# Enemy bullets kept on screen by the bullet scenario
+NUM_SATURATION_BULLETS = 400
+
+def setup_bullets(game):
+    """ Screen full of enemy bullets """
+    make_player_immortal(game)
+    refill_bullets(game, 0)
+
+
+def refill_bullets(game, tick):
+    """ Replace the bullets that left the screen """
+    del tick
+    num_missing = NUM_SATURATION_BULLETS - (len(game.enemy_object_list) -
+                                            len(game.enemy_list))
+    for _ in range(num_missing):
+        bullet = guardian.Bullet(enemy=True,
+                                 x_speed=random.choice((-1, 0, 1)),
+                                 y_speed=random.randint(1, 4))
+        bullet.rect.x = random.randint(bullet.rect.width + 1,
+                                       guardian.SCREEN_WIDTH - 1)
+        bullet.rect.y = random.randint(0, guardian.SCREEN_HEIGHT - 1)
+
+
+def setup_start_screen(game):
+    """ Idle on the start screen """
+    game.start_screen = True
+
+
+# name: (setup, called before each tick or None, window size)
+NORMAL_SIZE = (guardian.SCREEN_WIDTH, guardian.SCREEN_HEIGHT)
+ZOOM_SIZE = (guardian.SCREEN_WIDTH * 2, guardian.SCREEN_HEIGHT * 2)
+
+SCENARIOS = {
+    'start_screen': (setup_start_screen, None, NORMAL_SIZE),
+    'enemies_10': (setup_enemies(10), None, NORMAL_SIZE),
+    'enemies_100': (setup_enemies(100), None, NORMAL_SIZE),
+    'enemies_1000': (setup_enemies(1000), None, NORMAL_SIZE),
+    'whale_fight': (setup_whale, refill_whale, NORMAL_SIZE),
+    'bullets': (setup_bullets, refill_bullets, NORMAL_SIZE),
+    'zoom_2x': (setup_enemies(10), None, ZOOM_SIZE),
+}
+
+
+def summarize(times):
+    """ Statistics in milliseconds of a list of durations in seconds """
+    times_ms = sorted(val * 1000.0 for val in times)
+    return {'mean': statistics.mean(times_ms),
+            'median': statistics.median(times_ms),
+            'p95': times_ms[int(0.95 * (len(times_ms) - 1))],
+            'max': times_ms[-1]}
+
+
+def build_scenario(name, seed):
+    """ Game, screen and drawing surface of the scenario """
+    setup, _, size = SCENARIOS[name]
+    random.seed(seed)
+    guardian.game_clock.set_fixed_step(1000.0 / guardian.FPS)
+
+    game = guardian.Game()
+    game.start_screen = False
+    game.set_fps(guardian.FPS)
+    screen = game.resize_screen(size)
+    surface_fixed_size = pygame.Surface(NORMAL_SIZE).convert()
+    setup(game)
+    return game, screen, surface_fixed_size
+
+
+def run_scenario(name, ticks, warmup, seed):
+    """ Build the scenario and time the phases of each tick """
+    refill = SCENARIOS[name][1]
+    game, screen, surface_fixed_size = build_scenario(name, seed)
+
+    times = {phase: [] for phase in PHASES}
+    for tick in range(warmup + ticks):
+        if refill is not None:
+            refill(game, tick)
+
+        time_start = time.perf_counter()
+        game.run_logic()
+        time_logic = time.perf_counter()
+        game.display_frame(surface_fixed_size, screen)
+        time_end = time.perf_counter()
+
+        if tick >= warmup:
+            times['run_logic'].append(time_logic - time_start)
+            times['display_frame'].append(time_end - time_logic)
+
+    result = {phase: summarize(times[phase]) for phase in PHASES}
+    # the frame is drawn right after its logic: the latency is the tick
+    result['tick'] = summarize([logic + draw for logic, draw in
+                                zip(times['run_logic'], times['display_frame'])])
+    result['sprites'] = len(game.all_sprites_list)
+    return result
+
+
+def run_pipelined(name, ticks, warmup, seed):
+    """ Same scenario with the logic on the LogicWorker thread while the
+    previous frame is drawn. Time each tick and the latency from its
+    start to the end of the drawing of its frame """
+    refill = SCENARIOS[name][1]
+    game, screen, surface_fixed_size = build_scenario(name, seed)
+    worker = guardian.LogicWorker(game)
+
+    frame = None
+    times = {'tick': [], 'latency': []}
+    for tick in range(warmup + ticks):
+        if refill is not None:
+            refill(game, tick)
+
+        time_start = time.perf_counter()
+        worker.start(time_start)
+        latency = None
+        if frame is not None:
+            game.present(frame, surface_fixed_size, screen)
+            latency = time.perf_counter() - frame.time_input
+        frame = worker.finish()
+        time_end = time.perf_counter()
+
+        # same ticks as run_scenario; the first one has no frame to draw
+        if tick >= warmup:
+            times['tick'].append(time_end - time_start)
+            if latency is not None:
+                times['latency'].append(latency)
+
+    worker.stop()
+    return {key: summarize(values) for key, values in times.items()}
+
+
+# 200 bullets in one tick: 8 arms of 25 bullets, faster outwards
+STORM_PATTERN = [{'shape': 'spiral', 'arms': 8, 'count': 200, 'turn': 6,
+                  'speed': 1, 'speed_step': 0.1, 'interval': 0}]
+
+def time_pattern_spawn(elements, repeats, seed):
+    """ Median ms to spawn all the bullets of the first step of a bullet
+    pattern: batched with PatternBullet.spawn_many, and with one
+    constructor call per bullet """
+    game, _, _ = build_scenario('start_screen', seed)
+    _, rows, _ = guardian.compile_bullet_pattern(elements).steps[0]
+
+    def spawn_one_by_one():
+        """ Bullets created by their constructor """
+        for image, x_speed, y_speed in rows:
+            bullet = guardian.PatternBullet(x_speed, y_speed, image=image)
+            bullet.move_to(guardian.SCREEN_WIDTH // 2 - bullet.rect.width // 2, 0)
+
+    result = {'bullets': len(rows)}
+    for method, spawn in (('constructor', spawn_one_by_one),
+                          ('batched', lambda: guardian.PatternBullet.spawn_many(
+                              rows, guardian.SCREEN_WIDTH // 2, 0))):
+        times = []
+        for _ in range(repeats):
+            time_start = time.perf_counter()
+            spawn()
+            times.append(time.perf_counter() - time_start)
+            bullets = game.entity_registry.entities[guardian.LAYER_ENEMY_BULLETS]
+            for bullet in bullets[::-1]:
+                bullet.kill()
+        result[method] = summarize(times)['median']
+    return result
+
+
+def block_flip(seconds):
+    """ Make pygame.display.flip wait like a vsync'd display. The wait
+    releases the GIL, as a real blocking flip does """
+    flip = pygame.display.flip
+
+    def blocking_flip():
+        """ Flip, then wait """
+        flip()
+        time.sleep(seconds)
+    pygame.display.flip = blocking_flip
+
+
+def compare(results, baseline, tolerance, min_delta_ms):
+    """ Return the list of regressions: median slower than the baseline
+    by more than tolerance (relative) and min_delta_ms (absolute) """
+    regressions = []
+    for name, result in results['scenarios'].items():
+        if name not in baseline['scenarios']:
+            continue
+        for phase in PHASES:
+            current = result[phase]['median']
+            reference = baseline['scenarios'][name][phase]['median']
+            if (current > reference * (1.0 + tolerance) and
+                    current - reference > min_delta_ms):
+                regressions.append((name, phase, reference, current))
+    return regressions
+
+
+def main():
+    """ Run the benchmark """
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                        help='comma separated scenarios among: ' +
+                        ', '.join(SCENARIOS))
+    parser.add_argument('--ticks', type=int, default=300)
+    parser.add_argument('--warmup', type=int, default=30)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--baseline', default=None,
+                        help='JSON results to compare with')
+    parser.add_argument('--save-baseline', default=None,
+                        help='also save the results as baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='allowed relative slowdown of the median')
+    parser.add_argument('--min-delta', type=float, default=0.05,
+                        help='slowdowns below these ms are ignored')
+    parser.add_argument('--pipeline', action='store_true',
+                        help='also time the pipelined loop, logic on a thread')
+    parser.add_argument('--flip-ms', type=float, default=0.0,
+                        help='make each display flip block for these ms, as '
+                        'with vsync (the dummy driver returns at once)')
+    args = parser.parse_args()
+
+    guardian_env.init_headless()
+    if args.flip_ms > 0.0:
+        block_flip(args.flip_ms / 1000.0)
+
+    results = {'python': platform.python_version(),
+               'pygame': pygame.version.ver,
+               'platform': platform.platform(),
+               'ticks': args.ticks,
+               'flip_ms': args.flip_ms,
+               'scenarios': {}}
+    print('{0:14} {1:>10} {2:>10} {3:>10} {4:>10}'.format(
+        'scenario', 'logic ms', 'p95', 'draw ms', 'p95'))
+    for name in args.scenarios.split(','):
+        result = run_scenario(name, args.ticks, args.warmup, args.seed)
+        results['scenarios'][name] = result
+        print('{0:14} {1:10.3f} {2:10.3f} {3:10.3f} {4:10.3f}'.format(
+            name, result['run_logic']['median'], result['run_logic']['p95'],
+            result['display_frame']['median'], result['display_frame']['p95']))
+
+    if args.pipeline:
+        results['pipelined'] = {}
+        print('{0:14} {1:>10} {2:>10} {3:>10} {4:>10}'.format(
+            'scenario', 'ticks/s', 'pipelined', 'latency ms', 'pipelined'))
+        for name in args.scenarios.split(','):
+            result = run_pipelined(name, args.ticks, args.warmup, args.seed)
+            results['pipelined'][name] = result
+            sequential = results['scenarios'][name]['tick']
+            print('{0:14} {1:10.0f} {2:10.0f} {3:10.3f} {4:10.3f}'.format(
+                name, 1000.0 / sequential['mean'], 1000.0 / result['tick']['mean'],
+                sequential['median'], result['latency']['median']))
+
+    results['pattern_spawn'] = time_pattern_spawn(STORM_PATTERN, 200, args.seed)
+    print('spawn of {bullets} pattern bullets: {constructor:.3f} ms with the '
+          'constructor, {batched:.3f} ms batched'.format(**results['pattern_spawn']))
+
+    results['assets'] = guardian.assets.memory_report()
+    print('{images} images: {separate_bytes} bytes as separate surfaces, '
+          '{allocated_bytes} bytes allocated in {surfaces} surfaces'.format(
+              **results['assets']))
+
+    for file_name in (args.output, args.save_baseline):
+        if file_name:
+            with open(file_name, 'w') as json_file:
+                json.dump(results, json_file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as json_file:
+            baseline = json.load(json_file)
+        regressions = compare(results, baseline, args.tolerance, args.min_delta)
+        for name, phase, reference, current in regressions:
+            print('REGRESSION {0} {1}: {2:.3f} ms -> {3:.3f} ms'.format(
+                name, phase, reference, current))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
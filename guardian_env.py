@@ -0,0 +1,427 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Environment API over the Game, used to drive it from automated agents
+(e.g. playtesting bots) without faking pygame events or reading the screen.
+
+GameEnv wraps one Game with reset()/step(action).
+VectorGameEnv runs N independent games in worker processes and steps
+them in lockstep.
+FrameObserver exposes the rendered frame as NumPy arrays without copies.
+
+Everything runs headless: no window and no sound card are needed.
+"""
+
+import argparse
+import contextlib
+import copy
+import multiprocessing
+import os
+import random
+import time
+
+import pygame
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import guardian
+
+
+#--- Actions ---
+# An action is a bit mask of the buttons held during the step, the same
+# used by the game input
+ACTION_NONE = guardian.ACTION_NONE
+ACTION_LEFT = guardian.ACTION_LEFT
+ACTION_RIGHT = guardian.ACTION_RIGHT
+ACTION_UP = guardian.ACTION_UP
+ACTION_DOWN = guardian.ACTION_DOWN
+ACTION_FIRE = guardian.ACTION_FIRE
+NUM_ACTIONS = 32 # all the combinations of the buttons
+
+# Reward lost for each hit point
+HP_LOSS_PENALTY = 10.0
+
+#--- Observations ---
+# 'state': dictionary with positions, 'features': fixed size vector,
+# 'frame': RGB frame, 'grayscale': gray frame (both optionally downsampled)
+OBSERVATION_TYPES = ('state', 'features', 'frame', 'grayscale')
+
+# Slots of the feature vector, unused slots are zero
+MAX_FEATURE_ENEMIES = 16
+MAX_FEATURE_BULLETS = 32
+# player x, y, hit points, then x, y, present for each slot
+FEATURE_SIZE = 3 + 3 * (MAX_FEATURE_ENEMIES + MAX_FEATURE_BULLETS)
+
+# Luma weights (x256) for the gray conversion
+GRAY_WEIGHTS = (77, 150, 29)
+
+
+def init_headless():
+    """ Initialize pygame without window and without sound.
+    The game logic follows a fixed step clock of one frame per update. """
+    os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+    os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+    # Let SIGTERM stop worker processes instead of becoming a QUIT event
+    os.environ.setdefault('SDL_NO_SIGNAL_HANDLERS', '1')
+    pygame.display.init()
+    pygame.font.init()
+    if pygame.display.get_surface() is None:
+        pygame.display.set_mode([guardian.SCREEN_WIDTH, guardian.SCREEN_HEIGHT])
+    guardian.game_clock.set_fixed_step(1000.0 / guardian.FPS)
+    guardian.audio.enabled = False
+
+
+def _require_numpy():
+    """ Raise an error if numpy is not installed """
+    if numpy is None:
+        raise ImportError('numpy is required for array observations')
+
+
+class FrameObserver(object):
+    """ NumPy access to the frame drawn by Game.display_frame.
+    Arrays are indexed [x, y] as in pygame.surfarray. """
+
+    def __init__(self, surface, downsample=1):
+        """ Constructor. Pass the surface with fixed size used to draw
+        the game and the downsample factor of the buffers """
+        _require_numpy()
+        self.surface = surface
+        self.downsample = downsample
+        width = len(range(0, surface.get_width(), downsample))
+        height = len(range(0, surface.get_height(), downsample))
+        # Buffers reused across frames
+        self.rgb_buffer = numpy.zeros((width, height, 3), dtype=numpy.uint8)
+        self.gray_buffer = numpy.zeros((width, height), dtype=numpy.uint8)
+        self._gray_sum = numpy.zeros((width, height), dtype=numpy.uint16)
+        self._gray_tmp = numpy.zeros((width, height), dtype=numpy.uint16)
+
+    @contextlib.contextmanager
+    def pixels(self, mapped=False):
+        """ Zero-copy view of the surface: pixels3d, or pixels2d with the
+        mapped colors if mapped is True. The surface stays locked, so it
+        cannot be drawn, until the with block ends. """
+        if mapped:
+            view = pygame.surfarray.pixels2d(self.surface)
+        else:
+            view = pygame.surfarray.pixels3d(self.surface)
+        try:
+            yield view
+        finally:
+            del view
+
+    def rgb(self):
+        """ Fill and return the RGB buffer, downsampled """
+        step = self.downsample
+        with self.pixels() as view:
+            numpy.copyto(self.rgb_buffer, view[::step, ::step])
+        return self.rgb_buffer
+
+    def grayscale(self):
+        """ Fill and return the gray buffer, downsampled """
+        step = self.downsample
+        gray_sum = self._gray_sum
+        gray_tmp = self._gray_tmp
+        with self.pixels() as view:
+            sampled = view[::step, ::step]
+            numpy.multiply(sampled[..., 0], GRAY_WEIGHTS[0], out=gray_sum,
+                           dtype=numpy.uint16)
+            for channel in (1, 2):
+                numpy.multiply(sampled[..., channel], GRAY_WEIGHTS[channel],
+                               out=gray_tmp, dtype=numpy.uint16)
+                numpy.add(gray_sum, gray_tmp, out=gray_sum)
+        numpy.right_shift(gray_sum, 8, out=gray_tmp)
+        numpy.copyto(self.gray_buffer, gray_tmp, casting='unsafe')
+        return self.gray_buffer
+
+
+def fill_feature_vector(game, features):
+    """ Write positions of player, enemies and enemy bullets into features,
+    an array of FEATURE_SIZE floats, normalized to the screen size.
+    Nothing is drawn. """
+    width = float(guardian.SCREEN_WIDTH)
+    height = float(guardian.SCREEN_HEIGHT)
+    features.fill(0.0)
+
+    player = game.player
+    features[0] = player.rect.centerx / width
+    features[1] = player.rect.centery / height
+    features[2] = player.physical_obj['hit_points'] / float(guardian.PLAYER_HP)
+
+    num_enemies = 0
+    num_bullets = 0
+    bullet_offset = 3 + 3 * MAX_FEATURE_ENEMIES
+    for sprite in game.enemy_object_list:
+        if sprite.category == guardian.CATEGORY_ENEMY_BULLET:
+            if num_bullets == MAX_FEATURE_BULLETS:
+                continue
+            idx = bullet_offset + 3 * num_bullets
+            num_bullets += 1
+        else:
+            if num_enemies == MAX_FEATURE_ENEMIES:
+                continue
+            idx = 3 + 3 * num_enemies
+            num_enemies += 1
+        features[idx] = sprite.rect.centerx / width
+        features[idx + 1] = sprite.rect.centery / height
+        features[idx + 2] = 1.0
+
+    return features
+
+
+class GameEnv(object):
+    """ Environment with one game. The game starts directly in play,
+    skipping the start screen. """
+
+    def __init__(self, render=False, observation_type='state', downsample=1,
+                 rewind_seconds=0.0):
+        """ Constructor. If render is True each step draws the frame,
+        frame observations always do. See OBSERVATION_TYPES.
+        With rewind_seconds > 0 a snapshot is recorded at each step. """
+        if observation_type not in OBSERVATION_TYPES:
+            raise ValueError('Unknown observation type ' + observation_type)
+        init_headless()
+        self.observation_type = observation_type
+        self.render = render or observation_type in ('frame', 'grayscale')
+        # Everything will be drawn on a fixed surface, as in main()
+        self.surface_fixed_size = pygame.display.get_surface().copy()
+        self.frame_observer = None
+        self.features = None
+        if observation_type in ('frame', 'grayscale'):
+            self.frame_observer = FrameObserver(self.surface_fixed_size,
+                                                downsample)
+        elif observation_type == 'features':
+            _require_numpy()
+            self.features = numpy.zeros(FEATURE_SIZE, dtype=numpy.float32)
+        self.rewind_buffer = None
+        if rewind_seconds > 0.0:
+            self.rewind_buffer = guardian.RewindBuffer(rewind_seconds)
+        self.game = None
+        self.last_action = ACTION_NONE
+        self.last_score = 0
+        self.last_hit_points = 0
+        self.num_steps = 0
+
+    def reset(self, seed=None):
+        """ Start a new game and return the first observation """
+        random.seed(seed)
+        guardian.game_clock.set_fixed_step(1000.0 / guardian.FPS)
+
+        self.game = guardian.Game()
+        self.game.start_screen = False
+        self.game.set_fps(guardian.FPS)
+
+        self.last_action = ACTION_NONE
+        self.last_score = self.game.player.score
+        self.last_hit_points = self.game.player.physical_obj['hit_points']
+        self.num_steps = 0
+        if self.rewind_buffer is not None:
+            self.rewind_buffer.clear()
+            self.rewind_buffer.record(self.game)
+
+        if self.render:
+            self._draw()
+        return self.observation()
+
+    def _apply_action(self, action):
+        """ Hold the buttons of the action. As for the space bar, a bullet
+        is fired when fire gets pressed. """
+        self.game.player.apply_actions(action)
+        self.last_action = action
+
+    def step(self, action):
+        """ Run one logic update with the given action.
+        Return observation, reward, done, info """
+        self._apply_action(action)
+        self.game.run_logic()
+        if self.render:
+            self._draw()
+        self.num_steps += 1
+        if self.rewind_buffer is not None:
+            self.rewind_buffer.record(self.game)
+
+        player = self.game.player
+        hit_points = player.physical_obj['hit_points']
+        reward = (player.score - self.last_score -
+                  HP_LOSS_PENALTY * max(self.last_hit_points - hit_points, 0))
+        self.last_score = player.score
+        self.last_hit_points = hit_points
+
+        done = hit_points <= 0
+        info = {'score': player.score,
+                'hit_points': hit_points,
+                'steps': self.num_steps}
+
+        return self.observation(), reward, done, info
+
+    def save_state(self):
+        """ Snapshot of the game and of the environment """
+        return (self.game.get_state(), self.last_action, self.num_steps)
+
+    def load_state(self, state):
+        """ Resume from a snapshot created by save_state().
+        Return the observation """
+        game_state, self.last_action, self.num_steps = state
+        self.game.set_state(game_state)
+        self.last_score = self.game.player.score
+        self.last_hit_points = self.game.player.physical_obj['hit_points']
+        if self.render:
+            self._draw()
+        return self.observation()
+
+    def rewind(self, seconds):
+        """ Go back in the game by the given seconds, at most up to the
+        length of the rewind buffer. Return the observation """
+        num_ticks = self.rewind_buffer.rewind(self.game, seconds)
+        if num_ticks:
+            self.num_steps -= num_ticks
+            self.last_score = self.game.player.score
+            self.last_hit_points = self.game.player.physical_obj['hit_points']
+            if self.render:
+                self._draw()
+        return self.observation()
+
+    def _draw(self):
+        """ Draw the current frame """
+        screen = pygame.display.get_surface()
+        self.game.display_frame(self.surface_fixed_size, screen)
+
+    def observation(self):
+        """ Observation of the selected type. Arrays are buffers reused
+        at each step: copy them to keep them. """
+        if self.observation_type == 'frame':
+            return self.frame_observer.rgb()
+        elif self.observation_type == 'grayscale':
+            return self.frame_observer.grayscale()
+        elif self.observation_type == 'features':
+            return fill_feature_vector(self.game, self.features)
+        return self.state()
+
+    def state(self):
+        """ Positions of the player, enemies and bullets plus player status """
+        game = self.game
+        player = game.player
+        enemies = [sprite.rect.center for sprite in game.enemy_list]
+        bullets = [sprite.rect.center for sprite in game.enemy_object_list
+                   if sprite.category == guardian.CATEGORY_ENEMY_BULLET]
+        return {'player': player.rect.center,
+                'hit_points': player.physical_obj['hit_points'],
+                'score': player.score,
+                'enemies': enemies,
+                'bullets': bullets}
+
+
+def _env_worker(connection, env_kwargs):
+    """ Loop run by each process of VectorGameEnv """
+    env = GameEnv(**env_kwargs)
+    while True:
+        command, data = connection.recv()
+        if command == 'reset':
+            connection.send(env.reset(data))
+        elif command == 'step':
+            observation, reward, done, info = env.step(data)
+            if done:
+                # Start a new game right away, as in gym vector env
+                # Observation buffers are reused by reset()
+                info['final_observation'] = copy.copy(observation)
+                observation = env.reset()
+            connection.send((observation, reward, done, info))
+        elif command == 'close':
+            connection.close()
+            break
+
+
+class VectorGameEnv(object):
+    """ N independent games, each in its own process, stepped in lockstep.
+    A game is automatically reset when it ends. """
+
+    def __init__(self, num_envs, **env_kwargs):
+        """ Constructor. Start a process for each game,
+        env_kwargs are passed to GameEnv """
+        self.num_envs = num_envs
+        self.connections = []
+        self.processes = []
+        for _ in range(num_envs):
+            parent_conn, child_conn = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=_env_worker,
+                                              args=(child_conn, env_kwargs),
+                                              daemon=True)
+            process.start()
+            child_conn.close()
+            self.connections.append(parent_conn)
+            self.processes.append(process)
+
+        self.total_steps = 0
+        self.elapsed_time = 0.0
+
+    def reset(self, seeds=None):
+        """ Reset all the games. Return the list of observations """
+        if seeds is None:
+            seeds = [None] * self.num_envs
+        for connection, seed in zip(self.connections, seeds):
+            connection.send(('reset', seed))
+        return [connection.recv() for connection in self.connections]
+
+    def step(self, actions):
+        """ Step every game with its action.
+        Return lists of observations, rewards, dones and infos """
+        time_start = time.perf_counter()
+        for connection, action in zip(self.connections, actions):
+            connection.send(('step', action))
+        results = [connection.recv() for connection in self.connections]
+        self.elapsed_time += time.perf_counter() - time_start
+        self.total_steps += self.num_envs
+
+        observations, rewards, dones, infos = zip(*results)
+        return list(observations), list(rewards), list(dones), list(infos)
+
+    def steps_per_second(self):
+        """ Aggregate steps per second over all the games """
+        if self.elapsed_time <= 0.0:
+            return 0.0
+        return self.total_steps / self.elapsed_time
+
+    def close(self):
+        """ Stop the processes """
+        for connection in self.connections:
+            connection.send(('close', None))
+            connection.close()
+        for process in self.processes:
+            process.join()
+
+
+def main():
+    """ Run random agents and report the steps per second """
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--num-envs', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--steps', type=int, default=1000,
+                        help='steps for each game')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--render', action='store_true',
+                        help='draw every frame')
+    parser.add_argument('--observation', choices=OBSERVATION_TYPES,
+                        default='state')
+    parser.add_argument('--downsample', type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    envs = VectorGameEnv(args.num_envs, render=args.render,
+                         observation_type=args.observation,
+                         downsample=args.downsample)
+    envs.reset([args.seed + idx for idx in range(args.num_envs)])
+
+    games_over = 0
+    for _ in range(args.steps):
+        actions = [rng.randrange(NUM_ACTIONS) for _ in range(args.num_envs)]
+        _, _, dones, _ = envs.step(actions)
+        games_over += sum(dones)
+
+    envs.close()
+    print('{0} games, {1} steps, {2} game over, {3:.1f} steps/s'.format(
+        args.num_envs, envs.total_steps, games_over, envs.steps_per_second()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,617 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Two-player lockstep netplay over UDP.
+
+Both peers run the same deterministic simulation (fixed step clock, seed
+chosen by the host) and exchange only the actions of their player, one
+bit mask per tick, delta and run-length encoded. The local actions are
+applied a few ticks later (input delay) to give them time to reach the
+peer. When the actions of the peer are late, they are predicted to stay
+the same; if the prediction was wrong the game goes back to the snapshot
+of that tick and the ticks are replayed with the right actions (rollback).
+
+The host is the first player, the one who joins the second.
+
+Example:
+    python guardian_net.py --host 5555
+    python guardian_net.py --join 192.168.1.10:5555
+    python guardian_net.py --local-test --ticks 1200 --lag-ms 40 --loss 0.05
+"""
+
+import argparse
+import hashlib
+import heapq
+import multiprocessing
+import random
+import select
+import socket
+import statistics
+import struct
+import time
+
+import pygame
+
+import guardian
+import guardian_env
+
+
+#--- Protocol ---
+PROTOCOL_VERSION = 1
+PACKET_HELLO = 1
+PACKET_INPUTS = 2
+PACKET_BYE = 3
+
+# type, version, seed, input delay
+HELLO = struct.Struct('!BBIB')
+# type, ticks received from the peer, first tick of the actions,
+# send time and echo of the last peer time, in ms modulo 2**16
+HEADER = struct.Struct('!BIIHH')
+NO_ECHO = 0xFFFF
+
+# An action byte: XOR with the previous actions in the low bits,
+# length of the run of ticks minus one in the high bits
+ACTION_BITS = 5
+ACTION_MASK = (1 << ACTION_BITS) - 1
+MAX_RUN = 1 << (8 - ACTION_BITS)
+
+MAX_INPUTS_PER_PACKET = 120
+MAX_PACKET_SIZE = 512
+UDP_IP_OVERHEAD = 28 # bytes of the IPv4 and UDP headers of each packet
+
+INPUT_DELAY = 2 # ticks
+MAX_ROLLBACK = 8 # ticks simulated ahead of the peer before waiting
+HELLO_RETRY_S = 0.2
+FINISH_TIMEOUT_S = 5.0
+
+
+def encode_inputs(inputs):
+    """ Encode a list of action masks: one byte per run of ticks with the
+    same actions, holding the XOR with the actions of the previous run
+    (ACTION_NONE before the first one) and the length of the run """
+    data = bytearray()
+    previous = guardian.ACTION_NONE
+    index = 0
+    while index < len(inputs):
+        actions = inputs[index]
+        run = 1
+        while (run < MAX_RUN and index + run < len(inputs) and
+               inputs[index + run] == actions):
+            run += 1
+        data.append(((run - 1) << ACTION_BITS) | (actions ^ previous))
+        previous = actions
+        index += run
+    return bytes(data)
+
+
+def decode_inputs(data):
+    """ Decode the action masks encoded by encode_inputs() """
+    inputs = []
+    actions = guardian.ACTION_NONE
+    for byte in data:
+        actions ^= byte & ACTION_MASK
+        inputs.extend([actions] * ((byte >> ACTION_BITS) + 1))
+    return inputs
+
+
+def time_ms():
+    """ Clock of the packet timestamps """
+    return int(time.perf_counter() * 1000.0) & 0xFFFF
+
+
+def host(sock, seed, input_delay, timeout=60.0):
+    """ Wait for a peer to join. Return its address and the HELLO reply,
+    sent again if the peer did not get it """
+    sock.settimeout(timeout)
+    while True:
+        data, address = sock.recvfrom(MAX_PACKET_SIZE)
+        if len(data) == HELLO.size and data[0] == PACKET_HELLO:
+            break
+    version = HELLO.unpack(data)[1]
+    if version != PROTOCOL_VERSION:
+        raise ConnectionError('peer protocol {0}, expected {1}'.format(
+            version, PROTOCOL_VERSION))
+    reply = HELLO.pack(PACKET_HELLO, PROTOCOL_VERSION, seed, input_delay)
+    sock.sendto(reply, address)
+    sock.setblocking(False)
+    return address, reply
+
+
+def join(sock, address, timeout=60.0):
+    """ Join the host at address. Return the seed and the input delay
+    chosen by the host """
+    hello = HELLO.pack(PACKET_HELLO, PROTOCOL_VERSION, 0, 0)
+    sock.settimeout(HELLO_RETRY_S)
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        sock.sendto(hello, address)
+        try:
+            data, sender = sock.recvfrom(MAX_PACKET_SIZE)
+        except socket.timeout:
+            continue
+        except ConnectionRefusedError:
+            # the host is not listening yet
+            time.sleep(HELLO_RETRY_S)
+            continue
+        if sender == address and len(data) == HELLO.size and data[0] == PACKET_HELLO:
+            _, version, seed, input_delay = HELLO.unpack(data)
+            if version != PROTOCOL_VERSION:
+                raise ConnectionError('host protocol {0}, expected {1}'.format(
+                    version, PROTOCOL_VERSION))
+            sock.setblocking(False)
+            return seed, input_delay
+    raise ConnectionError('no answer from {0}:{1}'.format(*address))
+
+
+class NetplaySession(object):
+    """ Actions of the two players, exchanged over a non blocking UDP
+    socket. Every packet carries all the local actions the peer did not
+    acknowledge yet, so a lost packet is recovered by the next one.
+    loss and lag_ms simulate a worse network on the outgoing packets. """
+
+    def __init__(self, sock, peer, input_delay=INPUT_DELAY, hello_reply=None,
+                 loss=0.0, lag_ms=0.0):
+        """ Constructor """
+        self.sock = sock
+        self.peer = peer
+        self.input_delay = input_delay
+        self.hello_reply = hello_reply
+        # actions of each tick, the local ones start after the delay
+        self.local_inputs = [guardian.ACTION_NONE] * input_delay
+        self.remote_inputs = []
+        self.remote_acked = 0 # local ticks received by the peer
+        self.remote_time = None # (peer time, local time) of the last packet
+        self.peer_left = False
+
+        self.loss = loss
+        self.lag_ms = lag_ms
+        self.rng = random.Random()
+        self.outbox = [] # (due time, sequence, data) of the lagged packets
+        self.num_delayed = 0
+
+        self.time_start = time.perf_counter()
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.packets_sent = 0
+        self.packets_received = 0
+        self.rtt_ms = []
+
+    def add_local_input(self, actions):
+        """ Actions of the local player, for the tick input_delay ticks
+        after the current one """
+        self.local_inputs.append(actions)
+
+    def remote_input(self, tick):
+        """ Actions of the peer at tick, predicted to be the last ones
+        received when they did not arrive yet """
+        if tick < len(self.remote_inputs):
+            return self.remote_inputs[tick]
+        if self.remote_inputs:
+            return self.remote_inputs[-1]
+        return guardian.ACTION_NONE
+
+    def send(self, packet_type=PACKET_INPUTS):
+        """ Send the local actions not acknowledged by the peer """
+        first = self.remote_acked
+        inputs = self.local_inputs[first:first + MAX_INPUTS_PER_PACKET]
+        now = time_ms()
+        echo = NO_ECHO
+        if self.remote_time is not None:
+            # the time spent here is not part of the round trip
+            peer_time, received = self.remote_time
+            echo = (peer_time + now - received) & 0xFFFF
+        self._send(HEADER.pack(packet_type, len(self.remote_inputs), first,
+                               now, echo) + encode_inputs(inputs))
+
+    def _send(self, data):
+        """ Send a packet, through the simulated network if any """
+        self.bytes_sent += len(data) + UDP_IP_OVERHEAD
+        self.packets_sent += 1
+        if self.loss and self.rng.random() < self.loss:
+            return
+        if self.lag_ms:
+            due = time.perf_counter() + self.lag_ms / 1000.0
+            heapq.heappush(self.outbox, (due, self.num_delayed, data))
+            self.num_delayed += 1
+            self.flush()
+        else:
+            self._sendto(data)
+
+    def _sendto(self, data):
+        """ Write a packet on the socket """
+        try:
+            self.sock.sendto(data, self.peer)
+        except ConnectionRefusedError:
+            pass # the peer is gone, or not there yet
+
+    def flush(self):
+        """ Send the lagged packets that are due """
+        now = time.perf_counter()
+        while self.outbox and self.outbox[0][0] <= now:
+            self._sendto(heapq.heappop(self.outbox)[2])
+
+    def wait(self, seconds):
+        """ Wait until a packet arrives, a lagged packet is due or the time
+        is over. Return True if a packet arrived """
+        if self.outbox:
+            seconds = min(seconds, self.outbox[0][0] - time.perf_counter())
+        readable, _, _ = select.select([self.sock], [], [], max(seconds, 0.0))
+        self.flush()
+        return bool(readable)
+
+    def receive(self):
+        """ Read the packets of the peer. Return the first tick whose
+        remote actions just arrived, None if there is no new one """
+        self.flush()
+        first_new = None
+        while True:
+            try:
+                data, address = self.sock.recvfrom(MAX_PACKET_SIZE)
+            except BlockingIOError:
+                break
+            except ConnectionRefusedError:
+                continue
+            if address != self.peer or len(data) < 1:
+                continue
+            self.bytes_received += len(data) + UDP_IP_OVERHEAD
+            self.packets_received += 1
+
+            if data[0] == PACKET_HELLO:
+                # our reply was lost
+                if self.hello_reply is not None:
+                    self._sendto(self.hello_reply)
+                continue
+            if data[0] not in (PACKET_INPUTS, PACKET_BYE) or len(data) < HEADER.size:
+                continue
+
+            packet_type, ack, first_tick, peer_time, echo = HEADER.unpack_from(data)
+            now = time_ms()
+            if packet_type == PACKET_BYE:
+                self.peer_left = True
+            self.remote_acked = max(self.remote_acked, ack)
+            if echo != NO_ECHO:
+                self.rtt_ms.append((now - echo) & 0xFFFF)
+            self.remote_time = (peer_time, now)
+
+            inputs = decode_inputs(data[HEADER.size:])
+            known = len(self.remote_inputs)
+            if first_tick <= known < first_tick + len(inputs):
+                self.remote_inputs.extend(inputs[known - first_tick:])
+                if first_new is None:
+                    first_new = known
+        return first_new
+
+    def report(self):
+        """ Bandwidth, with the UDP/IP headers, and round trip time """
+        elapsed = max(time.perf_counter() - self.time_start, 1e-9)
+        rtt_ms = sorted(self.rtt_ms) or [0]
+        return {'sent_bytes_per_s': self.bytes_sent / elapsed,
+                'received_bytes_per_s': self.bytes_received / elapsed,
+                'packets_per_s': self.packets_sent / elapsed,
+                'bytes_per_packet': (self.bytes_sent / max(self.packets_sent, 1) -
+                                     UDP_IP_OVERHEAD),
+                'rtt_ms_mean': statistics.mean(rtt_ms),
+                'rtt_ms_p95': rtt_ms[int(0.95 * (len(rtt_ms) - 1))]}
+
+
+class LockstepGame(object):
+    """ Game of two players advanced one tick at a time with the actions
+    of the NetplaySession. A snapshot is kept for every tick whose remote
+    actions are not confirmed, to roll back when they were mispredicted.
+    It waits for the peer when it is more than max_rollback ticks ahead. """
+
+    def __init__(self, game, session, local_index, max_rollback=MAX_ROLLBACK):
+        """ Constructor """
+        self.game = game
+        self.session = session
+        self.local_index = local_index
+        self.max_rollback = max(max_rollback, 1)
+        self.tick = 0 # next tick to simulate
+        self.snapshots = {} # tick: game state before the tick
+        self.predicted = {} # tick: remote actions it was simulated with
+
+        self.rollbacks = 0
+        self.ticks_replayed = 0
+        self.max_ticks_replayed = 0
+        self.stalls = 0
+
+    def _simulate(self):
+        """ Run the logic of the next tick """
+        tick = self.tick
+        self.snapshots[tick] = self.game.get_state()
+        remote = self.session.remote_input(tick)
+        self.predicted[tick] = remote
+        actions = [None, None]
+        actions[self.local_index] = (self.session.local_inputs[tick], None)
+        actions[1 - self.local_index] = (remote, None)
+        self.game.apply_actions(actions)
+        self.game.run_logic()
+        self.tick += 1
+
+    def _rollback(self, first_tick):
+        """ Replay the ticks from the first one simulated with wrong remote
+        actions, looking from first_tick """
+        remote_inputs = self.session.remote_inputs
+        for tick in range(first_tick, min(self.tick, len(remote_inputs))):
+            if remote_inputs[tick] != self.predicted[tick]:
+                break
+        else:
+            return
+
+        # Sounds were already played the first time
+        replay_end = self.tick
+        audio_enabled = guardian.audio.enabled
+        guardian.audio.enabled = False
+        self.game.set_state(self.snapshots[tick])
+        self.tick = tick
+        while self.tick < replay_end:
+            self._simulate()
+        guardian.audio.enabled = audio_enabled
+
+        self.rollbacks += 1
+        self.ticks_replayed += replay_end - tick
+        self.max_ticks_replayed = max(self.max_ticks_replayed, replay_end - tick)
+
+    def update(self):
+        """ Receive the actions of the peer and roll back if needed """
+        first_new = self.session.receive()
+        if first_new is not None and first_new < self.tick:
+            self._rollback(first_new)
+        # Confirmed ticks are never replayed
+        confirmed = min(len(self.session.remote_inputs), self.tick)
+        for tick in [tick for tick in self.snapshots if tick < confirmed]:
+            del self.snapshots[tick]
+            del self.predicted[tick]
+
+    def advance(self, local_actions):
+        """ Simulate the next tick, the local actions are used input_delay
+        ticks later. Return False, without using them, when waiting for
+        the peer """
+        self.update()
+        if self.tick - len(self.session.remote_inputs) >= self.max_rollback:
+            self.stalls += 1
+            self.session.send()
+            return False
+        self.session.add_local_input(local_actions)
+        self._simulate()
+        self.session.send()
+        return True
+
+    def finish(self, timeout=FINISH_TIMEOUT_S):
+        """ Exchange the last actions until both peers have all the ticks
+        simulated here, then say goodbye. Return True if they did """
+        session = self.session
+        deadline = time.perf_counter() + timeout
+        next_send = 0.0
+        complete = False
+        while time.perf_counter() < deadline:
+            self.update()
+            complete = (len(session.remote_inputs) >= self.tick and
+                        session.remote_acked >= self.tick)
+            if complete or session.peer_left:
+                break
+            if time.perf_counter() >= next_send:
+                session.send()
+                next_send = time.perf_counter() + 1.0 / guardian.FPS
+            session.wait(next_send - time.perf_counter())
+        for _ in range(3):
+            session.send(PACKET_BYE)
+        while session.outbox:
+            session.flush()
+            time.sleep(0.001)
+        return complete
+
+    def report(self):
+        """ Rollback and network statistics """
+        result = {'ticks': self.tick,
+                  'input_delay_ms': self.session.input_delay * 1000.0 / guardian.FPS,
+                  'rollbacks': self.rollbacks,
+                  'ticks_replayed': self.ticks_replayed,
+                  'max_rollback_ms': self.max_ticks_replayed * 1000.0 / guardian.FPS,
+                  'stalls': self.stalls}
+        result.update(self.session.report())
+        return result
+
+
+def new_game(seed):
+    """ Game of two players, the same on both peers """
+    random.seed(seed)
+    guardian.game_clock.set_fixed_step(1000.0 / guardian.FPS)
+    game = guardian.Game(2)
+    game.start_screen = False
+    game.set_fps(guardian.FPS)
+    return game
+
+
+def state_digest(game):
+    """ Hash of the game state, to check that the peers did not diverge """
+    return hashlib.sha1(guardian.dump_state(game.get_state())).hexdigest()
+
+
+def run_realtime(lockstep, poll_actions, max_ticks=None, draw=None):
+    """ Advance the game FPS times per second until max_ticks, or until
+    poll_actions() returns None or the peer leaves """
+    logic_step = 1.0 / guardian.FPS
+    next_time = time.perf_counter()
+    pressed = guardian.ACTION_NONE
+    while max_ticks is None or lockstep.tick < max_ticks:
+        actions = poll_actions()
+        if actions is None or lockstep.session.peer_left:
+            break
+        # A press is kept until a tick uses it
+        pressed |= actions
+        if not lockstep.advance(pressed):
+            lockstep.session.wait(logic_step)
+            continue
+        pressed = guardian.ACTION_NONE
+        if draw is not None:
+            draw()
+
+        # Read the packets while waiting, not only once per tick
+        next_time += logic_step
+        delay = next_time - time.perf_counter()
+        while delay > 0:
+            if lockstep.session.wait(delay):
+                lockstep.update()
+            delay = next_time - time.perf_counter()
+        if delay < -MAX_ROLLBACK * logic_step:
+            next_time = time.perf_counter()
+
+
+def bot_actions(seed, tick):
+    """ Actions of the test bots: random buttons changed every 15 ticks,
+    and a shot every 8 ticks """
+    actions = random.Random(seed * 1000003 + tick // 15).randrange(
+        guardian_env.NUM_ACTIONS)
+    if tick % 8 == 0:
+        actions |= guardian.ACTION_FIRE
+    else:
+        actions &= ~guardian.ACTION_FIRE
+    return actions
+
+
+def _test_peer(index, args, results):
+    """ Peer process of the local test, the first one is the host """
+    guardian_env.init_headless()
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', 0))
+    if index == 0:
+        results.put(('port', sock.getsockname()[1]))
+        peer, reply = host(sock, args.seed, args.input_delay)
+        seed, input_delay = args.seed, args.input_delay
+    else:
+        peer, reply = ('127.0.0.1', args.test_port), None
+        seed, input_delay = join(sock, peer)
+
+    session = NetplaySession(sock, peer, input_delay, reply,
+                             loss=args.loss, lag_ms=args.lag_ms)
+    lockstep = LockstepGame(new_game(seed), session, index, args.max_rollback)
+    run_realtime(lockstep, lambda: bot_actions(index, lockstep.tick), args.ticks)
+    complete = lockstep.finish()
+    report = lockstep.report()
+    report['complete'] = complete
+    results.put((index, state_digest(lockstep.game), report))
+    sock.close()
+
+
+def local_test(args):
+    """ Play a game between two bots in two processes over localhost.
+    Return True if both ended with the same game state """
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    processes = [context.Process(target=_test_peer, args=(0, args, results))]
+    processes[0].start()
+    args.test_port = results.get(timeout=60)[1]
+    processes.append(context.Process(target=_test_peer,
+                                     args=(1, args, results)))
+    processes[1].start()
+
+    timeout = 60.0 + 2.0 * args.ticks / guardian.FPS
+    peers = sorted(results.get(timeout=timeout) for _ in processes)
+    for process in processes:
+        process.join()
+
+    for index, digest, report in peers:
+        print('player {0}: {1}'.format(index + 1, digest))
+        print_report(report)
+    same = peers[0][1] == peers[1][1]
+    print('game states are {0}'.format('identical' if same else 'DIFFERENT'))
+    return same
+
+
+def print_report(report):
+    """ Print the statistics of a LockstepGame """
+    print('  {ticks} ticks, input delay {input_delay_ms:.1f} ms, '
+          'round trip {rtt_ms_mean:.1f} ms (p95 {rtt_ms_p95:.1f} ms)'.format(**report))
+    print('  {rollbacks} rollbacks, {ticks_replayed} ticks replayed, '
+          'longest {max_rollback_ms:.1f} ms, {stalls} stalls'.format(**report))
+    print('  sent {sent_bytes_per_s:.0f} B/s, received {received_bytes_per_s:.0f} B/s, '
+          '{packets_per_s:.1f} packets/s of {bytes_per_packet:.1f} B '
+          'plus UDP/IP headers'.format(**report))
+
+
+def play(args):
+    """ Play over the network in a window, with the keyboard or joypad """
+    pygame.init()
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    if args.host is not None:
+        sock.bind(('', args.host))
+        print('Waiting for the second player on port {0}'.format(args.host))
+        seed = args.seed if args.seed is not None else random.randrange(2**32)
+        peer, reply = host(sock, seed, args.input_delay)
+        input_delay = args.input_delay
+        index = 0
+    else:
+        host_name, port = args.join.rsplit(':', 1)
+        peer, reply = (socket.gethostbyname(host_name), int(port)), None
+        seed, input_delay = join(sock, peer)
+        index = 1
+
+    screen = pygame.display.set_mode([guardian.SCREEN_WIDTH, guardian.SCREEN_HEIGHT],
+                                     guardian.DISPLAY_FLAGS)
+    surface_fixed_size = screen.copy()
+    pygame.display.set_caption('Guardian - player {0}'.format(index + 1))
+    guardian.audio.preload()
+
+    session = NetplaySession(sock, peer, input_delay, reply,
+                             loss=args.loss, lag_ms=args.lag_ms)
+    lockstep = LockstepGame(new_game(seed), session, index, args.max_rollback)
+    guardian.audio.play_music('corridor')
+    # The local player uses the keys and joypad of the first player
+    input_mapper = lockstep.game.input_mappers[0]
+
+    def poll_actions():
+        """ Held actions, plus the ones pressed and already released """
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT:
+                return None
+            input_mapper.process_event(event)
+        held, pressed = input_mapper.poll()
+        return held | pressed
+
+    def draw():
+        """ Draw the current frame """
+        lockstep.game.display_frame(surface_fixed_size, screen)
+
+    run_realtime(lockstep, poll_actions, draw=draw)
+    lockstep.finish(timeout=1.0)
+    print_report(lockstep.report())
+    sock.close()
+    pygame.quit()
+
+
+def main():
+    """ Host, join or run the local test """
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    mode = parser.add_mutually_exclusive_group(required=True)
+    mode.add_argument('--host', type=int, metavar='PORT',
+                      help='wait for the second player on this UDP port')
+    mode.add_argument('--join', metavar='HOST:PORT',
+                      help='join the game of the first player')
+    mode.add_argument('--local-test', action='store_true',
+                      help='two bots in two processes over localhost')
+    parser.add_argument('--input-delay', type=int, default=INPUT_DELAY,
+                        help='ticks the local actions are delayed (host only)')
+    parser.add_argument('--max-rollback', type=int, default=MAX_ROLLBACK,
+                        help='ticks simulated ahead of the peer before waiting')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='seed of the game (host only)')
+    parser.add_argument('--ticks', type=int, default=600,
+                        help='length of the local test')
+    parser.add_argument('--loss', type=float, default=0.0,
+                        help='simulated loss rate of the sent packets')
+    parser.add_argument('--lag-ms', type=float, default=0.0,
+                        help='simulated delay of the sent packets')
+    args = parser.parse_args()
+
+    if args.local_test:
+        if args.seed is None:
+            args.seed = 0
+        if not local_test(args):
+            raise SystemExit(1)
+    else:
+        play(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""
+Bullet patterns of the whale: loading, checks and compiled spawn tables.
+
+Run with: python -m unittest discover tests
+"""
+
+import json
+import os
+import random
+import tempfile
+import unittest
+import unittest.mock
+
+import guardian
+import guardian_env
+
+
+class BulletPatternTest(unittest.TestCase):
+    """ load_bullet_patterns and compile_bullet_pattern """
+
+    def setUp(self):
+        """ Game with a whale, which registers the bullet images """
+        guardian_env.init_headless()
+        random.seed(0)
+        self.game = guardian.Game()
+        self.whale = guardian.add_whale()
+
+    def load(self, patterns, sequence=('test',)):
+        """ Load the patterns from a temporary JSON file """
+        with tempfile.NamedTemporaryFile('w', suffix='.json',
+                                         delete=False) as json_file:
+            json.dump({'sequence': list(sequence), 'patterns': patterns},
+                      json_file)
+        try:
+            return guardian.load_bullet_patterns(json_file.name)
+        finally:
+            os.remove(json_file.name)
+
+    def test_volley(self):
+        """ The default sequence is the original volley of five bullets """
+        self.assertEqual(guardian.Whale.pattern_sequence, ('volley',))
+        steps = guardian.Whale.patterns['volley'].steps
+        self.assertEqual(len(steps), 1)
+        time_ms, rows, aimed_rows = steps[0]
+        self.assertEqual(time_ms, 0)
+        self.assertIsNone(aimed_rows)
+        self.assertEqual([(guardian.assets.name_of(image), x_speed, y_speed)
+                          for image, x_speed, y_speed in rows],
+                         [('whale_bullet_big', 0, 3),
+                          ('whale_bullet_small', -3, 3),
+                          ('whale_bullet_small', -1, 3),
+                          ('whale_bullet_small', 3, 3),
+                          ('whale_bullet_small', 1, 3)])
+
+    def test_spiral_steps(self):
+        """ A spiral fires one bullet per arm at each interval """
+        patterns, _ = self.load({'test': [{'shape': 'spiral', 'arms': 2,
+                                           'count': 6, 'interval': 3}]})
+        steps = patterns['test'].steps
+        self.assertEqual([len(rows) for _, rows, _ in steps], [2, 2, 2])
+        self.assertEqual([time_ms for time_ms, _, _ in steps], [0, 50, 100])
+
+    def test_invalid_patterns(self):
+        """ Patterns that are not valid or fire nothing are rejected """
+        invalid = ([],
+                   [{'shape': 'ring', 'count': 8, 'repeat': 0}],
+                   [{'shape': 'bullets'}],
+                   [{'shape': 'bullets', 'velocities': [[1, 2, 3]]}],
+                   [{'shape': 'wave'}],
+                   [{'shape': 'ring', 'image': 'missing'}],
+                   [{'shape': 'spiral', 'arms': 0}],
+                   [{'shape': 'ring', 'count': '8'}],
+                   [{'shape': 'ring', 'count': 2.5}],
+                   [{'shape': 'ring', 'repeat': True}],
+                   [{'shape': 'ring', 'speed': None}],
+                   [{'shape': 'spread', 'width': 'wide'}],
+                   [{'shape': 'ring', 'repeat': 3, 'interval': -5}],
+                   [{'shape': 'ring', 'delay': -1}],
+                   [{'shape': 'bullets', 'velocities': [[1, 'x']]}])
+        for elements in invalid:
+            with self.assertRaises(ValueError):
+                self.load({'test': elements})
+        with self.assertRaises(ValueError):
+            self.load({'test': [{'shape': 'ring'}]}, sequence=())
+        with self.assertRaises(ValueError):
+            self.load({'test': [{'shape': 'ring'}]}, sequence=('other',))
+
+    def test_loaded_with_game(self):
+        """ The patterns are compiled when the game starts, before any
+        whale appears """
+        with unittest.mock.patch.object(guardian.Whale, 'pattern_sequence', ()), \
+                unittest.mock.patch.object(guardian.Whale, 'patterns', {}):
+            guardian.Game()
+            self.assertEqual(guardian.Whale.pattern_sequence, ('volley',))
+            self.assertIn('volley', guardian.Whale.patterns)
+
+    def test_spawn_many(self):
+        """ Batched bullets are like the ones of the constructor """
+        rows = guardian.Whale.patterns['volley'].steps[0][1]
+        guardian.PatternBullet.spawn_many(rows, 100, 50)
+        bullets = self.game.entity_registry.entities[guardian.LAYER_ENEMY_BULLETS]
+        self.assertEqual(len(bullets), len(rows))
+        for bullet, (image, x_speed, y_speed) in zip(bullets, rows):
+            expected = guardian.PatternBullet(x_speed, y_speed, image=image)
+            expected.move_to(100 - expected.rect.width//2, 50)
+            self.assertEqual(bullet.get_state(), expected.get_state())
+            self.assertEqual(sorted(vars(bullet)), sorted(vars(expected)))
+            self.assertTrue(bullet.alive())
+            expected.kill()
+
+
+if __name__ == '__main__':
+    unittest.main()
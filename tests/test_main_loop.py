@@ -0,0 +1,91 @@
+"""
+Main loop: the screens shown when waking up from the idle screens.
+
+Run with: python -m unittest discover tests
+"""
+
+import sys
+import unittest
+from unittest import mock
+
+import pygame
+
+import guardian
+import guardian_env
+
+
+class IdleScreensTest(unittest.TestCase):
+    """ main() goes from game over to the start screen when Enter is
+    pressed, with and without the pipelined loop """
+
+    def run_main(self, *args):
+        """ Play until game over, press Enter, then quit at the next idle
+        wait. Return the log of the screens drawn ('start', 'play',
+        'over') and of the idle waits ('wait') """
+        guardian_env.init_headless()
+        log = []
+        # events returned by the idle waits, in order
+        wake_events = [pygame.event.Event(pygame.KEYDOWN, key=pygame.K_SPACE,
+                                          mod=0, unicode=' ', scancode=0),
+                       pygame.event.Event(pygame.KEYDOWN, key=pygame.K_RETURN,
+                                          mod=0, unicode='\r', scancode=0),
+                       pygame.event.Event(pygame.QUIT)]
+        present = guardian.Game.present
+        run_logic = guardian.Game.run_logic
+        ticks = [0]
+
+        def wait(timeout):
+            """ Wake up at once with the next event """
+            del timeout
+            log.append('wait')
+            if wake_events:
+                return wake_events.pop(0)
+            return pygame.event.Event(pygame.NOEVENT)
+
+        def present_logged(game, frame, surface, screen):
+            """ Log the screen of the frame drawn """
+            log.append('start' if frame.start_screen else
+                       'over' if frame.game_over else 'play')
+            present(game, frame, surface, screen)
+
+        def run_logic_ended(game):
+            """ The players die as soon as the game starts """
+            run_logic(game)
+            ticks[0] += 1
+            if not game.start_screen:
+                for player in game.players:
+                    player.physical_obj['hit_points'] = 0
+            if ticks[0] > 600:
+                pygame.event.post(pygame.event.Event(pygame.QUIT))
+
+        with mock.patch.object(sys, 'argv', ['guardian'] + list(args)), \
+                mock.patch.object(pygame.event, 'wait', wait), \
+                mock.patch.object(guardian.Game, 'present', present_logged), \
+                mock.patch.object(guardian.Game, 'run_logic', run_logic_ended), \
+                mock.patch.object(guardian.audio, 'enabled', False):
+            guardian.main()
+        return log
+
+    def check_restart(self, log):
+        """ Each idle wait follows the drawing of the idle screen, the
+        last one the start screen shown after the game over """
+        self.assertEqual(log.count('wait'), 3, log)
+        drawn_before_waits = []
+        for index, entry in enumerate(log):
+            if entry == 'wait':
+                drawn = [item for item in log[:index] if item != 'wait']
+                drawn_before_waits.append(drawn[-1])
+        self.assertEqual(drawn_before_waits, ['start', 'over', 'start'], log)
+        self.assertIn('play', log)
+
+    def test_restart(self):
+        """ Sequential loop """
+        self.check_restart(self.run_main())
+
+    def test_restart_pipelined(self):
+        """ Pipelined loop, the logic on its thread """
+        self.check_restart(self.run_main('--pipeline'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+"""
+Netplay: action codec and rollback of the lockstep game, without network.
+
+Run with: python -m unittest discover tests
+"""
+
+import random
+import unittest
+
+import guardian
+import guardian_env
+import guardian_net
+
+
+class InputCodecTest(unittest.TestCase):
+    """ encode_inputs / decode_inputs """
+
+    def assertRoundTrip(self, inputs):
+        """ Decoding the encoded inputs gives them back """
+        self.assertEqual(guardian_net.decode_inputs(
+            guardian_net.encode_inputs(inputs)), inputs)
+
+    def test_empty(self):
+        """ No actions, no bytes """
+        self.assertEqual(guardian_net.encode_inputs([]), b'')
+        self.assertRoundTrip([])
+
+    def test_long_runs(self):
+        """ Runs longer than MAX_RUN take one byte per MAX_RUN ticks """
+        max_run = guardian_net.MAX_RUN
+        for length in (1, max_run - 1, max_run, max_run + 1, 5 * max_run + 3):
+            inputs = [guardian.ACTION_FIRE | guardian.ACTION_LEFT] * length
+            self.assertRoundTrip(inputs)
+            self.assertEqual(len(guardian_net.encode_inputs(inputs)),
+                             -(-length // max_run))
+        self.assertRoundTrip([guardian.ACTION_NONE] * (3 * max_run) +
+                             [guardian.ACTION_UP] * (2 * max_run + 1))
+
+    def test_random(self):
+        """ All the action masks, in random runs """
+        rng = random.Random(1)
+        for _ in range(50):
+            inputs = []
+            for _ in range(rng.randrange(1, 30)):
+                inputs.extend([rng.randrange(guardian_env.NUM_ACTIONS)] *
+                              rng.randrange(1, 3 * guardian_net.MAX_RUN))
+            self.assertRoundTrip(inputs)
+
+
+class RollbackTest(unittest.TestCase):
+    """ LockstepGame replays the ticks of mispredicted remote actions """
+
+    NUM_TICKS = 90
+    SEED = 5
+
+    def setUp(self):
+        """ Actions of the two players """
+        guardian_env.init_headless()
+        self.local = [guardian_net.bot_actions(1, tick)
+                      for tick in range(self.NUM_TICKS)]
+        self.remote = [guardian_net.bot_actions(2, tick)
+                       for tick in range(self.NUM_TICKS)]
+
+    def lockstep(self):
+        """ Lockstep game of the first player, without socket """
+        session = guardian_net.NetplaySession(None, None, input_delay=0)
+        game = guardian_net.new_game(self.SEED)
+        return guardian_net.LockstepGame(game, session, 0,
+                                         max_rollback=self.NUM_TICKS)
+
+    def test_rollback_reaches_same_state(self):
+        """ Remote actions received late: after the rollbacks the state is
+        the one of the game simulated with the right actions """
+        reference = self.lockstep()
+        reference.session.remote_inputs = list(self.remote)
+        for actions in self.local:
+            reference.session.add_local_input(actions)
+            reference._simulate()
+        expected = guardian_net.state_digest(reference.game)
+        self.assertEqual(reference.rollbacks, 0)
+
+        lockstep = self.lockstep()
+        session = lockstep.session
+        for tick, actions in enumerate(self.local):
+            session.add_local_input(actions)
+            lockstep._simulate()
+            # the remote actions arrive 10 ticks late, in batches
+            if tick % 5 == 4 and tick >= 10:
+                first_new = len(session.remote_inputs)
+                session.remote_inputs = self.remote[:tick - 9]
+                lockstep._rollback(first_new)
+        first_new = len(session.remote_inputs)
+        session.remote_inputs = list(self.remote)
+        lockstep._rollback(first_new)
+
+        self.assertGreater(lockstep.rollbacks, 0)
+        self.assertEqual(lockstep.tick, self.NUM_TICKS)
+        self.assertEqual(guardian_net.state_digest(lockstep.game), expected)
+
+    def test_wrong_prediction_changes_state(self):
+        """ Without the rollback the mispredicted game differs, so the
+        test above checks something """
+        reference = self.lockstep()
+        reference.session.remote_inputs = list(self.remote)
+        for actions in self.local:
+            reference.session.add_local_input(actions)
+            reference._simulate()
+
+        lockstep = self.lockstep()
+        for actions in self.local:
+            lockstep.session.add_local_input(actions)
+            lockstep._simulate()
+        self.assertNotEqual(guardian_net.state_digest(lockstep.game),
+                            guardian_net.state_digest(reference.game))
+
+
+if __name__ == '__main__':
+    unittest.main()
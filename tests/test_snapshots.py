@@ -0,0 +1,82 @@
+"""
+Game snapshots: save, restore and rewind give back the exact same state.
+
+Run with: python -m unittest discover tests
+"""
+
+import random
+import unittest
+
+import guardian
+import guardian_env
+
+
+def dumped(env):
+    """ Serialized state of the game of the environment """
+    return guardian.dump_state(env.game.get_state())
+
+
+class SnapshotTest(unittest.TestCase):
+    """ Game.get_state / Game.set_state and the rewind buffer """
+
+    def setUp(self):
+        """ Game played for a while with random buttons """
+        self.env = guardian_env.GameEnv(rewind_seconds=1.0)
+        self.env.reset(seed=3)
+        self.actions = random.Random(7)
+        for _ in range(120):
+            self.step()
+
+    def step(self):
+        """ One step with a random action """
+        self.env.step(self.actions.randrange(2 * guardian.ACTION_FIRE))
+
+    def test_restore_is_identical(self):
+        """ snapshot, steps, restore: the same bytes, and the same steps
+        from there give the same states """
+        snapshot = dumped(self.env)
+        actions_state = self.actions.getstate()
+        played = []
+        for _ in range(30):
+            self.step()
+            played.append(dumped(self.env))
+
+        self.env.game.set_state(guardian.load_state(snapshot))
+        self.assertEqual(dumped(self.env), snapshot)
+
+        self.actions.setstate(actions_state)
+        for expected in played:
+            self.step()
+            self.assertEqual(dumped(self.env), expected)
+
+    def test_rewind_ticks(self):
+        """ Rewinding N ticks gives the state of N steps before """
+        states = [dumped(self.env)]
+        for _ in range(20):
+            self.step()
+            states.append(dumped(self.env))
+        num_steps = self.env.num_steps
+
+        for num_ticks in (1, 5):
+            self.env.rewind(num_ticks / float(guardian.FPS))
+            del states[len(states) - num_ticks:]
+            num_steps -= num_ticks
+            self.assertEqual(dumped(self.env), states[-1])
+            self.assertEqual(self.env.num_steps, num_steps)
+
+    def test_rewind_limited_by_buffer(self):
+        """ Rewinding more than the buffer stops at the oldest snapshot,
+        the number of steps follows the state restored """
+        buffer = self.env.rewind_buffer
+        oldest = guardian.dump_state(buffer.states[0])
+        num_ticks = len(buffer) - 1
+        num_steps = self.env.num_steps
+
+        self.env.rewind(10.0)
+        self.assertEqual(dumped(self.env), oldest)
+        self.assertEqual(self.env.num_steps, num_steps - num_ticks)
+        self.assertEqual(buffer.rewind(self.env.game, 1.0), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()